@@ -3,6 +3,7 @@ from ansible.plugins.loader import fragment_loader
 from ansible.utils import plugin_docs
 import os
 import re
+import pprint
 from stringcase import spinalcase, camelcase
 from pathlib import Path
 import base64
@@ -76,8 +77,122 @@ with open(DEFINITION_FILE) as f:
             config['defaultvalue'] = "4"
             config['additionalinfo'] = "If multiple hosts are specified in a command, how many hosts should be interacted with concurrently."
             integration['configuration'].append(config)
+
+        # Add static tunables relating to local (API backed) integrations
+        if not integration_def.get('hostbasedtarget'):
+            config = {}
+            config['display'] = "Run Modules In Process"
+            config['name'] = "in_process"
+            config['type'] = 8
+            config['required'] = False
+            config['additionalinfo'] = "Run the Ansible modules directly in the integration process rather than starting ansible-runner for each command, which is faster. Modules with an action plugin, and commands run async or with a host_timeout or deadline, still use ansible-runner."
+            integration['configuration'].append(config)
+
+            config = {}
+            config['display'] = "Rate Limit"
+            config['name'] = "rate_limit"
+            config['type'] = 0
+            config['required'] = False
+            config['additionalinfo'] = "The maximum module runs a second, shared by all commands of this instance. Leave empty for no limit."
+            integration['configuration'].append(config)
+
+            config = {}
+            config['display'] = "Rate Limit Burst"
+            config['name'] = "rate_limit_burst"
+            config['type'] = 0
+            config['required'] = False
+            config['defaultvalue'] = "1"
+            config['additionalinfo'] = "How many module runs can start at once before the Rate Limit applies."
+            integration['configuration'].append(config)
+
+            config = {}
+            config['display'] = "Rate Limit Retries"
+            config['name'] = "rate_limit_retries"
+            config['type'] = 0
+            config['required'] = False
+            config['defaultvalue'] = "3"
+            config['additionalinfo'] = "How many times a module run is retried when the provider rate limits it (eg HTTP 429). All commands of this instance back off before retrying."
+            integration['configuration'].append(config)
+
+            config = {}
+            config['display'] = "Rate Limit Backoff"
+            config['name'] = "rate_limit_backoff"
+            config['type'] = 0
+            config['required'] = False
+            config['defaultvalue'] = "2"
+            config['additionalinfo'] = "Seconds to back off before the first retry of a rate limited module run, doubled for each later retry."
+            integration['configuration'].append(config)
+
+        # Add static tunables relating to persistent network_cli connections
+        if integration_def.get('hostbasedtarget') in ("ios", "nxos"):
+            config = {}
+            config['display'] = "Connect Timeout"
+            config['name'] = "connect_timeout"
+            config['type'] = 0
+            config['required'] = False
+            config['additionalinfo'] = "Seconds to wait for the SSH connection to a device."
+            integration['configuration'].append(config)
+
+            config = {}
+            config['display'] = "Command Timeout"
+            config['name'] = "command_timeout"
+            config['type'] = 0
+            config['required'] = False
+            config['additionalinfo'] = "Seconds to wait for a device to respond to a command."
+            integration['configuration'].append(config)
+
+            config = {}
+            config['display'] = "Persistent Connection Socket Directory"
+            config['name'] = "persistent_control_path_dir"
+            config['type'] = 0
+            config['required'] = False
+            config['additionalinfo'] = "Where the sockets of the open device connections are kept. Defaults to ansible-pc in the temp directory."
+            integration['configuration'].append(config)
+
+        # Add static tunables relating to the ansible-runner artifacts
+        config = {}
+        config['display'] = "Keep Runner Artifacts"
+        config['name'] = "keep_artifacts"
+        config['type'] = 8
+        config['required'] = False
+        config['additionalinfo'] = "Keep the ansible-runner artifacts (job events, stdout, status) of each command for debugging. By default they are removed as soon as the results have been parsed."
+        integration['configuration'].append(config)
+
+        config = {}
+        config['display'] = "Artifact Directory"
+        config['name'] = "artifact_dir"
+        config['type'] = 0
+        config['required'] = False
+        config['additionalinfo'] = "Where ansible-runner writes its files. Defaults to /dev/shm/ansible-runner (tmpfs) when available."
+        integration['configuration'].append(config)
+
+        config = {}
+        config['display'] = "Max Kept Artifacts"
+        config['name'] = "artifact_max_count"
+        config['type'] = 0
+        config['required'] = False
+        config['defaultvalue'] = "20"
+        config['additionalinfo'] = "When artifacts are kept, the number of most recent command runs to keep."
+        integration['configuration'].append(config)
+
+        config = {}
+        config['display'] = "Max Artifact Age (hours)"
+        config['name'] = "artifact_max_age"
+        config['type'] = 0
+        config['required'] = False
+        config['additionalinfo'] = "When artifacts are kept, remove the artifacts of command runs older than this."
+        integration['configuration'].append(config)
+
+        config = {}
+        config['display'] = "Max Artifact Size (MB)"
+        config['name'] = "artifact_max_size"
+        config['type'] = 0
+        config['required'] = False
+        config['additionalinfo'] = "When artifacts are kept, remove the oldest artifacts once their total size goes over this."
+        integration['configuration'].append(config)
         
         commands = []
+        argument_schemas = {}
         command_examples = []
         for ansible_module in integration_def.get('ansible_modules'):
             print("Adding Module: %s" % ansible_module)
@@ -110,11 +225,29 @@ with open(DEFINITION_FILE) as f:
             # Arguments
             options = doc.get('options')
 
+            # Compact argument schema of every module option, used by AnsibleApiModule to validate and coerce args before running the module
+            argument_schema = {}
+            for arg, option in (options or {}).items():
+                option = option or {}
+                option_schema = {}
+                if option.get('type') not in (None, 'str'):
+                    option_schema['type'] = str(option.get('type'))
+                if option.get('elements') is not None:
+                    option_schema['elements'] = str(option.get('elements'))
+                if option.get('required') == True:
+                    option_schema['required'] = True
+                if option.get('choices') is not None:
+                    option_schema['choices'] = [str(choice) for choice in option.get('choices')]
+                if option.get('aliases'):
+                    option_schema['aliases'] = [str(alias) for alias in option.get('aliases')]
+                argument_schema[str(arg)] = option_schema
+            argument_schemas[ansible_module] = argument_schema
+
             # Add static arguments if integration uses host based targets
             if integration_def.get('hostbasedtarget'):
                 argument = {}
                 argument['name'] = "host"
-                argument['description'] = "hostname or IP of target. Optionally the port can be specified using :PORT. If multiple targets are specified using an array, the integration will use the configured concurrency factor for high performance."
+                argument['description'] = "hostname or IP of target. Optionally the port can be specified using :PORT. Ranges such as web[01:10].example.com and CIDR blocks such as 10.0.0.0/24 are expanded to the hosts they contain. If multiple targets are specified using an array, the integration will use the configured concurrency factor for high performance."
                 argument['required'] = True
                 argument['isArray'] = True
                 command['arguments'].append(argument)
@@ -178,10 +311,80 @@ with open(DEFINITION_FILE) as f:
 
                     command['arguments'].append(argument)
 
+            # Add static arguments to run the module as a background job. network_cli modules can't be run in the background
+            if integration_def.get('hostbasedtarget') not in ("nxos", "ios"):
+                argument = {}
+                argument['name'] = "async"
+                argument['description'] = "If Yes, the module is started in the background and a job ID is returned straight away. Use the job-status command to get the results."
+                argument['defaultValue'] = "No"
+                argument['predefined'] = ['Yes', 'No']
+                argument['auto'] = "PREDEFINED"
+                command['arguments'].append(argument)
+
+                argument = {}
+                argument['name'] = "async_timeout"
+                argument['description'] = "The maximum runtime in seconds of a background job. Only used if async is Yes."
+                argument['defaultValue'] = "3600"
+                command['arguments'].append(argument)
+
+            argument = {}
+            argument['name'] = "timing"
+            argument['description'] = "If Yes, the duration of each stage of the command and of each host is also returned under the Timing context key."
+            argument['defaultValue'] = "No"
+            argument['predefined'] = ['Yes', 'No']
+            argument['auto'] = "PREDEFINED"
+            command['arguments'].append(argument)
+
+            argument = {}
+            argument['name'] = "delta"
+            argument['description'] = "If Yes, only the hosts and fields that changed since the last run with the same arguments are returned. Each returned host has a delta field of new or changed. Only the hosts of the run are compared, so running on some of the hosts doesn't affect the others. Hosts that are no longer run are not reported as removed. The last results of arguments not run for 30 days are forgotten."
+            argument['defaultValue'] = "No"
+            argument['predefined'] = ['Yes', 'No']
+            argument['auto'] = "PREDEFINED"
+            command['arguments'].append(argument)
+
+            argument = {}
+            argument['name'] = "host_timeout"
+            argument['description'] = "The maximum seconds the module can run on each host. Hosts that take longer are reported with the status TIMEOUT. Modules whose action plugin can't run async, such as copy, template and fetch, can't use it, use deadline instead."
+            command['arguments'].append(argument)
+
+            argument = {}
+            argument['name'] = "deadline"
+            argument['description'] = "The maximum seconds of the whole command. Set it below the XSOAR command timeout. Close to the deadline the run is stopped, and the results that are already in are returned along with the hosts that timed out."
+            command['arguments'].append(argument)
+
+            if integration_def.get('hostbasedtarget'):
+                argument = {}
+                argument['name'] = "precheck"
+                argument['description'] = "If Yes, hosts are first checked to accept a TCP connection on their port. Hosts that don't are reported as UNREACHABLE and skipped, rather than holding up the run until the connection times out."
+                argument['defaultValue'] = "No"
+                argument['predefined'] = ['Yes', 'No']
+                argument['auto'] = "PREDEFINED"
+                command['arguments'].append(argument)
+
+                argument = {}
+                argument['name'] = "precheck_timeout"
+                argument['description'] = "Seconds to wait for the TCP connection of the precheck."
+                argument['defaultValue'] = "2"
+                command['arguments'].append(argument)
+
+            # Add static arguments to page the results of modules that return lists, unless the module has its own
+            returndocs_dict = yaml.load(returndocs, Loader=yaml.Loader) if returndocs is not None else None
+            returns_list = any((details or {}).get('type') == 'list' for details in (returndocs_dict or {}).values())
+            if returns_list and not set(['limit', 'cursor']) & set(options or {}):
+                argument = {}
+                argument['name'] = "limit"
+                argument['description'] = "The maximum number of list items to return, a positive number. The rest are kept for 10 minutes in the container that ran the command, use the returned cursor to get the next page. Cursors can't be used in other containers, such as on another engine."
+                command['arguments'].append(argument)
+
+                argument = {}
+                argument['name'] = "cursor"
+                argument['description'] = "The cursor of the next page, returned by the previous page. The next page is returned without running the module again."
+                command['arguments'].append(argument)
+
             # Outputs
             command['outputs'] = []
             if returndocs is not None:
-                returndocs_dict = yaml.load(returndocs, Loader=yaml.Loader)
                 if returndocs_dict is not None:
                     for output, details in returndocs_dict.items():
                         output_to_add = {}
@@ -218,6 +421,21 @@ with open(DEFINITION_FILE) as f:
                                 output_to_add['type'] = "unknown"  
                             command['outputs'].append(output_to_add)                
 
+            command['outputs'].extend([
+                {'contextPath': "%s.Timing.run_id" % name.lower(), 'description': "ID of the timed command run. Only returned if timing is Yes.", 'type': "string"},
+                {'contextPath': "%s.Timing.module" % name.lower(), 'description': "The Ansible module that was timed. Only returned if timing is Yes.", 'type': "string"},
+                {'contextPath': "%s.Timing.total" % name.lower(), 'description': "Total command duration in milliseconds.", 'type': "number"},
+                {'contextPath': "%s.Timing.stages" % name.lower(), 'description': "Duration in milliseconds of each stage, eg inventory, runner, connect, execute, parse, markdown.", 'type': "unknown"},
+                {'contextPath': "%s.Timing.hosts" % name.lower(), 'description': "Duration in milliseconds of each host, and for network devices the time taken to connect to it.", 'type': "unknown"}
+            ])
+            if returns_list and not set(['limit', 'cursor']) & set(options or {}):
+                command['outputs'].extend([
+                    {'contextPath': "%s.Page.module" % name.lower(), 'description': "The Ansible module that was paged. Only returned if limit or cursor is set.", 'type': "string"},
+                    {'contextPath': "%s.Page.offset" % name.lower(), 'description': "The number of list items before this page.", 'type': "number"},
+                    {'contextPath': "%s.Page.total" % name.lower(), 'description': "The total number of list items.", 'type': "number"},
+                    {'contextPath': "%s.Page.next_cursor" % name.lower(), 'description': "The cursor of the next page, empty on the last page.", 'type': "string"}
+                ])
+
             commands.append(command)
 
             # Create example XSOAR command
@@ -246,12 +464,32 @@ with open(DEFINITION_FILE) as f:
 
                 command_examples.append(example_command + "\n")
 
+        # Add the command used to poll modules started as background jobs
+        if integration_def.get('hostbasedtarget') not in ("nxos", "ios"):
+            command = {}
+            command['name'] = command_prefix + '-job-status'
+            command['description'] = "Get the status of a module started with async=Yes. Once the job has finished on all hosts the module results are returned."
+            command['polling'] = True
+            command['arguments'] = [
+                {'name': "job_id", 'description': "The job ID returned when the module was started.", 'required': True},
+                {'name': "polling", 'description': "If Yes, the command will be rerun until the job has finished.", 'defaultValue': "No", 'predefined': ['Yes', 'No'], 'auto': "PREDEFINED"},
+                {'name': "interval_in_seconds", 'description': "How often to check the job status when polling.", 'defaultValue': "30"},
+                {'name': "timeout_in_seconds", 'description': "How long to keep polling before giving up.", 'defaultValue': "600"}
+            ]
+            command['outputs'] = [
+                {'contextPath': "%s.job.job_id" % name.lower(), 'description': "The job ID.", 'type': "string"},
+                {'contextPath': "%s.job.module" % name.lower(), 'description': "The Ansible module run by the job.", 'type': "string"},
+                {'contextPath': "%s.job.status" % name.lower(), 'description': "The job status, running or finished.", 'type': "string"},
+                {'contextPath': "%s.job.hosts" % name.lower(), 'description': "The hosts the job is running on.", 'type': "unknown"},
+                {'contextPath': "%s.job.pending_hosts" % name.lower(), 'description': "The hosts the job has not finished on yet.", 'type': "unknown"}
+            ]
+            commands.append(command)
+
 
 
         
         # Generate python script
         integration_script = '''import traceback
-import ssh_agent_setup
 import demistomock as demisto  # noqa: F401
 from CommonServerPython import *  # noqa: F401
 
@@ -264,6 +502,8 @@ from AnsibleApiModule import *  # noqa: E402
             integration_script +="host_type = '%s'" % integration_def.get('hostbasedtarget')
         else:
             integration_script +="host_type = 'local'"
+
+        integration_script += "\n\n# Argument schemas of the Ansible modules\nargument_schemas = %s" % pprint.pformat(argument_schemas, width=120)
         
         integration_script += '''
 
@@ -277,14 +517,16 @@ def main() -> None:
     :rtype:
     """
 
-    # SSH Key integration requires ssh_agent to be running in the background
-    ssh_agent_setup.setup()
+    # SSH keys are loaded into an ssh-agent of their own by AnsibleApiModule when a command needs them
 
     # Common Inputs
     command = demisto.command()
     args = demisto.args()
     int_params = demisto.params()
 
+    # Args are validated and coerced against the module argument schemas before anything is run
+    load_argument_schemas(argument_schemas)
+
     try:
 
         if command == 'test-module':
@@ -323,6 +565,9 @@ def main() -> None:
 
             integration_script += "\n        elif command == '%s':\n            return_results(generic_ansible('%s', '%s', args, int_params, host_type))" % (demisto_command, name.lower(), ansible_module,)
 
+        if integration_def.get('hostbasedtarget') not in ("nxos", "ios"):
+            integration_script += "\n        elif command == '%s-job-status':\n            return_results(generic_ansible_job_status('%s', args, int_params, host_type))" % (command_prefix, name.lower())
+
         integration_script += '''
     # Log exceptions and return errors
     except Exception as e:
@@ -1,8 +1,147 @@
 from CommonServerPython import *  # noqa: F403
 from CommonServerUserPython import *  # noqa: F403
 import ansible_runner  # pylint: disable=E0401
+import asyncio
+import concurrent.futures
+import errno
+import fcntl
+import functools
+import hashlib
+import io
+import ipaddress
 import json
-from typing import Dict, cast, List, Union, Any
+import os
+import random
+import re
+import runpy
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+import weakref
+from contextlib import contextmanager, redirect_stdout
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from typing import Dict, cast, List, Union, Any, Iterator, Tuple, Optional, FrozenSet, Set, Callable, Awaitable
+
+# Command args that configure how the module is run, rather than being passed to the module
+CONTROL_ARGS = ['host', 'async', 'async_timeout', 'timing', 'delta', 'precheck', 'precheck_timeout', 'host_timeout',
+                'deadline', 'limit', 'cursor']
+
+# ansible-runner events that hold the result of a host
+HOST_RESULT_EVENTS = ["runner_on_ok", "runner_on_unreachable", "runner_on_failed"]
+EVENT_STATUS = {'runner_on_ok': 'SUCCESS', 'runner_on_unreachable': 'UNREACHABLE!', 'runner_on_failed': 'FAILED!'}
+# Result keys left out of the output, the same as Ansible does when it displays a result
+RESULT_INTERNAL_KEYS = ['invocation', 'diff', 'exception']
+
+# Integration params that configure the integration, rather than being passed to local modules
+CONTROL_PARAMS = ['keep_artifacts', 'artifact_dir', 'artifact_max_count', 'artifact_max_age', 'artifact_max_size',
+                  'connect_timeout', 'command_timeout', 'persistent_control_path_dir', 'in_process', 'rate_limit',
+                  'rate_limit_burst', 'rate_limit_retries', 'rate_limit_backoff']
+
+# Upper bound on the hosts of a command, so a pattern such as 10.0.0.0/8 fails instead of filling memory
+MAX_INVENTORY_HOSTS = 65536
+
+# ansible-runner private data dirs
+PRIVATE_DATA_DIR_PREFIX = 'ansible-'
+DEFAULT_ARTIFACT_MAX_COUNT = 20
+
+# ssh-agents shared by the commands run in a container, one for each key, named by the hash of the key
+SSH_AGENT_SOCKET = 'ansible-ssh-agent-%s.sock'
+SSH_AGENT_STATE = 'ansible-ssh-agent-%s.json'
+# Seconds a key stays loaded, so keys removed or rotated in the credential manager don't stay in the agent
+SSH_KEY_LIFETIME = 3600
+
+# Persistent network_cli connections, the inventory vars and Ansible settings of their timeout params
+PERSISTENT_CONNECTION_VARS = {'connect_timeout': 'ansible_timeout'}
+PERSISTENT_CONNECTION_SETTINGS = {'command_timeout': 'ANSIBLE_PERSISTENT_COMMAND_TIMEOUT'}
+CONNECT_TASK_NAME = 'connect'
+# With timing, network devices are connected to in a task of their own running these modules, so the connect time of
+# the persistent connection is reported. ssh and winrm connect again for each task, and ping needs Python on the host,
+# so their connect time is left in the module run
+CONNECT_TASKS: Dict[str, Dict[str, Any]] = {
+    'ios': {'cli_command': {'command': 'show clock'}},
+    'nxos': {'cli_command': {'command': 'show clock'}}
+}
+
+# Reachability pre-check, the ports probed when the inventory doesn't set one
+DEFAULT_PRECHECK_TIMEOUT = 2.0
+CONNECTION_PORTS = {'ssh': 22, 'network_cli': 22, 'winrm': 5986}
+PRECHECK_STATUS = 'UNREACHABLE'
+# Probes open at once, so large inventories don't run out of file descriptors
+PRECHECK_CONCURRENCY = 100
+# Connection errors that mean the host is down or can't be reached. Other errors, such as running out of
+# file descriptors, say nothing about the host, so it is left to Ansible
+DEAD_HOST_ERRNOS = {errno.ECONNREFUSED, errno.ETIMEDOUT, errno.ENETUNREACH, errno.EHOSTUNREACH, errno.EHOSTDOWN}
+
+# Time limits. Part of the deadline is kept back to return the results that are already in
+DEADLINE_MARGIN = 5.0
+TIMEOUT_STATUS = 'TIMEOUT'
+TIMEOUT_MESSAGES = ['async task did not complete within the requested time', 'command timeout triggered']
+# Action plugins that can run their module async. The other action plugins, such as copy, template and fetch, fail
+# async tasks, so host_timeout and async can't be used with them
+ASYNC_ACTION_PLUGINS = frozenset(['command', 'shell', 'normal', 'package', 'service', 'uri', 'reboot', 'yum', 'aws_s3',
+                                  'win_updates'])
+
+# Statuses of hosts that have no module result, as they were not run or did not finish
+INCOMPLETE_STATUSES = [PRECHECK_STATUS, TIMEOUT_STATUS]
+
+# Delta mode, digests of the last results of each module run
+DELTA_CONTEXT_KEY = 'ansible_delta'
+DELTA_FIELD_DIGEST_SIZE = 4
+DELTA_HOST_DIGEST_SIZE = 8
+# The digests of args not run for DELTA_KEY_TTL seconds are dropped, as are those of the least recently run args
+# past MAX_DELTA_KEYS. When they were last run is only updated once a day, so unchanged runs don't write the context
+DELTA_KEY_TTL = 30 * 24 * 3600
+MAX_DELTA_KEYS = 100
+DELTA_USED_INTERVAL = 24 * 3600
+
+# Versioned integration context writes, retried when another command wrote first
+CONTEXT_UPDATE_RETRIES = 5
+
+# Client side rate limiting, a token bucket shared by the commands of an integration instance
+RATE_LIMIT_CONTEXT_KEY = 'ansible_rate_limit'
+DEFAULT_RATE_LIMIT_BACKOFF = 2.0
+MAX_RATE_LIMIT_BACKOFF = 60.0
+# Failures of the cloud provider throttling us. Besides an HTTP status of 429, the error codes and messages providers
+# throttle with, eg TooManyRequests (Azure), RequestLimitExceeded and ThrottlingException (AWS), rateLimitExceeded
+# (Google) and rate_limit_exceeded (Hetzner). Only whole codes and phrases, so unrelated errors mentioning 429 or a
+# rate limit setting are not retried
+RATE_LIMIT_PATTERN = re.compile(r'\b(?:too ?many ?requests(?:exception)?|request ?limit ?exceeded|throttling(?:exception)?|'
+                                r'slow ?down|(?:user)?rate[ _]?limit[ _]?exceeded)\b', re.IGNORECASE)
+
+# Pagination of large results, the result sets still to be paged are cached for a while. The results are kept in
+# files local to the container, and the integration context only holds an index of them, so cursors only work in the
+# container that ran the command. The dir name must not start with PRIVATE_DATA_DIR_PREFIX, or rotate_artifacts
+# would remove it
+PAGINATION_ARGS = ['limit', 'cursor']
+PAGES_CONTEXT_KEY = 'ansible_pages'
+PAGES_DIR = 'page-cache'
+PAGE_CACHE_TTL = 600
+MAX_CACHED_RESULT_SETS = 10
+MAX_PAGE_CACHE_BYTES = 64 * 1024 * 1024
+
+# Background (async) jobs
+ASYNC_JOBS_CONTEXT_KEY = 'ansible_jobs'
+DEFAULT_ASYNC_TIMEOUT = 3600
+ASYNC_STATUS_KEYS = ['ansible_job_id', 'started', 'finished', 'results_file']
+
+# Argument schemas of the modules, emitted by the integration generator and loaded with load_argument_schemas
+ARGUMENT_SCHEMAS: Dict[str, Dict[str, Dict[str, Any]]] = {}
+# The strings Ansible accepts as booleans, see ansible.module_utils.parsing.convert_bool
+BOOLEANS_TRUE = frozenset(('y', 'yes', 'on', '1', 'true', 't'))
+BOOLEANS_FALSE = frozenset(('n', 'no', 'off', '0', 'false', 'f'))
+
+# Process wide limit on concurrent runs started by generic_ansible_async
+MAX_CONCURRENT_RUNS = 4
+RUN_SEMAPHORES: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]' = weakref.WeakKeyDictionary()
+
+# Modules run in process read their args from, and print their result to, process wide state, so one runs at a time
+IN_PROCESS_LOCK = threading.Lock()
 
 
 # Dict to Markdown Converter adapted from https://github.com/PolBaladas/torsimany/
@@ -110,6 +249,120 @@ def camelCase(st: str):
     return output[0].lower() + output[1:]
 
 
+def expand_host_pattern(host: str) -> Iterator[str]:
+    """Lazily expand a host argument entry into the individual hosts it describes.
+
+    Supported forms, each optionally followed by a :PORT suffix:
+    * plain hostname or IP -- yielded as is
+    * CIDR block, eg 10.0.0.0/30 or 2001:db8::/126 -- yields the usable host addresses of the network
+    * Ansible style range, eg web[01:03].example.com or 10.0.0.[1:20] -- numeric ranges
+      keep their zero padding, alphabetic ranges such as [a:c] are also supported
+    IPv6 addresses and networks only take a port in brackets, eg [2001:db8::1]:2222.
+    """
+    # Split off the port first, range brackets also contain a colon
+    host, port = split_host_port(host)
+
+    if host_pattern_size(host) > MAX_INVENTORY_HOSTS:
+        raise ValueError("Host pattern %s expands to %d hosts, more than the maximum of %d" % (
+            host, host_pattern_size(host), MAX_INVENTORY_HOSTS))
+
+    if '/' in host:
+        try:
+            network = ipaddress.ip_network(host, strict=False)
+        except ValueError:
+            network = None
+        if network is not None:
+            # /32 and /31 networks have no separate network/broadcast address to skip
+            addresses = network.hosts() if network.num_addresses > 2 else iter(network)
+            for address in addresses:
+                yield join_host_port(str(address), port)
+            return
+
+    match = re.search(r'\[([0-9a-zA-Z]+):([0-9a-zA-Z]+)\]', host)
+    if match is None:
+        yield join_host_port(host, port)
+        return
+
+    prefix, suffix = host[:match.start()], host[match.end():]
+    first, last = match.group(1), match.group(2)
+    if first.isdigit() and last.isdigit():
+        width = len(first) if first.startswith('0') else 0
+        values = (str(i).zfill(width) for i in range(int(first), int(last) + 1))
+    elif len(first) == 1 and len(last) == 1 and first.isalpha() and last.isalpha():
+        values = (chr(i) for i in range(ord(first), ord(last) + 1))
+    else:
+        raise ValueError("Invalid host range: %s" % host)
+
+    for value in values:
+        # The remainder could hold another range, eg rack[1:2]-node[1:4]
+        yield from expand_host_pattern(join_host_port(prefix + value + suffix, port))
+
+
+def split_host_port(host: str) -> Tuple[str, str]:
+    """Split a host into its address and port, '' if it has none.
+
+    IPv6 addresses hold colons of their own, so their port has to be given in brackets. An address
+    with more than one colon outside of brackets has no port.
+    """
+    match = re.fullmatch(r'\[([^\]]*:[^\]]*:[^\]]*)\](?::(\d+))?', host)
+    if match:
+        return match.group(1), match.group(2) or ''
+    if '[' not in host and host.count(':') > 1:
+        return host, ''
+    # Range brackets such as [1:3] also contain a colon, so only a trailing :PORT is a port
+    address, port = re.match(r'^(.+?)(?::(\d+))?$', host).groups()  # type: ignore[union-attr]
+    return address, port or ''
+
+
+def join_host_port(address: str, port: str) -> str:
+    if not port:
+        return address
+    return ('[%s]:%s' if ':' in address else '%s:%s') % (address, port)
+
+
+def host_pattern_size(host: str) -> int:
+    """The number of hosts a host pattern, without its port, expands to. Counted without expanding it."""
+    if '/' in host:
+        try:
+            network = ipaddress.ip_network(host, strict=False)
+            return network.num_addresses - 2 if network.num_addresses > 2 else network.num_addresses
+        except ValueError:
+            pass
+
+    size = 1
+    for first, last in re.findall(r'\[([0-9a-zA-Z]+):([0-9a-zA-Z]+)\]', host):
+        if first.isdigit() and last.isdigit():
+            size *= max(int(last) - int(first) + 1, 0)
+        elif len(first) == 1 and len(last) == 1:
+            size *= max(ord(last) - ord(first) + 1, 0)
+    return size
+
+
+def normalise_host(host: str, default_port: Any = None) -> Tuple[str, str]:
+    """The (address, port) of a host, normalised so the same host written differently compares equal.
+
+    Hostnames are lower cased without a trailing dot, IP addresses are in their canonical form, and a
+    port that is the same as the default port is left out.
+    """
+    address, port = split_host_port(host)
+    address = address.lower().rstrip('.')
+    try:
+        address = str(ipaddress.ip_address(address))
+    except ValueError:
+        pass
+    if str(port) == str(default_port or ''):
+        port = ''
+    return address, port
+
+
+@functools.lru_cache(maxsize=4096)
+def resolve_host(address: str) -> Optional[str]:
+    try:
+        return str(ipaddress.ip_address(socket.getaddrinfo(address, None)[0][4][0]))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
 def generate_ansible_inventory(args: Dict[str, Any], int_params: Dict[str, Any], host_type: str = "local"):
     host_types = ['ssh', 'winrm', 'nxos', 'ios', 'local']
     if host_type not in host_types:
@@ -128,95 +381,989 @@ def generate_ansible_inventory(args: Dict[str, Any], int_params: Dict[str, Any],
 
     # All other host types are remote
     elif host_type in ['ssh', 'winrm', 'nxos', 'ios']:
+        # Settings shared by every host are set once as group vars, rather than copied into each host
+        group_vars: Dict[str, Any] = {}
+        creds = int_params.get('creds', {})
+        credentials = creds.get('credentials') or {}
+
+        if int_params.get('port'):
+            group_vars['ansible_port'] = int_params.get('port')
+
+        # Common SSH based auth options
+        if host_type in ['ssh', 'nxos', 'ios']:
+            # SSH Key saved in credential manager selection
+            if credentials.get('sshkey'):
+                group_vars['ansible_user'] = credentials.get('user')
+                sshkey = credentials.get('sshkey')
+
+            # Password saved in credential manager selection
+            elif credentials.get('password'):
+                group_vars['ansible_user'] = credentials.get('user')
+                group_vars['ansible_password'] = credentials.get('password')
+
+            # username/password individually entered
+            else:
+                group_vars['ansible_user'] = creds.get('identifier')
+                group_vars['ansible_password'] = creds.get('password')
+
+            # ios and nxos specific
+            if host_type in ['ios', 'nxos']:
+                group_vars['ansible_connection'] = 'network_cli'
+                group_vars['ansible_network_os'] = host_type
+                group_vars['ansible_become'] = 'yes'
+                group_vars['ansible_become_method'] = 'enable'
+                for param, var in PERSISTENT_CONNECTION_VARS.items():
+                    if int_params.get(param):
+                        group_vars[var] = int(int_params[param])
+
+        # winrm
+        elif host_type == 'winrm':
+            # Only two credential options
+            # Password saved in credential manager selection
+            if credentials.get('password'):
+                group_vars['ansible_user'] = credentials.get('user')
+                group_vars['ansible_password'] = credentials.get('password')
+
+            # username/password individually entered
+            else:
+                group_vars['ansible_user'] = creds.get('identifier')
+                group_vars['ansible_password'] = creds.get('password')
+
+            group_vars['ansible_connection'] = "winrm"
+            group_vars['ansible_winrm_transport'] = "ntlm"
+            group_vars['ansible_winrm_server_cert_validation'] = "ignore"
+
+        inventory['all']['vars'] = group_vars
+
         hosts = args.get('host')
         if type(hosts) is str:
             # host arg could be csv
             hosts = [host.strip() for host in hosts.split(',')]  # type: ignore[union-attr]
 
-        for host in hosts:  # type: ignore[union-attr]
-            new_host = {}
-            new_host['ansible_host'] = host
+        seen: Dict[Tuple[str, str], str] = {}
+        for host_entry in hosts:  # type: ignore[union-attr]
+            if not host_entry:
+                continue
+            for host in expand_host_pattern(host_entry):
+                # Duplicate addresses are only added once, however they are written
+                host_key = normalise_host(host, group_vars.get('ansible_port'))
+                if host_key in seen:
+                    continue
+                seen[host_key] = host
+                if len(seen) > MAX_INVENTORY_HOSTS:
+                    raise ValueError("The hosts expand to more than the maximum of %d hosts" % MAX_INVENTORY_HOSTS)
+
+                # Host entries only hold the address, and the port if it overrides the default
+                address, port = split_host_port(host)
+                new_host = {'ansible_host': address}
+                if port:
+                    new_host['ansible_port'] = port
+
+                inventory['all']['hosts'][host] = new_host
+
+        remove_hostname_duplicates(inventory, seen)
 
-            if ":" in host:
-                address = host.split(':')
-                new_host['ansible_port'] = address[1]
-                new_host['ansible_host'] = address[0]
+    return inventory, sshkey
+
+
+def remove_hostname_duplicates(inventory: Dict[str, Any], seen: Dict[Tuple[str, str], str]):
+    """Remove the hosts given by name that are also given by IP address, so each host is only run once.
+
+    Names are only resolved if the hosts mix names and addresses.
+    """
+    addresses = set()
+    names = []
+    for (address, port), host in seen.items():
+        try:
+            ipaddress.ip_address(address)
+            addresses.add((address, port))
+        except ValueError:
+            names.append((address, port, host))
+    if not addresses or not names:
+        return
+
+    for address, port, host in names:
+        if (resolve_host(address), port) in addresses:
+            del inventory['all']['hosts'][host]
+
+
+def parse_host_results(events: Iterator[Dict[str, Any]]) -> List[Tuple[str, str, Any]]:
+    """Parse the ansible-runner events into a (host, status, result) entry for each successful host.
+
+    Hosts that hit their host_timeout get a TIMEOUT entry. Any other host that failed or was
+    unreachable raises a DemistoException, ending the command with an error.
+    """
+    host_results = []
+    for each_host_event in events:
+        # Troubleshooting
+        # demisto.log("%s: %s\n" % (each_host_event['event'], each_host_event))
+        if each_host_event['event'] in HOST_RESULT_EVENTS:
+
+            # parse results
+
+            # The connect task only opens the connection, a failure to connect is still an error
+            if each_host_event.get('event_data', {}).get('task') == CONNECT_TASK_NAME and \
+                    each_host_event['event'] == 'runner_on_ok':
+                continue
+
+            host = event_host(each_host_event)
+            if 'res' in each_host_event.get('event_data', {}):
+                # Playbook runs hold the result in the event data
+                result = {key: value for key, value in each_host_event['event_data']['res'].items()
+                          if not key.startswith('_ansible') and key not in RESULT_INTERNAL_KEYS}
+                status = EVENT_STATUS[each_host_event['event']]
+                if status == 'SUCCESS' and result.get('changed'):
+                    status = 'CHANGED'
             else:
-                new_host['ansible_host'] = host
-                if int_params.get('port'):
-                    new_host['ansible_port'] = int_params.get('port')
+                # Ad-hoc runs only have the result in the stdout
+                result = json.loads('{' + each_host_event['stdout'].split('{', 1)[1])
+                status = each_host_event['stdout'].replace('=>', '|').split('|', 3)[1]
+
+            if each_host_event['event'] == "runner_on_ok":
+                host_results.append((host, status, result))
 
-            # Common SSH based auth options
-            if host_type in ['ssh', 'nxos', 'ios']:
-                # SSH Key saved in credential manager selection
-                if int_params.get('creds', {}).get('credentials').get('sshkey'):
-                    username = int_params.get('creds', {}).get('credentials').get('user')
-                    sshkey = int_params.get('creds', {}).get('credentials').get('sshkey')
+            elif each_host_event['event'] == "runner_on_failed" and \
+                    any(str(result.get('msg', '')).startswith(message) for message in TIMEOUT_MESSAGES):
+                host_results.append((host, TIMEOUT_STATUS, {'timeout': True, 'msg': result.get('msg')}))
+                continue
 
-                    new_host['ansible_user'] = username
+            if each_host_event['event'] == "runner_on_unreachable":
+                msg = "Host %s unreachable\nError Details: %s" % (host, result.get('msg'))
 
-                # Password saved in credential manager selection
-                elif int_params.get('creds', {}).get('credentials').get('password'):
-                    username = int_params.get('creds', {}).get('credentials').get('user')
-                    password = int_params.get('creds', {}).get('credentials').get('password')
+            if each_host_event['event'] == "runner_on_failed":
+                msg = "Host %s failed running command\nError Details: %s" % (host, result.get('msg'))
 
-                    new_host['ansible_user'] = username
-                    new_host['ansible_password'] = password
+            if each_host_event['event'] in ["runner_on_failed", "runner_on_unreachable"]:
+                raise DemistoException(msg)
 
-                # username/password individually entered
-                else:
-                    username = int_params.get('creds', {}).get('identifier')
-                    password = int_params.get('creds', {}).get('password')
-
-                    new_host['ansible_user'] = username
-                    new_host['ansible_password'] = password
-
-                # ios specific
-                if host_type == 'ios':
-                    new_host['ansible_connection'] = 'network_cli'
-                    new_host['ansible_network_os'] = 'ios'
-                    new_host['ansible_become'] = 'yes'
-                    new_host['ansible_become_method'] = 'enable'
-                    inventory['all']['hosts'][host] = new_host
-
-                # nxos specific
-                elif host_type == 'nxos':
-                    new_host['ansible_connection'] = 'network_cli'
-                    new_host['ansible_network_os'] = 'nxos'
-                    new_host['ansible_become'] = 'yes'
-                    new_host['ansible_become_method'] = 'enable'
-                    inventory['all']['hosts'][host] = new_host
-
-            # winrm
-            elif host_type == 'winrm':
-                # Only two credential options
-                # Password saved in credential manager selection
-                if int_params.get('creds', {}).get('credentials').get('password'):
-                    username = int_params.get('creds', {}).get('credentials').get('user')
-                    password = int_params.get('creds', {}).get('credentials').get('password')
-
-                    new_host['ansible_user'] = username
-                    new_host['ansible_password'] = password
-
-                # username/password individually entered
-                else:
-                    username = int_params.get('creds', {}).get('identifier')
-                    password = int_params.get('creds', {}).get('password')
+    return host_results
 
-                    new_host['ansible_user'] = username
-                    new_host['ansible_password'] = password
 
-                new_host['ansible_connection'] = "winrm"
-                new_host['ansible_winrm_transport'] = "ntlm"
-                new_host['ansible_winrm_server_cert_validation'] = "ignore"
+def event_host(event: Dict[str, Any]) -> str:
+    if event.get('event_data', {}).get('host'):
+        return event['event_data']['host']
+    return event['stdout'].split('|', 1)[0].strip()
 
-            inventory['all']['hosts'][host] = new_host
 
-    return inventory, sshkey
+def normalise_host_result(command: str, result: Dict[str, Any], timer: 'CommandTimer') -> Any:
+    """Pick the output of a module out of its host result, and strip the ansible_ key prefixes."""
+    if 'fact' in command:
+        result = result['ansible_facts']
+    else:
+        if result.get(command) is not None:
+            result = result[command]
+        else:
+            result.pop("ansible_facts", None)
+
+    with timer.span('normalise'):
+        return rec_ansible_key_strip(result)
+
+
+def build_command_results(integration_name: str, command: str, host_results: List[Tuple[str, str, Any]],
+                          timer: Optional['CommandTimer'] = None, delta_key: Optional[str] = None,
+                          limit: int = 0) -> Union[CommandResults, List[CommandResults]]:
+    """Convert the successful host results of a module run into context and readable output.
+
+    If delta_key is given, only the hosts and fields that changed since the last run with the same
+    delta_key are output, see compute_delta. If limit is given, only the first page of limit entries
+    is output, along with the cursor of the next page, see cache_pages.
+    """
+    timer = timer or CommandTimer()
+    readable_output = ""
+    host_results = [(host, status, result if status in INCOMPLETE_STATUSES else normalise_host_result(command, result, timer))
+                    for host, status, result in host_results]
+    if delta_key is not None:
+        with timer.span('delta'):
+            host_results, readable_output = compute_delta(delta_key, host_results)
+
+    if timer.stages.get('throttled') or timer.rate_limit_retries:
+        readable_output += "Throttled for %.1f seconds, with %d retries after being rate limited\n" % (
+            timer.stages.get('throttled', 0) / 1000, timer.rate_limit_retries)
+
+    if not limit:
+        return render_command_results(integration_name, command, host_results, timer, readable_output)
+
+    with timer.span('paginate'):
+        host_results, page = cache_pages(command, host_results, limit)
+    return [
+        render_command_results(integration_name, command, host_results, timer, readable_output),
+        page_command_results(integration_name, page)
+    ]
+
+
+def render_command_results(integration_name: str, command: str, host_results: List[Tuple[str, str, Any]],
+                           timer: 'CommandTimer', readable_output: str = "") -> CommandResults:
+    """Output normalised host results as context and readable output, following readable_output."""
+    results = []
+    outputs_key_field = ''
+    timed_out = [host for host, status, _ in host_results if status == TIMEOUT_STATUS]
+    if timed_out:
+        readable_output += "Timed out hosts: %s\n" % ", ".join(timed_out)
+
+    for host, status, result in host_results:
+        if host != "localhost":
+            readable_output += "# %s - %s\n" % (host, status)
+        else:
+            # This is integration is not host based
+            readable_output += "# %s\n" % status
+
+        with timer.span('markdown'):
+            readable_output += dict2md(result)
+
+        # add host and status to result if it is a dict. Some ansible modules return a list
+        if (type(result) == dict) and (host != 'localhost'):
+            result['host'] = host
+            outputs_key_field = 'host'  # updates previous outputs that share this key, neat!
+
+        if (type(result) == dict):
+            result['status'] = status.strip()
+
+        results.append(result)
+
+    return CommandResults(
+        readable_output=readable_output,
+        outputs_prefix=integration_name + '.' + camelCase(command),
+        outputs_key_field=outputs_key_field,
+        outputs=results
+    )
+
+
+def value_digest(value: Any, size: int = DELTA_FIELD_DIGEST_SIZE) -> str:
+    return hashlib.blake2b(json.dumps(value, sort_keys=True, default=str).encode(), digest_size=size).hexdigest()
+
+
+def result_digests(result: Any) -> Dict[str, str]:
+    """The digest of each top level field of a host result."""
+    if isinstance(result, dict):
+        return {str(key): value_digest(value) for key, value in result.items()}
+    return {'': value_digest(result)}  # Some modules return a list, which is compared as a whole
+
+
+def pack_digests(host_digest: str, field_digests: Dict[str, str], fields: List[str]) -> str:
+    """Pack the digests of a host into one string, the host digest followed by the digest of each of fields.
+
+    The field names are stored once for all hosts, rather than with each host. Fields the host
+    doesn't have are filled with dashes.
+    """
+    absent = '-' * DELTA_FIELD_DIGEST_SIZE * 2
+    return host_digest + ''.join(field_digests.get(field, absent) for field in fields)
+
+
+def unpack_field_digests(packed: str, fields: List[str]) -> Dict[str, str]:
+    size = DELTA_FIELD_DIGEST_SIZE * 2
+    start = DELTA_HOST_DIGEST_SIZE * 2
+    field_digests = {}
+    for index, field in enumerate(fields):
+        # Fields added to the names after the host was packed are past the end of its string
+        digest = packed[start + index * size:start + (index + 1) * size]
+        if digest and digest != '-' * size:
+            field_digests[field] = digest
+    return field_digests
+
+
+def compute_delta(delta_key: str, host_results: List[Tuple[str, str, Any]]) -> Tuple[List[Tuple[str, str, Any]], str]:
+    """Compare normalised host results to the digests stored by the last runs with the same delta_key.
+
+    Returns the host results to output, with a summary for the readable output. New hosts are
+    output in full, and changed hosts only with their new or changed fields and the names of their
+    removed fields. Unchanged hosts are left out. Only the hosts of this run are compared and have
+    their digests updated, so running on a subset of the hosts doesn't affect the others.
+
+    Each host is stored as one string of digests, see pack_digests. The field digests are only
+    compared when the digest of the whole host result changed. Hosts that are no longer run are
+    not reported as removed, their digests are kept until the delta_key is dropped, see
+    prune_delta_keys.
+    """
+    def update(integration_context: Dict[str, Any]) -> Tuple[List[Tuple[str, str, Any]], Dict[str, int]]:
+        all_digests = integration_context.setdefault(DELTA_CONTEXT_KEY, {})
+        state = all_digests.setdefault(delta_key, {'fields': [], 'hosts': {}})
+        now = int(time.time())
+        if now - state.get('used', 0) >= DELTA_USED_INTERVAL:
+            state['used'] = now
+        prune_delta_keys(all_digests, now)
+        fields = state['fields']
+        known_fields = set(fields)
+        delta_results = []
+        counts = {'new': 0, 'changed': 0, 'unchanged': 0}
+
+        for host, status, result in host_results:
+            # Hosts without a result are output as is, and compared to their last result next time
+            if status in INCOMPLETE_STATUSES:
+                delta_results.append((host, status, result))
+                continue
+
+            host_digest = value_digest(result, DELTA_HOST_DIGEST_SIZE)
+            last_packed = state['hosts'].get(host)
+            if last_packed is not None and last_packed.startswith(host_digest):
+                counts['unchanged'] += 1
+                continue
+
+            field_digests = result_digests(result)
+            for field in field_digests:
+                if field not in known_fields:
+                    fields.append(field)
+                    known_fields.add(field)
+            state['hosts'][host] = pack_digests(host_digest, field_digests, fields)
+
+            if last_packed is None:
+                change = 'new'
+            else:
+                change = 'changed'
+                if isinstance(result, dict):
+                    last_fields = unpack_field_digests(last_packed, fields)
+                    removed_fields = [field for field in last_fields if field not in field_digests]
+                    result = {key: value for key, value in result.items()
+                              if last_fields.get(str(key)) != field_digests[str(key)]}
+                    if removed_fields:
+                        result['removed_fields'] = removed_fields
+
+            counts[change] += 1
+            if isinstance(result, dict):
+                result['delta'] = change
+            delta_results.append((host, status, result))
+        return delta_results, counts
+
+    delta_results, counts = update_context_with_retries(update)
+    summary = "Delta since the last run: %d new, %d changed, %d unchanged\n" % (
+        counts['new'], counts['changed'], counts['unchanged'])
+    return delta_results, summary
+
+
+def prune_delta_keys(all_digests: Dict[str, Any], now: int):
+    """Drop the digests of delta keys not run for DELTA_KEY_TTL seconds, and of the least recently run past MAX_DELTA_KEYS."""
+    for key, state in list(all_digests.items()):
+        if now - state.get('used', 0) >= DELTA_KEY_TTL:
+            del all_digests[key]
+    for key in sorted(all_digests, key=lambda key: all_digests[key].get('used', 0))[:-MAX_DELTA_KEYS]:
+        del all_digests[key]
+
+
+def update_context_with_retries(update: Callable[[Dict[str, Any]], Any]) -> Any:
+    """Change the integration context with update, and return what update returns.
+
+    The context is written with the version it was read at, so a command doesn't overwrite the
+    keys other commands changed in the meantime. On a version conflict the context is read again
+    and update is run again, up to CONTEXT_UPDATE_RETRIES times. The context is only written if
+    update changed it.
+    """
+    for attempt in range(CONTEXT_UPDATE_RETRIES):
+        integration_context, version = get_integration_context_with_version()
+        original = json.dumps(integration_context, sort_keys=True, default=str)
+        value = update(integration_context)
+        if json.dumps(integration_context, sort_keys=True, default=str) == original:
+            return value
+        try:
+            set_integration_context(integration_context, version=version)
+            return value
+        except ValueError as e:
+            demisto.debug("Integration context changed by another command, retrying: %s" % e)
+            time.sleep(random.uniform(0, 0.1 * (attempt + 1)))
+    raise DemistoException("Unable to update the integration context, it is being changed by other commands")
+
+
+def paginated(command: str, args: Dict[str, Any]) -> bool:
+    """Whether the results of a command are paged. Modules with limit or cursor options of their own are never paged."""
+    options = schema_options(command) or frozenset()
+    return any(args.get(arg) for arg in PAGINATION_ARGS if arg not in options)
+
+
+def page_field(result: Any) -> Optional[str]:
+    """The field of a host result that is paged, its longest list. '' if the result is a list itself, None if it has no list."""
+    if isinstance(result, list):
+        return ''
+    if isinstance(result, dict):
+        list_fields = [(len(value), key) for key, value in result.items() if isinstance(value, list)]
+        if list_fields:
+            return max(list_fields, key=lambda list_field: list_field[0])[1]
+    return None
+
+
+def page_host_results(host_results: List[Tuple[str, str, Any]], fields: List[Optional[str]], offset: int,
+                      limit: int) -> Tuple[List[Tuple[str, str, Any]], int]:
+    """The host results of the page of limit entries starting at offset, and the total number of entries.
+
+    The entries are the items of the paged field of each host in turn, see page_field. A host with no
+    list, or an empty one, is a single entry. Hosts on a page are output with only the items of their
+    paged field that are on the page, along with their other fields.
+    """
+    page = []
+    position = 0
+    for (host, status, result), field in zip(host_results, fields):
+        items = None if field is None else (result if field == '' else result[field])
+        count = max(len(items), 1) if items is not None else 1
+        start, end = max(offset - position, 0), min(offset + limit - position, count)
+        position += count
+        if start >= end:
+            continue
+
+        if field is None:
+            page.append((host, status, dict(result) if isinstance(result, dict) else result))
+        elif field == '':
+            page.append((host, status, result[start:end]))
+        else:
+            page.append((host, status, {**result, field: result[field][start:end]}))
+    return page, position
+
+
+def page_limit(command: str, args: Dict[str, Any]) -> int:
+    """The limit arg of a paged command, 0 if the command isn't paged or has no limit. Raises ValueError if it isn't positive."""
+    if not paginated(command, args) or args.get('limit') in (None, ''):
+        return 0
+    try:
+        limit = int(args['limit'])
+    except ValueError:
+        limit = 0
+    if limit <= 0:
+        raise ValueError("limit must be a positive number, not %s" % args['limit'])
+    return limit
+
+
+def cache_pages(command: str, host_results: List[Tuple[str, str, Any]],
+                limit: int) -> Tuple[List[Tuple[str, str, Any]], Dict[str, Any]]:
+    """Split normalised host results into pages of limit entries, and return the first page with its page info.
+
+    If there is more than one page, the host results are written to a file in the page cache dir,
+    kept for PAGE_CACHE_TTL seconds, and indexed in the integration context with the container
+    that holds the file. The page info holds the cursor of the next page. Later pages are served
+    from the file with generic_ansible_page, without running the module again, as long as they are
+    requested in the same container.
+    """
+    fields = [page_field(result) for _, _, result in host_results]
+    page, total = page_host_results(host_results, fields, 0, limit)
+    page_info = {'module': command, 'offset': 0, 'limit': limit, 'total': total, 'next_cursor': None}
+    if total <= limit:
+        return page, page_info
+
+    cache_id = uuid.uuid4().hex
+    cache_dir = page_cache_dir()
+    # Written to a temp file first, so a page is never read from a partly written file
+    temp_path = os.path.join(cache_dir, '.%s.tmp' % cache_id)
+    with open(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w') as f:
+        json.dump({'fields': fields, 'host_results': host_results}, f, default=str)
+    os.replace(temp_path, os.path.join(cache_dir, cache_id + '.json'))
+
+    def add_result_set(integration_context: Dict[str, Any]) -> List[str]:
+        result_sets = live_result_sets(integration_context)
+        dropped = [key for key in integration_context.get(PAGES_CONTEXT_KEY, {}) if key not in result_sets]
+        # The oldest result sets are dropped first
+        while len(result_sets) >= MAX_CACHED_RESULT_SETS:
+            oldest = min(result_sets, key=lambda key: result_sets[key]['expires'])
+            del result_sets[oldest]
+            dropped.append(oldest)
+        result_sets[cache_id] = {'module': command, 'limit': limit, 'total': total, 'container': socket.gethostname(),
+                                 'expires': time.time() + PAGE_CACHE_TTL}
+        integration_context[PAGES_CONTEXT_KEY] = result_sets
+        return dropped
+
+    try:
+        dropped_ids = update_context_with_retries(add_result_set)
+    except DemistoException:
+        # Without an index entry no cursor can reach the file
+        remove_file(os.path.join(cache_dir, cache_id + '.json'))
+        raise
+    for dropped_id in dropped_ids:
+        remove_file(os.path.join(cache_dir, dropped_id + '.json'))
+    prune_page_cache(cache_dir, keep=cache_id + '.json')
+
+    page_info['next_cursor'] = '%s:%d' % (cache_id, limit)
+    return page, page_info
+
+
+def page_cache_dir() -> str:
+    # Shared by the integration instances of the container, each indexing its own files
+    cache_dir = os.path.join(default_artifact_dir(), PAGES_DIR)
+    # The files hold module results, so only this user can read them
+    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    return cache_dir
+
+
+def remove_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass  # removed by a concurrent prune
+
+
+def prune_page_cache(cache_dir: str, keep: str):
+    """Remove the files of the page cache older than PAGE_CACHE_TTL, then the oldest while over MAX_PAGE_CACHE_BYTES.
+
+    This also covers files the index of no integration instance refers to anymore. keep is never removed.
+    """
+    now = time.time()
+    files = []
+    for entry in os.scandir(cache_dir):
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        if entry.name != keep and now - stat.st_mtime > PAGE_CACHE_TTL:
+            remove_file(entry.path)
+        else:
+            files.append((stat.st_mtime, stat.st_size, entry))
+
+    total_size = sum(size for _, size, _ in files)
+    for _, size, entry in sorted(files, key=lambda file: file[0]):
+        if total_size <= MAX_PAGE_CACHE_BYTES:
+            break
+        if entry.name != keep:
+            remove_file(entry.path)
+            total_size -= size
+
+
+def live_result_sets(integration_context: Dict[str, Any]) -> Dict[str, Any]:
+    """The index entries of the cached result sets that have not expired."""
+    now = time.time()
+    return {cache_id: result_set for cache_id, result_set in integration_context.get(PAGES_CONTEXT_KEY, {}).items()
+            if result_set['expires'] > now}
+
+
+def page_command_results(integration_name: str, page_info: Dict[str, Any]) -> CommandResults:
+    first = min(page_info['offset'] + 1, page_info['total'])
+    last = min(page_info['offset'] + page_info['limit'], page_info['total'])
+    readable_output = "Showing %d-%d of %d. " % (first, last, page_info['total'])
+    if page_info['next_cursor']:
+        readable_output += "Run the command again with cursor=%s for the next page." % page_info['next_cursor']
+    else:
+        readable_output += "This is the last page."
+    return CommandResults(
+        readable_output=readable_output,
+        outputs_prefix=integration_name + '.Page',
+        outputs_key_field='module',
+        outputs=page_info
+    )
+
+
+def generic_ansible_page(integration_name: str, command: str, args: Dict[str, Any]) -> List[CommandResults]:
+    """Return a later page of a paged command from the cache, given the cursor returned by the previous page.
+
+    The page is limit entries long, defaulting to the limit of the first page. The cached results
+    are local to the container that ran the command, so the cursor fails in other containers. If
+    the file of the cursor is gone, its index entry is dropped too.
+    """
+    cache_id, _, offset = str(args['cursor']).partition(':')
+    result_set = live_result_sets(get_integration_context()).get(cache_id)
+    cached = None
+    if result_set is not None and result_set['module'] == command and offset.isdigit() and re.fullmatch(r'[0-9a-f]+', cache_id):
+        if result_set.get('container') != socket.gethostname():
+            raise DemistoException("The cursor %s is of results cached in another container, they can only be paged in the "
+                                   "container that ran the command. Run the command again without a cursor to start from "
+                                   "the first page." % args['cursor'])
+        try:
+            with open(os.path.join(page_cache_dir(), cache_id + '.json')) as f:
+                cached = json.load(f)
+        except FileNotFoundError:
+            # Pruned from the page cache, so the index entry can go too
+            update_context_with_retries(lambda integration_context: integration_context.get(PAGES_CONTEXT_KEY, {}).pop(
+                cache_id, None))
+    if cached is None:
+        raise DemistoException("The cursor %s has expired or is not a cursor of %s. Run the command again without a cursor to "
+                               "start from the first page." % (args['cursor'], command))
+
+    limit = page_limit(command, args) or result_set['limit']
+    host_results = [(host, status, result) for host, status, result in cached['host_results']]
+    page, total = page_host_results(host_results, cached['fields'], int(offset), limit)
+    page_info = {'module': command, 'offset': int(offset), 'limit': limit, 'total': total, 'next_cursor': None}
+    if int(offset) + limit < total:
+        page_info['next_cursor'] = '%s:%d' % (cache_id, int(offset) + limit)
+
+    timer = CommandTimer()
+    return [
+        render_command_results(integration_name, command, page, timer),
+        page_command_results(integration_name, page_info)
+    ]
+
+
+def delta_key(integration_name: str, command: str, args: Dict[str, Any]) -> str:
+    """Runs of a module with the same args, other than the hosts, share their delta digests.
+
+    Each run only compares and updates the digests of its own hosts.
+    """
+    module_args = {key: value for key, value in args.items() if key not in CONTROL_ARGS}
+    return '%s.%s.%s' % (integration_name, command, value_digest(module_args))
+
+
+def default_artifact_dir() -> str:
+    # Prefer tmpfs, so short lived runner files never touch the disk
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm/ansible-runner'
+    return os.path.join(tempfile.gettempdir(), 'ansible-runner')
+
+
+def create_private_data_dir(int_params: Dict[str, Any]) -> str:
+    """Create a new ansible-runner private data dir under the configured artifact directory."""
+    base_dir = int_params.get('artifact_dir') or default_artifact_dir()
+    os.makedirs(base_dir, exist_ok=True)
+    return tempfile.mkdtemp(prefix=PRIVATE_DATA_DIR_PREFIX, dir=base_dir)
+
+
+def cleanup_private_data_dir(private_data_dir: str, int_params: Dict[str, Any]):
+    """Remove a private data dir once its results have been parsed.
+
+    If the keep_artifacts param is set the dir is kept for debugging, and instead the kept dirs
+    are rotated according to the artifact_max_count, artifact_max_age (hours) and
+    artifact_max_size (MB) params.
+    """
+    if not argToBoolean(int_params.get('keep_artifacts', False)):
+        shutil.rmtree(private_data_dir, ignore_errors=True)
+        return
+
+    rotate_artifacts(os.path.dirname(private_data_dir),
+                     max_count=int(int_params.get('artifact_max_count') or DEFAULT_ARTIFACT_MAX_COUNT),
+                     max_age=float(int_params.get('artifact_max_age') or 0),
+                     max_size=float(int_params.get('artifact_max_size') or 0))
+
+
+def rotate_artifacts(base_dir: str, max_count: int = 0, max_age: float = 0, max_size: float = 0):
+    """Delete the oldest private data dirs in base_dir that go over any of the given limits.
+
+    A limit of 0 is not enforced. max_age is in hours and max_size is in MB.
+    """
+    private_data_dirs = []
+    for entry in os.scandir(base_dir):
+        if entry.is_dir() and entry.name.startswith(PRIVATE_DATA_DIR_PREFIX):
+            private_data_dirs.append((entry.stat().st_mtime, entry.path))
+
+    now = time.time()
+    total_size = 0
+    # Newest first, so the most recent runs are the ones that are kept
+    for index, (mtime, path) in enumerate(sorted(private_data_dirs, reverse=True)):
+        for root, _, file_names in os.walk(path):
+            for file_name in file_names:
+                try:
+                    total_size += os.path.getsize(os.path.join(root, file_name))
+                except OSError:
+                    pass  # removed by a concurrent rotation
+
+        if (max_count and index >= max_count) or (max_age and now - mtime > max_age * 3600) \
+                or (max_size and total_size > max_size * 1024 * 1024):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def ssh_agent_env(sshkey: str, state_dir: Optional[str] = None) -> Optional[Dict[str, str]]:
+    """Load sshkey into an ssh-agent of its own, and return the env vars that point at it.
+
+    Each key has its own agent, named by the hash of the key, so instances with different keys
+    can't use each other's keys, and ssh only has one identity to offer. The agent is started on
+    first use and outlives the command, so later commands with the same key in the container
+    reuse it. The key is loaded for SSH_KEY_LIFETIME seconds, and loaded again once the agent no
+    longer holds it. Returns None if the agent can't be used, in which case the key has to be
+    handed to ansible-runner instead.
+    """
+    state_dir = state_dir or tempfile.gettempdir()
+    # Keys pasted into the credential manager can differ in line endings and surrounding whitespace
+    sshkey = '\n'.join(line.strip() for line in sshkey.strip().splitlines()) + '\n'
+    key_id = hashlib.sha256(sshkey.encode()).hexdigest()[:16]
+    auth_sock = os.path.join(state_dir, SSH_AGENT_SOCKET % key_id)
+    env = dict(os.environ, SSH_AUTH_SOCK=auth_sock)
+
+    try:
+        with open(os.path.join(state_dir, SSH_AGENT_STATE % key_id), 'a+') as state_file:
+            # Commands can run concurrently in the same container, only one of them should start the agent
+            fcntl.flock(state_file, fcntl.LOCK_EX)
+            state_file.seek(0)
+            try:
+                state = json.loads(state_file.read() or '{}')
+            except ValueError:
+                state = {}
+
+            # ssh-add exits with 2 when it can't connect to the agent, and 1 when it holds no keys
+            agent_check = subprocess.run(['ssh-add', '-l'], env=env, stdout=subprocess.DEVNULL,
+                                         stderr=subprocess.DEVNULL)
+            if agent_check.returncode == 2:
+                if os.path.exists(auth_sock):
+                    os.remove(auth_sock)  # left behind by an agent that is no longer running
+                output = subprocess.run(['ssh-agent', '-s', '-a', auth_sock], check=True, stdout=subprocess.PIPE,
+                                        universal_newlines=True).stdout
+                agent_pid = re.search(r'SSH_AGENT_PID=(\d+)', output)
+                state = {'pid': int(agent_pid.group(1)) if agent_pid else None}
+                demisto.debug("Started ssh-agent on %s" % auth_sock)
+
+            # The agent only ever holds this key, so if it holds a key it is this one
+            if agent_check.returncode != 0:
+                subprocess.run(['ssh-add', '-t', str(SSH_KEY_LIFETIME), '-'], env=env, input=sshkey, check=True,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+                demisto.debug("Loaded SSH key %s into ssh-agent" % key_id)
+
+            state_file.seek(0)
+            state_file.truncate()
+            json.dump(state, state_file)
+    except (OSError, subprocess.SubprocessError) as e:
+        demisto.debug("Unable to use ssh-agent, passing the SSH key to ansible-runner instead: %s" % e)
+        return None
+
+    return {'SSH_AUTH_SOCK': auth_sock}
+
+
+def persistent_connection_env(int_params: Dict[str, Any]) -> Dict[str, str]:
+    """Ansible settings for the persistent network_cli connections of ios and nxos hosts.
+
+    The sockets are kept in a fixed dir that only this user can reach, and command_timeout is the
+    persistent command timeout. Ansible closes the connections when a run ends, so each command
+    logs in, and runs enable, once for all of its tasks.
+    """
+    control_path_dir = int_params.get('persistent_control_path_dir') or os.path.join(tempfile.gettempdir(), 'ansible-pc')
+    # The sockets give access to logged in sessions, so only this user can reach them
+    os.makedirs(control_path_dir, mode=0o700, exist_ok=True)
+    env = {'ANSIBLE_PERSISTENT_CONTROL_PATH_DIR': control_path_dir}
+    for param, setting in PERSISTENT_CONNECTION_SETTINGS.items():
+        if int_params.get(param):
+            env[setting] = str(int(int_params[param]))
+    return env
+
+
+def ssh_key_kwargs(sshkey: str) -> Dict[str, Any]:
+    """ansible_runner.run keyword arguments for authenticating with sshkey.
+
+    The ssh-agent of the key is used where possible, as when given ssh_key ansible-runner writes the key
+    into the private data dir and loads it into a new agent on every run.
+    """
+    if not sshkey:
+        return {}
+
+    envvars = ssh_agent_env(sshkey)
+    if envvars is None:
+        return {'ssh_key': sshkey}
+    return {'envvars': envvars}
+
 
+def load_argument_schemas(schemas: Dict[str, Dict[str, Dict[str, Any]]]):
+    """Load the argument schemas of the modules of an integration, as emitted by the integration generator.
 
-def generic_ansible(integration_name: str, command: str,
-                    args: Dict[str, Any], int_params: Dict[str, Any], host_type: str) -> CommandResults:
+    Each schema maps the module options to their "type" (default str), "elements" type of lists,
+    "required" flag, "choices" and "aliases". Module args are checked and coerced against the
+    schema before anything is run, see validate_module_args.
+    """
+    ARGUMENT_SCHEMAS.update(schemas)
+
+
+def schema_options(command: str) -> Optional[FrozenSet[str]]:
+    """The option names, including aliases, in the argument schema of a module. None if it has no schema."""
+    schema = ARGUMENT_SCHEMAS.get(command)
+    if schema is None:
+        return None
+    options = set(schema)
+    for option in schema.values():
+        options.update(option.get('aliases', []))
+    return frozenset(options)
+
+
+def coerce_bool(value: Any) -> bool:
+    """Convert a value to a bool the way Ansible's check_type_bool does."""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)) and value in (0, 1):
+        return bool(value)
+    if isinstance(value, str) and value.strip().lower() in BOOLEANS_TRUE | BOOLEANS_FALSE:
+        return value.strip().lower() in BOOLEANS_TRUE
+    raise ValueError("not one of %s" % ", ".join(sorted(BOOLEANS_TRUE | BOOLEANS_FALSE)))
+
+
+def coerce_dict(value: Any) -> Any:
+    """Convert a value to a dict the way Ansible's check_type_dict does, from JSON or the k1=v1, k2=v2 form.
+
+    Strings that start with { but aren't JSON are passed through, for Ansible to evaluate.
+    """
+    if isinstance(value, dict):
+        return value
+    if not isinstance(value, str):
+        raise ValueError("%s cannot be converted to a dict" % type(value).__name__)
+    if value.startswith('{'):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
+    if '=' not in value:
+        raise ValueError("could not parse JSON or key=value")
+
+    # Fields are separated by commas or spaces, outside of quotes. Quotes are dropped, and \ escapes a character
+    fields = []
+    field_buffer: List[str] = []
+    in_quote: Optional[str] = None
+    in_escape = False
+    for c in value.strip():
+        if in_escape:
+            field_buffer.append(c)
+            in_escape = False
+        elif c == '\\':
+            in_escape = True
+        elif not in_quote and c in ('\'', '"'):
+            in_quote = c
+        elif in_quote and in_quote == c:
+            in_quote = None
+        elif not in_quote and c in (',', ' '):
+            if field_buffer:
+                fields.append(''.join(field_buffer))
+            field_buffer = []
+        else:
+            field_buffer.append(c)
+    if field_buffer:
+        fields.append(''.join(field_buffer))
+    if not all('=' in field for field in fields):
+        raise ValueError("could not parse key=value")
+    return dict(field.split('=', 1) for field in fields)
+
+
+def coerce_value(name: str, value: Any, value_type: str) -> Any:
+    """Convert an XSOAR arg value, often a string, to the type of the module option.
+
+    Values are accepted the same as Ansible accepts them. Types that aren't checked here are passed through.
+    """
+    try:
+        if value_type == 'bool':
+            return coerce_bool(value)
+        if value_type == 'int':
+            return int(value)
+        if value_type == 'float':
+            return float(value)
+        if value_type == 'dict':
+            return coerce_dict(value)
+    except (TypeError, ValueError) as e:
+        raise ValueError("Invalid value for %s, expected %s: %s (%s)" % (name, value_type, value, e))
+    return value
+
+
+def validate_module_args(command: str, module_args: Dict[str, Any]) -> Dict[str, Any]:
+    """Check module args against the argument schema of the module, and coerce them to the option types.
+
+    Raises ValueError for missing required args, values not in the choices and values that don't
+    match their type, before anything is run. Args of modules without a schema are returned as is.
+    """
+    schema = ARGUMENT_SCHEMAS.get(command)
+    if schema is None:
+        return module_args
+
+    missing = [name for name, option in schema.items() if option.get('required')
+               and all(module_args.get(key) in (None, '') for key in [name] + option.get('aliases', []))]
+    if missing:
+        raise ValueError("Missing required arguments: %s" % ", ".join(missing))
+
+    # Args given under an alias are checked against the option the alias belongs to
+    canonical = {alias: option_name for option_name, option in schema.items() for alias in option.get('aliases', [])}
+    coerced = {}
+    for name, value in module_args.items():
+        option = schema.get(name) or schema.get(canonical.get(name, ''))
+        if option is None or value in (None, ''):
+            coerced[name] = value
+            continue
+
+        value_type = option.get('type', 'str')
+        if value_type == 'list':
+            items = argToList(value)
+            value = [coerce_value(name, item, option['elements']) for item in items] if option.get('elements') else items
+        else:
+            value = coerce_value(name, value, value_type)
+
+        if option.get('choices'):
+            choices = [str(choice) for choice in option['choices']]
+            for item in (value if isinstance(value, list) else [value]):
+                if str(item) not in choices:
+                    raise ValueError("Invalid value for %s: %s. Expected one of: %s" % (name, item, ", ".join(choices)))
+
+        coerced[name] = value
+    return coerced
+
+
+@functools.lru_cache(maxsize=None)
+def module_options(command: str) -> Optional[FrozenSet[str]]:
+    """The option names, including aliases, accepted by an Ansible module.
+
+    Read from the module documentation. None if the module or Ansible can't be found.
+    """
+    try:
+        from ansible.plugins.loader import fragment_loader, module_loader  # pylint: disable=E0401
+        from ansible.utils import plugin_docs  # pylint: disable=E0401
+    except ImportError:
+        return None
+
+    module_path = module_loader.find_plugin(command)
+    if module_path is None:
+        return None
+
+    doc = plugin_docs.get_docstring(module_path, fragment_loader)[0] or {}
+    options: Set[str] = set()
+    for option_name, option in (doc.get('options') or {}).items():
+        options.add(option_name)
+        options.update((option or {}).get('aliases') or [])
+    return frozenset(options)
+
+
+def escape_templating(value: Any) -> Any:
+    # Task args are templated by Ansible, so make sure jinja syntax in a value is passed through as is
+    if isinstance(value, str) and ('{{' in value or '{%' in value or '{#' in value):
+        return '{%% raw %%}%s{%% endraw %%}' % value
+    if isinstance(value, list):
+        return [escape_templating(item) for item in value]
+    if isinstance(value, dict):
+        return {key: escape_templating(item) for key, item in value.items()}
+    return value
+
+
+def build_module_args(args: Dict[str, Any], int_params: Dict[str, Any], host_type: str,
+                      command: Optional[str] = None, templated: bool = True) -> Dict[str, Any]:
+    """Build the module args, passed to Ansible as structured data rather than a key=value string.
+
+    If the module has an argument schema, the args are validated and coerced against it. Jinja
+    syntax in the values is escaped, unless templated is False as the args are not templated by
+    Ansible, eg when the module is run in process.
+    """
+    module_args = {}
+    # Modules with limit or cursor options of their own are passed them, rather than being paged
+    own_pagination_args = [arg for arg in PAGINATION_ARGS if command and arg in (schema_options(command) or ())]
+    # build module args list
+    for arg_key, arg_value in args.items():
+        # skip hardcoded args, as they don't relate to the module
+        if arg_key in CONTROL_ARGS and arg_key not in own_pagination_args:
+            continue
+
+        module_args[arg_key] = arg_value
+
+    # If this isn't host based, then the integration params the module accepts will be used as command args
+    if host_type == 'local':
+        accepted_options = None
+        if command:
+            # The schema is already loaded, the module docs are only read without one
+            accepted_options = schema_options(command) or module_options(command)
+        for arg_key, arg_value in int_params.items():
+            if arg_key in CONTROL_PARAMS:
+                continue
+            if accepted_options is not None and arg_key not in accepted_options:
+                continue
+            module_args[arg_key] = arg_value
+
+    if command:
+        module_args = validate_module_args(command, module_args)
+    if not templated:
+        return module_args
+    return {key: escape_templating(value) for key, value in module_args.items()}
+
+
+def build_playbook(command: str, module_args: Dict[str, Any], async_timeout: int = 0,
+                   host_timeout: int = 0, connect_task: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """Build a single task playbook running the module against all hosts.
+
+    If async_timeout is set, the module is started in the background with poll=0. Otherwise if
+    host_timeout is set, the module is run async and polled, so Ansible fails it on hosts where
+    it takes longer than host_timeout seconds. If connect_task is set, it is run first to open the
+    connection, so the connect time can be told apart from the module run. See CONNECT_TASKS.
+    """
+    task: Dict[str, Any] = {'name': command, command: module_args}
+    if async_timeout:
+        task['async'] = async_timeout
+        task['poll'] = 0
+    elif host_timeout:
+        task['async'] = host_timeout
+        # Short timeouts are polled more often, so a host is not held up long after it finished
+        task['poll'] = max(1, min(10, host_timeout // 10))
+
+    tasks = [task]
+    if connect_task:
+        tasks.insert(0, dict(connect_task, name=CONNECT_TASK_NAME))
+
+    return [{'name': command, 'hosts': 'all', 'gather_facts': False, 'tasks': tasks}]
+
+
+def generic_ansible(integration_name: str, command: str, args: Dict[str, Any], int_params: Dict[str, Any],
+                    host_type: str) -> Union[CommandResults, List[CommandResults]]:
     """Run a Ansible module and return the results as a CommandResult.
 
     Keyword arguments:
@@ -224,10 +1371,25 @@ def generic_ansible(integration_name: str, command: str,
     command -- the ansible module to run
     args -- the XSOAR command args. Literally the demisto.args(). The args provided need to match the
             ansible module args, as well as include the arg "host" if the module is one that connects
-            to a host.
+            to a host. If the arg "async" is Yes the module is started as a background job, see
+            generic_ansible_job_status. If the arg "timing" is Yes the duration of each stage of the
+            command is also returned, under the Timing context key. If the arg "delta" is Yes only
+            the hosts and fields that changed since the last run are returned. If the arg "precheck"
+            is Yes, hosts that don't accept a TCP connection within "precheck_timeout" seconds are
+            reported as unreachable without being run. The arg "host_timeout" limits the seconds the
+            module can run on each host, and the arg "deadline" the seconds of the whole command.
+            Hosts that run out of time are reported with the status TIMEOUT, along with the
+            results of the other hosts. If the arg "limit" is set, only the first page of that
+            many entries is returned, with a cursor for the arg "cursor" to get the next page from
+            a cache, without running the module again.
     int_params -- the integration parameters. These will contain args that are integration wide.
                   They will passed to the the ansible module as args, with exception of credentials,
-                  these will be used to build the ansible inventory.
+                  these will be used to build the ansible inventory. If the param "in_process" is
+                  set, modules of local integrations are run in this process rather than with
+                  ansible-runner, see generic_ansible_in_process. The params "rate_limit",
+                  "rate_limit_burst", "rate_limit_retries" and "rate_limit_backoff" limit the rate
+                  of module runs of the integration instance, and retry runs rate limited by the
+                  provider, see run_rate_limited.
     host_type -- the type of host that is being managed. The following host types are supported:
                  * ssh -- Linux or Unix variant managed over ssh
                  * winrm -- Windows
@@ -237,87 +1399,733 @@ def generic_ansible(integration_name: str, command: str,
                              Mostly used by modules that connect out to cloud services.
     """
 
-    readable_output = ""
+    if args.get('cursor') and paginated(command, args):
+        return generic_ansible_page(integration_name, command, args)
+    page_limit(command, args)  # A bad limit fails the command before anything is run
+
+    timer = CommandTimer()
+    if runs_in_process(args, int_params, host_type):
+        in_process_results = generic_ansible_in_process(integration_name, command, args, int_params, timer)
+        if in_process_results is not None:
+            return in_process_results
+
+    runner_kwargs = build_runner_kwargs(command, args, int_params, host_type, timer)
+    try:
+        unreachable = []
+        if argToBoolean(args.get('precheck', False)):
+            with timer.span('precheck'):
+                unreachable = run_coroutine(precheck_inventory(runner_kwargs['inventory'], precheck_timeout(args)))
+
+        def run_once() -> Tuple[Any, List[Dict[str, Any]]]:
+            with timer.span('runner'):
+                r = ansible_runner.run(**runner_kwargs)
+            # runner.events reads the artifact files each time it is iterated, so only do that once
+            return r, list(r.events)
+
+        r, events = run_rate_limited(int_params, timer, run_once, deadline_time(args, timer))
+        return process_runner_results(integration_name, command, args, r, timer, unreachable,
+                                      list(runner_kwargs['inventory']['all']['hosts']), events)
+    finally:
+        cleanup_private_data_dir(runner_kwargs['private_data_dir'], int_params)
+
+
+def runs_in_process(args: Dict[str, Any], int_params: Dict[str, Any], host_type: str) -> bool:
+    """Whether to try running the module in process, see generic_ansible_in_process."""
+    # Background jobs and time limits are handled by Ansible, so those runs always go through ansible-runner
+    return host_type == 'local' and argToBoolean(int_params.get('in_process', False)) \
+        and not any(args.get(arg) for arg in ['host_timeout', 'deadline']) \
+        and not argToBoolean(args.get('async', False))
+
+
+def generic_ansible_in_process(integration_name: str, command: str, args: Dict[str, Any], int_params: Dict[str, Any],
+                               timer: 'CommandTimer') -> Optional[Union[CommandResults, List[CommandResults]]]:
+    """Run a module of a local integration in this process, rather than starting ansible-runner.
+
+    The result goes through the same processing as the result of a runner run. None if the module
+    can't be run in process, see in_process_module_path. This blocks, so generic_ansible_async
+    runs it in the default executor.
+    """
+    module_path = in_process_module_path(command)
+    if module_path is None:
+        demisto.debug("Unable to run %s in process, running it with ansible-runner" % command)
+        return None
+
+    with timer.span('module_args'):
+        module_args = build_module_args(args, int_params, 'local', command, templated=False)
+
+    def run_once() -> Tuple[Any, List[Dict[str, Any]]]:
+        with timer.span('module'):
+            result = run_module_in_process(command, module_path, module_args)
+
+        # Shaped like the event and run of ansible-runner, so the results are processed the same way
+        run = SimpleNamespace(
+            status='failed' if result.get('failed') else 'successful',
+            events=[{'event': 'runner_on_failed' if result.get('failed') else 'runner_on_ok', 'stdout': '',
+                     'event_data': {'host': 'localhost', 'res': result}}]
+        )
+        return run, run.events
+
+    run, events = run_rate_limited(int_params, timer, run_once)
+    return process_runner_results(integration_name, command, args, run, timer, events=events)
+
+
+def in_process_module_path(command: str) -> Optional[str]:
+    """The path of a module that can be run in process.
+
+    None if Ansible or the module can't be found, the module isn't python, or it has an action
+    plugin doing part of its work on the controller.
+    """
+    try:
+        from ansible.plugins.loader import action_loader, module_loader  # pylint: disable=E0401
+    except ImportError:
+        return None
+
+    module_path = module_loader.find_plugin(command)
+    if module_path is None or not module_path.endswith('.py') or action_loader.has_plugin(command):
+        return None
+    return module_path
+
+
+def run_module_in_process(command: str, module_path: str, module_args: Dict[str, Any]) -> Dict[str, Any]:
+    """Run an Ansible module in this process, the way Ansible runs it on a host, and return its result.
+
+    The args are injected into ansible.module_utils.basic, and the JSON result the module prints is
+    captured. Both are process wide, so modules are run one at a time under IN_PROCESS_LOCK.
+    """
+    from ansible.module_utils import basic  # pylint: disable=E0401
+    from ansible.module_utils.json_utils import _filter_non_json_lines  # pylint: disable=E0401
+
+    stdout = io.StringIO()
+    with IN_PROCESS_LOCK:
+        basic._ANSIBLE_ARGS = json.dumps({'ANSIBLE_MODULE_ARGS': dict(module_args, _ansible_module_name=command)}).encode()
+        try:
+            with redirect_stdout(stdout):
+                runpy.run_path(module_path, run_name='__main__')
+        except SystemExit:
+            pass  # Modules end with sys.exit once they have printed their result
+        except Exception:
+            return {'failed': True, 'msg': "MODULE FAILURE", 'exception': traceback.format_exc()}
+        finally:
+            basic._ANSIBLE_ARGS = None
+
+    try:
+        result = json.loads(_filter_non_json_lines(stdout.getvalue())[0])
+    except ValueError:
+        return {'failed': True, 'msg': "MODULE FAILURE\nSee module_stdout for the exact error",
+                'module_stdout': stdout.getvalue()}
+
+    # The same defaults the Ansible task executor sets
+    result.setdefault('changed', False)
+    if result.get('rc') not in [None, 0, '0']:
+        result.setdefault('failed', True)
+    return result
+
+
+async def generic_ansible_async(integration_name: str, command: str, args: Dict[str, Any], int_params: Dict[str, Any],
+                                host_type: str, semaphore: Optional[asyncio.Semaphore] = None
+                                ) -> Union[CommandResults, List[CommandResults]]:
+    """Awaitable version of generic_ansible, built on ansible_runner.run_async.
+
+    Takes the same arguments as generic_ansible and returns the same CommandResults. The number of
+    runs in flight is limited by semaphore, which defaults to a process wide limit of
+    MAX_CONCURRENT_RUNS. Blocking work, such as writing the private data dir, reading the
+    integration context, parsing the results and running modules in process, is run in the
+    default executor rather than on the event loop.
+    """
+    if args.get('cursor') and paginated(command, args):
+        return await run_blocking(generic_ansible_page, integration_name, command, args)
+    page_limit(command, args)
+    if semaphore is None:
+        semaphore = get_run_semaphore()
+
+    timer = CommandTimer()
+    if runs_in_process(args, int_params, host_type):
+        in_process_results = await run_blocking(generic_ansible_in_process, integration_name, command, args, int_params,
+                                                timer)
+        if in_process_results is not None:
+            return in_process_results
+
+    runner_kwargs = await run_blocking(build_runner_kwargs, command, args, int_params, host_type, timer)
+    try:
+        unreachable = []
+        if argToBoolean(args.get('precheck', False)):
+            with timer.span('precheck'):
+                unreachable = await precheck_inventory(runner_kwargs['inventory'], precheck_timeout(args))
+
+        async def run_once() -> Tuple[Any, List[Dict[str, Any]]]:
+            # Throttled commands wait outside the semaphore, so they don't hold up the other runs
+            async with semaphore:
+                with timer.span('runner'):
+                    thread, r = ansible_runner.run_async(**runner_kwargs)
+                    # The run happens in the runner thread, wait for it without blocking the event loop
+                    await asyncio.get_running_loop().run_in_executor(None, thread.join)
+            return r, await run_blocking(list, r.events)
+
+        r, events = await run_rate_limited_async(int_params, timer, run_once, deadline_time(args, timer))
+        return await run_blocking(process_runner_results, integration_name, command, args, r, timer, unreachable,
+                                  list(runner_kwargs['inventory']['all']['hosts']), events)
+    finally:
+        await run_blocking(cleanup_private_data_dir, runner_kwargs['private_data_dir'], int_params)
+
+
+async def generic_ansible_batch(integration_name: str, executions: List[Tuple[str, Dict[str, Any]]],
+                                int_params: Dict[str, Any], host_type: str,
+                                max_concurrency: int = MAX_CONCURRENT_RUNS
+                                ) -> List[Union[CommandResults, List[CommandResults]]]:
+    """Run several modules concurrently, eg against different host sets.
+
+    Keyword arguments:
+    executions -- list of (command, args) pairs, each is run as a call to generic_ansible_async
+    max_concurrency -- the maximum number of module runs in flight at once
+
+    The CommandResults are returned in the same order as executions. An execution that fails
+    returns an error entry, rather than ending the batch.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run_execution(command: str, args: Dict[str, Any]) -> Union[CommandResults, List[CommandResults]]:
+        try:
+            return await generic_ansible_async(integration_name, command, args, int_params, host_type, semaphore)
+        except Exception as e:
+            demisto.error(traceback.format_exc())
+            return CommandResults(readable_output="Failed to execute %s.\nError:\n%s" % (command, e),
+                                  entry_type=EntryType.ERROR)
+
+    return await asyncio.gather(*(run_execution(command, args) for command, args in executions))
+
+
+async def run_blocking(func: Callable[..., Any], *args: Any) -> Any:
+    """Run a blocking call in the default executor, without blocking the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args))
+
+
+def precheck_timeout(args: Dict[str, Any]) -> float:
+    return float(args.get('precheck_timeout') or DEFAULT_PRECHECK_TIMEOUT)
+
+
+def run_coroutine(coroutine: Awaitable[Any]) -> Any:
+    """Run a coroutine to completion from synchronous code, also when called from a running event loop."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    # Event loops can't be nested, so run the coroutine in its own loop in another thread
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+async def probe_host(address: str, port: int, timeout: float, semaphore: asyncio.Semaphore) -> bool:
+    """Whether the host at address:port may be alive, False if the connection is refused, times out or can't be routed."""
+    async with semaphore:
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(address, port), timeout)
+        except (ConnectionRefusedError, asyncio.TimeoutError):
+            return False
+        except OSError as e:
+            if e.errno in DEAD_HOST_ERRNOS:
+                return False
+            demisto.debug("Unable to probe %s port %d, leaving it to Ansible: %s" % (address, port, e))
+            return True
+    writer.close()
+    return True
+
+
+async def precheck_inventory(inventory: Dict[str, Any], timeout: float) -> List[Tuple[str, str, Any]]:
+    """Probe the connection port of every host in the inventory concurrently, and remove the dead hosts.
+
+    Dead hosts would otherwise each hold up a fork for the full connect timeout of the runner. At
+    most PRECHECK_CONCURRENCY hosts are probed at once.
+    Returns a host result for each dead host. Local hosts are not probed. If no host is left,
+    the command is ended with an error.
+    """
+    group_vars = inventory['all'].get('vars', {})
+    targets = {}
+    for host, host_vars in inventory['all']['hosts'].items():
+        connection = host_vars.get('ansible_connection', group_vars.get('ansible_connection', 'ssh'))
+        if connection == 'local':
+            continue
+        port = host_vars.get('ansible_port') or group_vars.get('ansible_port') or CONNECTION_PORTS.get(connection, 22)
+        targets[host] = (host_vars.get('ansible_host', host), int(port))
+
+    semaphore = asyncio.Semaphore(PRECHECK_CONCURRENCY)
+    alive = await asyncio.gather(*(probe_host(address, port, timeout, semaphore) for address, port in targets.values()))
+
+    unreachable = []
+    for (host, (address, port)), host_alive in zip(targets.items(), alive):
+        if not host_alive:
+            del inventory['all']['hosts'][host]
+            unreachable.append((host, PRECHECK_STATUS, {
+                'unreachable': True,
+                'msg': "Unable to connect to %s port %d within %s seconds" % (address, port, timeout)
+            }))
+
+    if not inventory['all']['hosts']:
+        raise DemistoException("All hosts are unreachable: %s" % ", ".join(host for host, _, _ in unreachable))
+    return unreachable
+
+
+def get_run_semaphore() -> asyncio.Semaphore:
+    # Semaphores belong to the event loop they are used in, so keep one per loop
+    loop = asyncio.get_running_loop()
+    if RUN_SEMAPHORES.get(loop) is None:
+        RUN_SEMAPHORES[loop] = asyncio.Semaphore(MAX_CONCURRENT_RUNS)
+    return RUN_SEMAPHORES[loop]
+
+
+def build_runner_kwargs(command: str, args: Dict[str, Any], int_params: Dict[str, Any], host_type: str,
+                        timer: Optional['CommandTimer'] = None) -> Dict[str, Any]:
+    """Build the ansible_runner.run keyword arguments for running a module."""
+    timer = timer or CommandTimer()
     sshkey = ""
     fork_count = 1   # default to executing against 1 host at a time
 
     if args.get('concurrency'):
         fork_count = cast(int, args.get('concurrency'))
 
+    if argToBoolean(args.get('async', False)) and host_type in ['ios', 'nxos']:
+        # network_cli modules can't be run in the background, Ansible rejects a poll=0 task for them
+        raise ValueError("async is not supported for %s devices. Use host_timeout or deadline to limit the runtime instead."
+                         % host_type)
+
     # generate ansible host inventory
-    inventory, sshkey = generate_ansible_inventory(args=args, host_type=host_type, int_params=int_params)
+    with timer.span('inventory'):
+        inventory, sshkey = generate_ansible_inventory(args=args, host_type=host_type, int_params=int_params)
+
+    with timer.span('module_args'):
+        module_args = build_module_args(args, int_params, host_type, command)
+
+    # Background jobs are started with poll=0 so the run returns as soon as the module is launched
+    async_timeout = 0
+    if argToBoolean(args.get('async', False)):
+        async_timeout = int(args.get('async_timeout') or DEFAULT_ASYNC_TIMEOUT)
+
+    host_timeout = int(args.get('host_timeout') or 0)
+    if host_timeout and host_type in ['ios', 'nxos']:
+        # network_cli modules can't be run async, the persistent connection times out the command instead
+        inventory['all']['vars']['ansible_command_timeout'] = host_timeout
+        host_timeout = 0
+
+    if (async_timeout or host_timeout) and not supports_async(command):
+        raise ValueError("%s can't be run with async or host_timeout, as its action plugin doesn't support async tasks. "
+                         "Use deadline to limit the runtime instead." % command)
+
+    # With timing, network devices are connected to in a task of its own, so the connect time is reported per host
+    connect_task = None
+    if argToBoolean(args.get('timing', False)) and not async_timeout:
+        connect_task = CONNECT_TASKS.get(host_type)
+    playbook = build_playbook(command, module_args, async_timeout, host_timeout, connect_task)
+
+    # The event data is needed, as it holds the structured result of each host
+    kwargs = dict(inventory=inventory, playbook=playbook, quiet=True, omit_event_data=False, forks=fork_count,
+                  private_data_dir=create_private_data_dir(int_params), **ssh_key_kwargs(sshkey))
+    if host_type in ['ios', 'nxos']:
+        kwargs.setdefault('envvars', {}).update(persistent_connection_env(int_params))
+
+    cancel_at = deadline_time(args, timer)
+    if cancel_at is not None:
+        # ansible-runner polls this while the run is going, and stops the run once it returns True
+        kwargs['cancel_callback'] = lambda: time.time() >= cancel_at
+    return kwargs
+
+
+def supports_async(command: str) -> bool:
+    """Whether a module can be run async. Modules with an action plugin can only if it is one of ASYNC_ACTION_PLUGINS.
+
+    If Ansible can't be imported here, the module is assumed to support it, and Ansible has the final say.
+    """
+    try:
+        from ansible.plugins.loader import action_loader  # pylint: disable=E0401
+    except ImportError:
+        return True
+    return command in ASYNC_ACTION_PLUGINS or not action_loader.has_plugin(command)
+
+
+def deadline_time(args: Dict[str, Any], timer: 'CommandTimer') -> Optional[float]:
+    """When the run of a command with the deadline arg is cancelled, leaving time to return the results that are in."""
+    if not args.get('deadline'):
+        return None
+    deadline = float(args['deadline'])
+    return timer.started + deadline - min(DEADLINE_MARGIN, deadline / 10)
+
+
+def process_runner_results(integration_name: str, command: str, args: Dict[str, Any], r: Any,
+                           timer: Optional['CommandTimer'] = None,
+                           unreachable: Optional[List[Tuple[str, str, Any]]] = None,
+                           hosts: Optional[List[str]] = None, events: Optional[List[Dict[str, Any]]] = None
+                           ) -> Union[CommandResults, List[CommandResults]]:
+    """Turn a finished ansible-runner run of a module into CommandResults.
+
+    unreachable holds the results of the hosts that failed the pre-check, and were not run. If the
+    run was cancelled at the deadline, the hosts of the run that have no result are reported as
+    timed out. events are the events of the run, if they were already read.
+    """
+    timer = timer or CommandTimer()
+    with timer.span('parse'):
+        # runner.events reads the artifact files each time it is iterated, so only do that once
+        if events is None:
+            events = list(r.events)
+        host_results = parse_host_results(events) + (unreachable or [])
+        if getattr(r, 'status', None) == 'canceled':
+            host_results += deadline_results(events, hosts or [], args.get('deadline'))
+    timer.add_event_timings(events)
+
+    command_results: Union[CommandResults, List[CommandResults]]
+    if argToBoolean(args.get('async', False)):
+        command_results = start_async_job(integration_name, command, host_results,
+                                          int(args.get('async_timeout') or DEFAULT_ASYNC_TIMEOUT))
+    else:
+        if args.get('host_timeout'):
+            strip_async_status(host_results)
+        command_results = build_command_results(
+            integration_name, command, host_results, timer,
+            delta_key=delta_key(integration_name, command, args) if argToBoolean(args.get('delta', False)) else None,
+            limit=page_limit(command, args))
+
+    timing = timer.to_context(integration_name, command)
+    demisto.debug("Ansible timing: %s" % json.dumps(timing))
+    if not argToBoolean(args.get('timing', False)):
+        return command_results
+
+    return (command_results if isinstance(command_results, list) else [command_results]) + [
+        CommandResults(
+            readable_output="# Timing\n" + dict2md(timing['stages']),
+            outputs_prefix=integration_name + '.Timing',
+            outputs_key_field='run_id',
+            outputs=timing
+        )
+    ]
+
+
+def strip_async_status(host_results: List[Tuple[str, str, Any]]):
+    """Drop the async_status bookkeeping of polled results, so they look the same as a foreground run."""
+    for _, _, result in host_results:
+        if isinstance(result, dict):
+            for key in ASYNC_STATUS_KEYS:
+                result.pop(key, None)
+
+
+def rate_limited(events: List[Dict[str, Any]]) -> bool:
+    """Whether a host of the run failed as the provider is rate limiting us."""
+    for event in events:
+        if event['event'] == 'runner_on_failed':
+            result = event.get('event_data', {}).get('res', {})
+            if str(result.get('status')) == '429' or RATE_LIMIT_PATTERN.search(str(result.get('msg', ''))):
+                return True
+    return False
+
+
+def rate_limit_delay(int_params: Dict[str, Any]) -> float:
+    """Take a token from the rate limit bucket of the integration instance, and return the seconds to wait for it.
+
+    The bucket is kept in the integration context, so it is shared by concurrent commands. It holds up
+    to rate_limit_burst tokens, refilled at rate_limit tokens per second. The token is taken even if
+    the bucket is empty, leaving it in debt, so commands waiting on it are queued in order. Commands
+    also wait out the backoff of any command that was rate limited by the provider.
+    """
+    rate = float(int_params.get('rate_limit') or 0)
+    if not rate and not int_params.get('rate_limit_retries'):
+        return 0.0
+    if not rate:
+        bucket = get_integration_context().get(RATE_LIMIT_CONTEXT_KEY, {})
+        return max(bucket.get('blocked_until', 0) - time.time(), 0)
 
-    module_args = ""
-    # build module args list
-    for arg_key, arg_value in args.items():
-        # skip hardcoded host arg, as it doesn't related to module
-        if arg_key == 'host':
-            continue
+    burst = max(float(int_params.get('rate_limit_burst') or 1), 1)
 
-        module_args += "%s=\"%s\" " % (arg_key, arg_value)
+    def take_token(integration_context: Dict[str, Any]) -> float:
+        now = time.time()
+        bucket = integration_context.setdefault(RATE_LIMIT_CONTEXT_KEY, {})
+        tokens = min(bucket.get('tokens', burst) + (now - bucket.get('updated', now)) * rate, burst) - 1
+        bucket.update(tokens=tokens, updated=now)
+        return max(bucket.get('blocked_until', 0) - now, -tokens / rate, 0)
 
-        # If this isn't host based, then all the integration parms will be used as command args
-    if host_type == 'local':
-        for arg_key, arg_value in int_params.items():
-            module_args += "%s=\"%s\" " % (arg_key, arg_value)
+    return update_context_with_retries(take_token)
 
-    r = ansible_runner.run(inventory=inventory, host_pattern='all', module=command, quiet=True,
-                           omit_event_data=True, ssh_key=sshkey, module_args=module_args, forks=fork_count)
 
-    results = []
-    outputs_key_field = ''
-    for each_host_event in r.events:
-        # Troubleshooting
-        # demisto.log("%s: %s\n" % (each_host_event['event'], each_host_event))
-        if each_host_event['event'] in ["runner_on_ok", "runner_on_unreachable", "runner_on_failed"]:
+def rate_limit_backoff(int_params: Dict[str, Any], attempt: int) -> float:
+    """Back off after the provider rate limited attempt, and return the backoff in seconds.
 
-            # parse results
+    The backoff doubles with each attempt, with jitter so throttled commands don't retry together. It
+    is stored in the rate limit bucket, so concurrent commands of the integration instance back off too.
+    """
+    base = float(int_params.get('rate_limit_backoff') or DEFAULT_RATE_LIMIT_BACKOFF)
+    backoff = min(base * 2 ** attempt, MAX_RATE_LIMIT_BACKOFF) * random.uniform(0.5, 1)
 
-            result = json.loads('{' + each_host_event['stdout'].split('{', 1)[1])
-            host = each_host_event['stdout'].split('|', 1)[0].strip()
-            status = each_host_event['stdout'].replace('=>', '|').split('|', 3)[1]
+    def block(integration_context: Dict[str, Any]):
+        bucket = integration_context.setdefault(RATE_LIMIT_CONTEXT_KEY, {})
+        bucket['blocked_until'] = max(bucket.get('blocked_until', 0), time.time() + backoff)
 
-            # if successful build outputs
-            if each_host_event['event'] == "runner_on_ok":
-                if 'fact' in command:
-                    result = result['ansible_facts']
-                else:
-                    if result.get(command) is not None:
-                        result = result[command]
-                    else:
-                        result.pop("ansible_facts", None)
+    update_context_with_retries(block)
+    return backoff
 
-                result = rec_ansible_key_strip(result)
 
-                if host != "localhost":
-                    readable_output += "# %s - %s\n" % (host, status)
-                else:
-                    # This is integration is not host based
-                    readable_output += "# %s\n" % status
+def past_deadline(delay: float, deadline_at: Optional[float]) -> bool:
+    """Whether waiting delay seconds would take the command past deadline_at, see deadline_time."""
+    return deadline_at is not None and time.time() + delay >= deadline_at
 
-                readable_output += dict2md(result)
 
-                # add host and status to result if it is a dict. Some ansible modules return a list
-                if (type(result) == dict) and (host != 'localhost'):
-                    result['host'] = host
-                    outputs_key_field = 'host'  # updates previous outputs that share this key, neat!
+def deadline_run() -> Tuple[Any, List[Dict[str, Any]]]:
+    # A cancelled run without events, so every host is reported as not started before the deadline
+    return SimpleNamespace(status='canceled', events=[]), []
 
-                if (type(result) == dict):
-                    result['status'] = status.strip()
 
-                results.append(result)
-            if each_host_event['event'] == "runner_on_unreachable":
-                msg = "Host %s unreachable\nError Details: %s" % (host, result.get('msg'))
+def run_rate_limited(int_params: Dict[str, Any], timer: 'CommandTimer',
+                     run_once: Callable[[], Tuple[Any, List[Dict[str, Any]]]],
+                     deadline_at: Optional[float] = None) -> Tuple[Any, List[Dict[str, Any]]]:
+    """Call run_once, which runs the module and returns the run and its events, within the rate limit.
 
-            if each_host_event['event'] == "runner_on_failed":
-                msg = "Host %s failed running command\nError Details: %s" % (host, result.get('msg'))
+    Runs the provider rate limited are retried up to rate_limit_retries times. The time spent waiting
+    is timed as the throttled stage. If waiting would take the command past deadline_at, it doesn't
+    wait and returns a cancelled run instead, so the hosts are reported as TIMEOUT.
+    """
+    retries = int(int_params.get('rate_limit_retries') or 0)
+    for attempt in range(retries + 1):
+        delay = rate_limit_delay(int_params)
+        if delay:
+            if past_deadline(delay, deadline_at):
+                return deadline_run()
+            with timer.span('throttled'):
+                time.sleep(delay)
+
+        r, events = run_once()
+        if attempt == retries or not rate_limited(events):
+            break
+        timer.rate_limit_retries += 1
+        demisto.debug("Rate limited, backing off %.1f seconds" % rate_limit_backoff(int_params, attempt))
+    return r, events
+
+
+async def run_rate_limited_async(int_params: Dict[str, Any], timer: 'CommandTimer',
+                                 run_once: Callable[[], Awaitable[Tuple[Any, List[Dict[str, Any]]]]],
+                                 deadline_at: Optional[float] = None) -> Tuple[Any, List[Dict[str, Any]]]:
+    """Awaitable version of run_rate_limited, waiting and updating the bucket without blocking the event loop."""
+    retries = int(int_params.get('rate_limit_retries') or 0)
+    for attempt in range(retries + 1):
+        delay = await run_blocking(rate_limit_delay, int_params)
+        if delay:
+            if past_deadline(delay, deadline_at):
+                return deadline_run()
+            with timer.span('throttled'):
+                await asyncio.sleep(delay)
+
+        r, events = await run_once()
+        if attempt == retries or not rate_limited(events):
+            break
+        timer.rate_limit_retries += 1
+        backoff = await run_blocking(rate_limit_backoff, int_params, attempt)
+        demisto.debug("Rate limited, backing off %.1f seconds" % backoff)
+    return r, events
+
+
+def deadline_results(events: List[Dict[str, Any]], hosts: List[str], deadline: Any) -> List[Tuple[str, str, Any]]:
+    """TIMEOUT results for the hosts of a run cancelled at the deadline, that did not return a result."""
+    started = set()
+    finished = set()
+    for event in events:
+        if event['event'] == 'runner_on_start' and event.get('event_data', {}).get('host'):
+            started.add(event['event_data']['host'])
+        elif event['event'] in HOST_RESULT_EVENTS:
+            finished.add(event_host(event))
 
-            if each_host_event['event'] in ["runner_on_failed", "runner_on_unreachable"]:
-                return_error(msg)
+    results = []
+    for host in hosts:
+        if host in finished:
+            continue
+        if host in started:
+            msg = "Cancelled at the %s second deadline before the module finished" % deadline
+        else:
+            msg = "Not started before the %s second deadline" % deadline
+        results.append((host, TIMEOUT_STATUS, {'timeout': True, 'msg': msg}))
+    return results
+
+
+class CommandTimer:
+    """Durations of the stages of a command, in milliseconds.
 
+    Stages are timed with span, repeated spans of the same stage add up. The runner
+    startup and module execution stages, and the duration of each host, are taken from the
+    timestamps of the ansible-runner events. The connect time of each host, and the connect
+    stage, are taken from the connect task, if the playbook has one.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        # Timing entries of repeated runs are kept apart in the context by the run ID
+        self.run_id = uuid.uuid4().hex
+        self.stages: Dict[str, float] = {}
+        self.hosts: Dict[str, float] = {}
+        self.connect: Dict[str, float] = {}
+        self.rate_limit_retries = 0
+        self.runner_window = (0.0, 0.0)
+
+    @contextmanager
+    def span(self, stage: str):
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            self.stages[stage] = self.stages.get(stage, 0) + (end - start) * 1000
+            if stage == 'runner':
+                self.runner_window = (start, end)
+
+    def add_event_timings(self, events: List[Dict[str, Any]]):
+        first_event = last_result = task_start = None
+        host_starts = {}
+        for event in events:
+            if not event.get('created'):
+                continue
+            # Event timestamps are naive UTC
+            created = datetime.fromisoformat(event['created']).replace(tzinfo=timezone.utc).timestamp()
+            if first_event is None:
+                first_event = created
+
+            if event['event'] == 'runner_on_start':
+                task_start = created if task_start is None else task_start
+                # The host is only known if the event data was not omitted
+                if event.get('event_data', {}).get('host'):
+                    host_starts[event['event_data']['host']] = created
+
+            elif event['event'] in HOST_RESULT_EVENTS:
+                last_result = created
+                host = event_host(event)
+                # Without a start event for the host, time it from the start of the task
+                host_start = host_starts.get(host, task_start or first_event)
+                if event.get('event_data', {}).get('task') == CONNECT_TASK_NAME:
+                    self.connect[host] = max(created - host_start, 0) * 1000
+                else:
+                    self.hosts[host] = max(created - host_start, 0) * 1000
+
+        if first_event is not None and self.runner_window[0]:
+            self.stages['runner_startup'] = max(first_event - self.runner_window[0], 0) * 1000
+        if task_start is not None and last_result is not None:
+            self.stages['execute'] = max(last_result - task_start, 0) * 1000
+        if self.connect:
+            # Hosts are connected to in parallel, so the stage takes as long as the slowest host
+            self.stages['connect'] = max(self.connect.values())
+
+    def to_context(self, integration_name: str, command: str) -> Dict[str, Any]:
+        return {
+            'run_id': self.run_id,
+            'integration': integration_name,
+            'module': command,
+            'total': round((time.time() - self.started) * 1000, 1),
+            'stages': {stage: round(duration, 1) for stage, duration in self.stages.items()},
+            'rate_limit_retries': self.rate_limit_retries,
+            'hosts': [self.host_context(host, duration) for host, duration in self.hosts.items()]
+        }
+
+    def host_context(self, host: str, duration: float) -> Dict[str, Any]:
+        context = {'host': host, 'duration': round(duration, 1)}
+        if host in self.connect:
+            context['connect'] = round(self.connect[host], 1)
+        return context
+
+
+def start_async_job(integration_name: str, command: str, host_results: List[Tuple[str, str, Any]],
+                    async_timeout: int) -> CommandResults:
+    """Record the Ansible job IDs of a module launched in the background, and return the XSOAR job ID."""
+    job_id = str(uuid.uuid4())
+    job = {
+        'module': command,
+        'hosts': {host: result.get('ansible_job_id') for host, status, result in host_results
+                  if status not in INCOMPLETE_STATUSES},
+        'expires': int(time.time()) + async_timeout
+    }
+
+    def add_job(integration_context: Dict[str, Any]):
+        # Jobs whose async timeout has passed can no longer be polled, so drop them while we are here
+        jobs = {key: value for key, value in integration_context.get(ASYNC_JOBS_CONTEXT_KEY, {}).items()
+                if value.get('expires', 0) > time.time()}
+        jobs[job_id] = job
+        integration_context[ASYNC_JOBS_CONTEXT_KEY] = jobs
+
+    update_context_with_retries(add_job)
+
+    output = {'job_id': job_id, 'module': command, 'status': 'running', 'hosts': list(job['hosts'])}
+    unreachable_hosts = [host for host, status, _ in host_results if status == PRECHECK_STATUS]
+    if unreachable_hosts:
+        output['unreachable_hosts'] = unreachable_hosts
     return CommandResults(
-        readable_output=readable_output,
-        outputs_prefix=integration_name + '.' + camelCase(command),
-        outputs_key_field=outputs_key_field,
-        outputs=results
+        readable_output="# Job %s started\n" % job_id + dict2md(output),
+        outputs_prefix=integration_name + '.job',
+        outputs_key_field='job_id',
+        outputs=output
     )
+
+
+def drop_async_job(job_id: str):
+    update_context_with_retries(lambda integration_context: integration_context.get(ASYNC_JOBS_CONTEXT_KEY, {}).pop(job_id, None))
+
+
+def generic_ansible_job_status(integration_name: str, args: Dict[str, Any], int_params: Dict[str, Any],
+                               host_type: str) -> Union[CommandResults, List[CommandResults]]:
+    """Check on a module started with generic_ansible in async mode.
+
+    Keyword arguments:
+    integration_name -- the name of the XSOAR integration. Used for context output structure
+    args -- the XSOAR command args. Must include "job_id". If "polling" is Yes, the command will be
+            rescheduled every "interval_in_seconds" until the job has finished on all hosts.
+    int_params -- the integration parameters, used to build the ansible inventory
+    host_type -- the type of host that is being managed, see generic_ansible
+    """
+    job_id = args.get('job_id')
+    job = get_integration_context().get(ASYNC_JOBS_CONTEXT_KEY, {}).get(job_id)
+    if job is None:
+        raise ValueError("Unknown or expired job ID: %s" % job_id)
+
+    inventory, sshkey = generate_ansible_inventory(args={'host': list(job['hosts'])}, host_type=host_type,
+                                                   int_params=int_params)
+    # Each host has its own Ansible job ID, which async_status picks up from the host vars
+    for host, ansible_job_id in job['hosts'].items():
+        inventory['all']['hosts'][host]['async_jid'] = ansible_job_id
+
+    private_data_dir = create_private_data_dir(int_params)
+    try:
+        r = ansible_runner.run(inventory=inventory, playbook=build_playbook('async_status', {'jid': '{{ async_jid }}'}),
+                               quiet=True, omit_event_data=False, forks=int(int_params.get('concurrency') or 1),
+                               private_data_dir=private_data_dir, **ssh_key_kwargs(sshkey))
+        host_results = parse_host_results(r.events)
+    except DemistoException:
+        # The job failed on a host, so polling it again would only fail the same way
+        drop_async_job(job_id)
+        raise
+    finally:
+        cleanup_private_data_dir(private_data_dir, int_params)
+    pending = [host for host, _, result in host_results if not result.get('finished')]
+
+    output = {'job_id': job_id, 'module': job['module'], 'hosts': list(job['hosts'])}
+    if pending:
+        output['status'] = 'running'
+        output['pending_hosts'] = pending
+
+        scheduled_command = None
+        if argToBoolean(args.get('polling', False)):
+            scheduled_command = ScheduledCommand(
+                command=demisto.command(),
+                next_run_in_seconds=int(args.get('interval_in_seconds') or 30),
+                args=args,
+                timeout_in_seconds=int(args.get('timeout_in_seconds') or 600)
+            )
+
+        return CommandResults(
+            readable_output="# Job %s running\n" % job_id + dict2md(output),
+            outputs_prefix=integration_name + '.job',
+            outputs_key_field='job_id',
+            outputs=output,
+            scheduled_command=scheduled_command
+        )
+
+    drop_async_job(job_id)
+
+    strip_async_status(host_results)
+
+    output['status'] = 'finished'
+    return [
+        CommandResults(
+            outputs_prefix=integration_name + '.job',
+            outputs_key_field='job_id',
+            outputs=output,
+            readable_output="# Job %s finished\n" % job_id
+        ),
+        build_command_results(integration_name, job['module'], host_results)
+    ]
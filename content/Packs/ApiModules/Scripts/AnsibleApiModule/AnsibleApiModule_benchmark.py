@@ -0,0 +1,193 @@
+"""Offline benchmarks for AnsibleApiModule.
+
+ansible_runner.run is replaced with TestsInput.fake_runner, which replays synthetic event streams,
+so no Ansible or hosts are needed. Run from this directory, in the same environment as the unit tests:
+
+    python AnsibleApiModule_benchmark.py --hosts 1,10,100,1000 --output bench.json
+    python AnsibleApiModule_benchmark.py --hosts 1,10,100,1000 --compare bench.json
+
+The event streams are seeded, so results from different commits are comparable as long as the
+same settings are used. Each stage reports latency (median and p95 in ms), throughput (hosts per
+second, based on the median) and peak traced memory (KB).
+
+If a share of the hosts fail or are unreachable, the command ends with an error at the first bad
+host. The parse and end_to_end stages of those runs are checked to raise that error, and are
+reported apart as parse_failed and end_to_end_failed, as they time an early abort rather than the
+whole run.
+"""
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from unittest.mock import patch
+
+from AnsibleApiModule import dict2md, rec_ansible_key_strip, generate_ansible_inventory, generic_ansible
+from AnsibleApiModule import parse_host_results, compute_delta
+from CommonServerPython import DemistoException
+from TestsInput.fake_runner import generate_events, make_fake_run
+from TestsInput.integration_context import MockIntegrationContext
+
+INT_PARAMS = {'port': 22, 'creds': {'identifier': 'bill', 'password': 'xyz321', 'credentials': {}}}
+
+
+def measure(func: Callable[[], Any], repeat: int) -> Dict[str, float]:
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append((time.perf_counter() - start) * 1000)
+
+    # Peak memory is traced in a separate run, as tracing slows everything down
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    durations.sort()
+    return {
+        'median_ms': round(statistics.median(durations), 3),
+        'p95_ms': round(durations[min(int(len(durations) * 0.95), len(durations) - 1)], 3),
+        'peak_kb': round(peak / 1024, 1)
+    }
+
+
+@contextmanager
+def expect_host_error(expected: bool):
+    """Check that failed or unreachable hosts end the command with their error, and nothing else does."""
+    if not expected:
+        yield
+        return
+    try:
+        yield
+    except DemistoException as e:
+        if not str(e).startswith('Host '):
+            raise
+    else:
+        raise AssertionError("Expected the failed or unreachable hosts to end the command with an error")
+
+
+def run_end_to_end(args: Dict[str, Any], event_settings: Dict[str, Any], expect_error: bool):
+    with patch('ansible_runner.run', side_effect=make_fake_run(**event_settings)), expect_host_error(expect_error):
+        generic_ansible('linux', 'ping', args, INT_PARAMS, 'ssh')
+
+
+def run_parse(events: List[Dict[str, Any]], expect_error: bool):
+    with expect_host_error(expect_error):
+        parse_host_results(events)
+
+
+def run_delta(host_results: List[Tuple[str, str, Any]], integration_context: MockIntegrationContext):
+    with integration_context.patch():
+        compute_delta('benchmark', host_results)
+
+
+def benchmark_host_count(host_count: int, payload_size: int, depth: int, failure_rate: float,
+                         unreachable_rate: float, repeat: int, seed: int) -> Dict[str, Dict[str, float]]:
+    hosts = ['10.%d.%d.%d' % (index // 65536, index // 256 % 256, index % 256) for index in range(host_count)]
+    args = {'host': hosts}
+    event_settings = dict(payload_size=payload_size, depth=depth, failure_rate=failure_rate,
+                          unreachable_rate=unreachable_rate, seed=seed)
+    events = generate_events(hosts, **event_settings)
+    results = [event['event_data']['res'] for event in events if event['event'] == 'runner_on_ok']
+    expect_error = any(event['event'] in ['runner_on_failed', 'runner_on_unreachable'] for event in events)
+    # Runs that end at the first bad host are reported apart, as they don't time the whole run
+    failed_suffix = '_failed' if expect_error else ''
+    normalised = [rec_ansible_key_strip(result) for result in results]
+    # Compared to the digests of an identical run, so every host is hashed and compared but none are output
+    host_results = [(hosts[index], 'SUCCESS', result) for index, result in enumerate(normalised)]
+    delta_context = MockIntegrationContext()
+    run_delta(host_results, delta_context)
+
+    stages = {
+        'inventory': lambda: generate_ansible_inventory(args, INT_PARAMS, host_type='ssh'),
+        'parse' + failed_suffix: lambda: run_parse(events, expect_error),
+        'normalise': lambda: [rec_ansible_key_strip(result) for result in results],
+        'markdown': lambda: [dict2md(result) for result in normalised],
+        'delta': lambda: run_delta(host_results, delta_context),
+        'end_to_end' + failed_suffix: lambda: run_end_to_end(args, event_settings, expect_error)
+    }
+
+    report = {}
+    for stage, func in stages.items():
+        report[stage] = measure(func, repeat)
+        median_seconds = report[stage]['median_ms'] / 1000
+        report[stage]['hosts_per_sec'] = round(host_count / median_seconds, 1) if median_seconds else 0.0
+    return report
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(host_counts: List[int], payload_size: int = 20, depth: int = 2, failure_rate: float = 0.0,
+                   unreachable_rate: float = 0.0, repeat: int = 5, seed: int = 0) -> Dict[str, Any]:
+    settings = dict(payload_size=payload_size, depth=depth, failure_rate=failure_rate,
+                    unreachable_rate=unreachable_rate, repeat=repeat, seed=seed)
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'settings': settings,
+        'results': {str(host_count): benchmark_host_count(host_count, **settings) for host_count in host_counts}
+    }
+
+
+def print_report(report: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None):
+    print("commit %s, python %s, settings %s" % (report['commit'], report['python'], report['settings']))
+    if baseline is not None:
+        print("compared to commit %s" % baseline.get('commit'))
+        if baseline.get('settings') != report['settings']:
+            print("WARNING: baseline was run with different settings %s" % baseline.get('settings'))
+
+    print("%8s %-18s %12s %12s %14s %12s" % ('hosts', 'stage', 'median ms', 'p95 ms', 'hosts/sec', 'peak KB'))
+    for host_count, stages in report['results'].items():
+        for stage, result in stages.items():
+            line = "%8s %-18s %12.3f %12.3f %14.1f %12.1f" % (host_count, stage, result['median_ms'], result['p95_ms'],
+                                                           result['hosts_per_sec'], result['peak_kb'])
+            baseline_result = (baseline or {}).get('results', {}).get(host_count, {}).get(stage)
+            if baseline_result and baseline_result['median_ms']:
+                change = (result['median_ms'] - baseline_result['median_ms']) / baseline_result['median_ms'] * 100
+                line += "  %+6.1f%% time" % change
+            print(line)
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--hosts', default='1,10,100,1000', help="comma separated host counts")
+    parser.add_argument('--payload-size', type=int, default=20, help="leaf values in each host result")
+    parser.add_argument('--depth', type=int, default=2, help="nesting depth of each host result")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="share of hosts that fail")
+    parser.add_argument('--unreachable-rate', type=float, default=0.0, help="share of hosts that are unreachable")
+    parser.add_argument('--repeat', type=int, default=5, help="timed runs of each stage")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="save the results as JSON")
+    parser.add_argument('--compare', help="JSON results of a previous run to compare against")
+    options = parser.parse_args(argv)
+
+    report = run_benchmarks([int(count) for count in options.hosts.split(',')], payload_size=options.payload_size,
+                            depth=options.depth, failure_rate=options.failure_rate,
+                            unreachable_rate=options.unreachable_rate, repeat=options.repeat, seed=options.seed)
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,11 +1,51 @@
-from AnsibleApiModule import dict2md, rec_ansible_key_strip, generate_ansible_inventory, generic_ansible
+from AnsibleApiModule import dict2md, rec_ansible_key_strip, generate_ansible_inventory, generic_ansible, expand_host_pattern
+from AnsibleApiModule import generic_ansible_job_status, generic_ansible_batch, rotate_artifacts, build_module_args
+from AnsibleApiModule import resolve_host, ssh_agent_env, SSH_AGENT_STATE, generic_ansible_async, load_argument_schemas
+from AnsibleApiModule import delta_key, rate_limited
 from TestsInput.markdown import MOCK_SINGLE_LEVEL_LIST, EXPECTED_MD_LIST, MOCK_SINGLE_LEVEL_DICT, EXPECTED_MD_DICT
 from TestsInput.markdown import MOCK_MULTI_LEVEL_DICT, EXPECTED_MD_MULTI_DICT, MOCK_MULTI_LEVEL_LIST
 from TestsInput.markdown import EXPECTED_MD_MULTI_LIST, MOCK_MULTI_LEVEL_LIST_ID_NAMES, EXPECTED_MD_MULTI_LIST_ID_NAMES
 from TestsInput.ansible_keys import MOCK_ANSIBLE_DICT, EXPECTED_ANSIBLE_DICT, MOCK_ANSIBLELESS_DICT, EXPECTED_ANSIBLELESS_DICT
 from TestsInput.ansible_inventory import ANSIBLE_INVENTORY_HOSTS_LIST, ANSIBLE_INVENTORY_HOSTS_CSV_LIST
 from TestsInput.ansible_inventory import ANSIBLE_INVENTORY_HOST_w_PORT, ANSIBLE_INVENTORY_INT_PARAMS
+from TestsInput.ansible_inventory import ANSIBLE_INVENTORY_HOST_RANGES, ANSIBLE_INVENTORY_HOST_DUPLICATES
+from TestsInput.ansible_async import ASYNC_ARGS, ASYNC_INT_PARAMS, MOCK_ASYNC_START_EVENTS, MOCK_ASYNC_RUNNING_EVENTS
+from TestsInput.ansible_async import MOCK_ASYNC_FINISHED_EVENTS, MOCK_ASYNC_FAILED_EVENTS, EXPECTED_ASYNC_OUTPUTS
+from TestsInput.ansible_delta import DELTA_ARGS, DELTA_SECOND_ARGS, DELTA_INT_PARAMS, MOCK_FIRST_RUN_FACTS
+from TestsInput.ansible_delta import MOCK_SECOND_RUN_FACTS, EXPECTED_DELTA_OUTPUTS, facts_events
+from TestsInput.ansible_timeouts import TIMEOUT_INT_PARAMS, MOCK_HOST_TIMEOUT_EVENTS, MOCK_DEADLINE_EVENTS
+from TestsInput.ansible_timeouts import EXPECTED_DEADLINE_OUTPUTS
+from TestsInput.network_cli import NETWORK_ARGS, NETWORK_INT_PARAMS, EXPECTED_NETWORK_VARS, MOCK_NETWORK_EVENTS
+from TestsInput.network_cli import EXPECTED_NETWORK_OUTPUTS
+from TestsInput.argument_schema import ARGUMENT_SCHEMAS, SCHEMA_INT_PARAMS, SCHEMA_ARGS, EXPECTED_SCHEMA_MODULE_ARGS
+from TestsInput.argument_schema import ANSIBLE_TYPE_FORMS
+from TestsInput.rate_limit import RATE_LIMIT_ARGS, RATE_LIMIT_INT_PARAMS, MOCK_RATE_LIMITED_EVENTS, MOCK_SERVER_EVENTS
+from TestsInput.rate_limit import RATE_LIMITED_MESSAGES, NOT_RATE_LIMITED_MESSAGES
+from TestsInput.pagination import PAGINATION_INT_PARAMS, MOCK_VM_INFO_EVENTS, MOCK_PACKAGE_FACTS_EVENTS
+from TestsInput.pagination import EXPECTED_PACKAGE_FACTS_PAGES
+from TestsInput.fake_runner import make_fake_run, make_fake_run_async
+from TestsInput.integration_context import MockIntegrationContext
+from TestsInput.fake_ansible import fake_ansible_modules, module_result
+from TestsInput.module_args import STRUCTURED_ARGS, STRUCTURED_INT_PARAMS, EXPECTED_STRUCTURED_MODULE_ARGS
+from TestsInput.module_args import MOCK_PLAYBOOK_EVENTS, EXPECTED_PLAYBOOK_OUTPUTS, EXPECTED_PLAYBOOK_READABLE
+from AnsibleApiModule_benchmark import run_benchmarks
+from CommonServerPython import DemistoException, EntryType
 from unittest.mock import patch
+import asyncio
+import errno
+import io
+import json
+import os
+import pytest
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List
 
 
 def test_dict2md_simple_lists():
@@ -134,23 +174,90 @@ def test_generate_ansible_inventory_creds():
     nxos_inv, nxos_sshkey = generate_ansible_inventory(
         ANSIBLE_INVENTORY_HOST_w_PORT, ANSIBLE_INVENTORY_INT_PARAMS, host_type="nxos")
     assert nxos_sshkey == 'aaaaaaaaaaaaaa'
-    assert nxos_inv.get('all').get('hosts').get('123.123.123.123:45678').get('ansible_network_os') == 'nxos'
-    assert nxos_inv.get('all').get('hosts').get('123.123.123.123:45678').get('ansible_become_method') == 'enable'
-    assert nxos_inv.get('all').get('hosts').get('123.123.123.123:45678').get('ansible_user') == 'joe'
+    assert nxos_inv.get('all').get('vars').get('ansible_network_os') == 'nxos'
+    assert nxos_inv.get('all').get('vars').get('ansible_become_method') == 'enable'
+    assert nxos_inv.get('all').get('vars').get('ansible_user') == 'joe'
 
     # B
     ssh_inv, ssh_sshkey = generate_ansible_inventory(ANSIBLE_INVENTORY_HOST_w_PORT, ANSIBLE_INVENTORY_INT_PARAMS, host_type="ssh")
     assert ssh_sshkey == 'aaaaaaaaaaaaaa'
-    assert ssh_inv.get('all').get('hosts').get('123.123.123.123:45678').get('ansible_network_os') is None
-    assert ssh_inv.get('all').get('hosts').get('123.123.123.123:45678').get('ansible_user') == 'joe'
+    assert ssh_inv.get('all').get('vars').get('ansible_network_os') is None
+    assert ssh_inv.get('all').get('vars').get('ansible_user') == 'joe'
 
     # C
     winrm_inv, winrm_sshkey = generate_ansible_inventory(
         ANSIBLE_INVENTORY_HOST_w_PORT, ANSIBLE_INVENTORY_INT_PARAMS, host_type="winrm")
     assert winrm_sshkey == ''
-    assert winrm_inv.get('all').get('hosts').get('123.123.123.123:45678').get('ansible_user') == 'joe'
-    assert winrm_inv.get('all').get('hosts').get('123.123.123.123:45678').get('ansible_winrm_transport') == 'ntlm'
-    assert winrm_inv.get('all').get('hosts').get('123.123.123.123:45678').get('ansible_connection') == 'winrm'
+    assert winrm_inv.get('all').get('vars').get('ansible_user') == 'joe'
+    assert winrm_inv.get('all').get('vars').get('ansible_winrm_transport') == 'ntlm'
+    assert winrm_inv.get('all').get('vars').get('ansible_connection') == 'winrm'
+
+    # Host entries only carry their address and port override
+    assert winrm_inv.get('all').get('hosts').get('123.123.123.123:45678') == {
+        'ansible_host': '123.123.123.123', 'ansible_port': '45678'}
+
+
+def test_generate_ansible_inventory_host_patterns():
+    """
+    Scenario: Given host ranges, CIDR blocks and repeated hosts the inventory should hold each host once
+
+    Given:
+    A. an Ansible style numeric range, an alphabetic range and a CIDR block with a port
+    B. the same host listed more than once
+    C. patterns that expand to more than the maximum number of hosts
+    D. the same host written in different cases, with the default port, and by name as well as by address
+    E. IPv6 addresses and networks, with and without a port in brackets
+
+    When:
+    - credentials are valid
+
+    Then:
+    A. Each pattern is expanded into the individual hosts, keeping padding and the port override
+    B. Duplicate hosts are only added once
+    C. An error is raised without expanding the pattern
+    D. Each host is only added once
+    E. The colons of the addresses are not taken for ports, and the same address written differently is added once
+    """
+
+    # A
+    assert list(expand_host_pattern('web[08:10].example.com')) == ['web08.example.com', 'web09.example.com',
+                                                                   'web10.example.com']
+    assert list(expand_host_pattern('rack-[a:c]')) == ['rack-a', 'rack-b', 'rack-c']
+    assert list(expand_host_pattern('10.0.0.0/30:2222')) == ['10.0.0.1:2222', '10.0.0.2:2222']
+
+    range_inv, _ = generate_ansible_inventory(ANSIBLE_INVENTORY_HOST_RANGES, ANSIBLE_INVENTORY_INT_PARAMS, host_type="ssh")
+    assert len(range_inv.get('all').get('hosts')) == 7
+    assert range_inv.get('all').get('hosts').get('10.0.0.2:2222') == {'ansible_host': '10.0.0.2', 'ansible_port': '2222'}
+    assert range_inv.get('all').get('vars').get('ansible_port') == 22
+
+    # B
+    dup_inv, _ = generate_ansible_inventory(ANSIBLE_INVENTORY_HOST_DUPLICATES, ANSIBLE_INVENTORY_INT_PARAMS, host_type="ssh")
+    assert list(dup_inv.get('all').get('hosts')) == ['123.123.123.123', 'host.example.com']
+
+    # C
+    with pytest.raises(ValueError, match="expands to 16777214 hosts"):
+        next(expand_host_pattern('10.0.0.0/8'))
+    with pytest.raises(ValueError, match="expands to 1000000 hosts"):
+        generate_ansible_inventory({'host': 'web[1:1000]-[1:1000]'}, ANSIBLE_INVENTORY_INT_PARAMS, host_type="ssh")
+
+    # D
+    addresses = {'web1.example.com': '10.0.0.9', 'db.example.com': '10.0.0.1'}
+    resolve_host.cache_clear()
+    with patch('socket.getaddrinfo', side_effect=lambda host, port: [(None, None, None, '', (addresses[host], 0))]):
+        norm_inv, _ = generate_ansible_inventory(
+            {'host': 'WEB1.example.com, web1.example.com., web1.example.com:22, db.example.com, 10.0.0.1'},
+            ANSIBLE_INVENTORY_INT_PARAMS, host_type="ssh")
+    resolve_host.cache_clear()
+    assert list(norm_inv.get('all').get('hosts')) == ['WEB1.example.com', '10.0.0.1']
+
+    # E
+    assert list(expand_host_pattern('2001:db8::/126')) == ['2001:db8::1', '2001:db8::2', '2001:db8::3']
+    assert list(expand_host_pattern('[2001:db8::/127]:2222')) == ['[2001:db8::]:2222', '[2001:db8::1]:2222']
+    v6_inv, _ = generate_ansible_inventory({'host': '2001:db8::1, 2001:DB8:0::1, [2001:db8::2]:2222, [2001:db8::3]'},
+                                           ANSIBLE_INVENTORY_INT_PARAMS, host_type="ssh")
+    assert v6_inv.get('all').get('hosts') == {'2001:db8::1': {'ansible_host': '2001:db8::1'},
+                                              '[2001:db8::2]:2222': {'ansible_host': '2001:db8::2', 'ansible_port': '2222'},
+                                              '2001:db8::3': {'ansible_host': '2001:db8::3'}}
 
 
 class Object(object):
@@ -172,6 +279,7 @@ def test_generic_ansible():
 
     Then:
     - Valid context/readable output
+    - With timing="Yes", the stage and per host durations are also returned under the Timing key, keyed by run ID
     """
 
     # Inputs
@@ -210,3 +318,1131 @@ def test_generic_ansible():
 
         assert CommandResults.readable_output == expected_readable
         assert CommandResults.outputs == expected_outputs
+
+    # With timing requested the stage durations are returned under the Timing key
+    args['timing'] = 'Yes'
+    with patch('ansible_runner.run', return_value=mock_ansible_results) as mock_run:
+        CommandResults, TimingResults = generic_ansible('microsoftwindows', 'win_audit_policy_system', args, int_params,
+                                                        host_type)
+
+        # winrm hosts are not pinged first, ping would be an extra task on every host
+        tasks = mock_run.call_args.kwargs['playbook'][0]['tasks']
+        assert len(tasks) == 1
+        assert tasks[0]['win_audit_policy_system'] == {'subcategory': 'File System', 'audit_type': 'failure'}
+        assert CommandResults.outputs == expected_outputs
+        assert TimingResults.outputs_prefix == 'microsoftwindows.Timing'
+        assert TimingResults.outputs_key_field == 'run_id'
+        assert len(TimingResults.outputs['run_id']) == 32
+        assert TimingResults.outputs['module'] == 'win_audit_policy_system'
+        assert {'inventory', 'runner', 'parse', 'normalise', 'markdown', 'execute'} <= set(TimingResults.outputs['stages'])
+        assert TimingResults.outputs['hosts'] == [{'host': '123.123.123.123', 'duration': 2923.9}]
+
+
+def test_generic_ansible_async_job():
+    """
+    Scenario: Given the async arg, the module should be started in the background and polled with the job status command
+
+    Given:
+    - valid host args for two linux hosts
+    - args async="Yes" async_timeout="600"
+
+    When:
+    A. the module is launched
+    B. the job status is checked while one host is still running, with polling enabled
+    C. the job status is checked after both hosts finished
+    D. the job status is checked of another job, that failed on its host
+    E. the module is launched on an IOS device
+
+    Then:
+    A. Ansible is run with poll=0 and a job ID is returned right away
+    B. The job is reported as running and the status command is rescheduled
+    C. The module results are returned as if the module had run in the foreground, and the job is forgotten
+    D. The failure is raised, and the job is forgotten so later polls don't fail the same way
+    E. The command fails before Ansible is run, as network_cli modules can't run in the background
+    """
+    with MockIntegrationContext().patch() as integration_context:
+
+        # A
+        mock_ansible_results = Object()
+        mock_ansible_results.events = MOCK_ASYNC_START_EVENTS
+        with patch('ansible_runner.run', return_value=mock_ansible_results) as mock_run:
+            start_results = generic_ansible('linux', 'apt', ASYNC_ARGS, ASYNC_INT_PARAMS, 'ssh')
+
+        task = mock_run.call_args.kwargs['playbook'][0]['tasks'][0]
+        assert (task['async'], task['poll']) == (600, 0)
+        assert task['apt'] == {'name': 'nginx', 'state': 'latest'}
+        job_id = start_results.outputs['job_id']
+        assert start_results.outputs['status'] == 'running'
+        assert integration_context.data['ansible_jobs'][job_id]['hosts'] == {'123.123.123.123': '11111.1',
+                                                                       '123.123.123.124': '22222.2'}
+
+        # B
+        mock_ansible_results.events = MOCK_ASYNC_RUNNING_EVENTS
+        with patch('ansible_runner.run', return_value=mock_ansible_results) as mock_run:
+            running_results = generic_ansible_job_status('linux', {'job_id': job_id, 'polling': 'Yes'},
+                                                         ASYNC_INT_PARAMS, 'ssh')
+
+        inventory = mock_run.call_args.kwargs['inventory']
+        assert inventory['all']['hosts']['123.123.123.124']['async_jid'] == '22222.2'
+        assert running_results.outputs['pending_hosts'] == ['123.123.123.124']
+        assert running_results.scheduled_command is not None
+
+        # C
+        mock_ansible_results.events = MOCK_ASYNC_FINISHED_EVENTS
+        with patch('ansible_runner.run', return_value=mock_ansible_results):
+            job_results, module_results = generic_ansible_job_status('linux', {'job_id': job_id}, ASYNC_INT_PARAMS, 'ssh')
+
+        assert job_results.outputs['status'] == 'finished'
+        assert module_results.outputs_prefix == 'linux.apt'
+        assert module_results.outputs == EXPECTED_ASYNC_OUTPUTS
+        assert job_id not in integration_context.data['ansible_jobs']
+
+        # D
+        mock_ansible_results.events = MOCK_ASYNC_START_EVENTS
+        with patch('ansible_runner.run', return_value=mock_ansible_results):
+            failed_job_id = generic_ansible('linux', 'apt', ASYNC_ARGS, ASYNC_INT_PARAMS, 'ssh').outputs['job_id']
+        mock_ansible_results.events = MOCK_ASYNC_FAILED_EVENTS
+        with patch('ansible_runner.run', return_value=mock_ansible_results):
+            with pytest.raises(DemistoException, match="No package matching"):
+                generic_ansible_job_status('linux', {'job_id': failed_job_id}, ASYNC_INT_PARAMS, 'ssh')
+        assert failed_job_id not in integration_context.data['ansible_jobs']
+
+        # E
+        with patch('ansible_runner.run') as mock_run:
+            with pytest.raises(ValueError, match="async is not supported for ios devices"):
+                generic_ansible('cisco', 'ios_command', dict(ASYNC_ARGS, commands='show version'), ASYNC_INT_PARAMS, 'ios')
+        mock_run.assert_not_called()
+
+
+def test_generic_ansible_batch():
+    """
+    Scenario: Given several module executions, they should run concurrently within the concurrency limit
+
+    Given:
+    - four executions of the same module against different hosts
+    - a concurrency limit of 2
+
+    When:
+    - ansible_runner.run_async runs each execution in its own thread
+
+    Then:
+    - No more than 2 runs are in flight at once, and more than 1 run was in flight at some point
+    - The CommandResults match the ones returned by the sync generic_ansible, in order
+    - An execution against an unreachable host returns an error entry, without failing the others
+    """
+    in_flight = []
+    max_in_flight = []
+    lock = threading.Lock()
+
+    def fake_run_async(**kwargs):
+        host = list(kwargs['inventory']['all']['hosts'])[0]
+        runner = Object()
+        runner.events = [{'event': 'runner_on_ok',
+                          'stdout': '%s | SUCCESS => {\r\n    "changed": false,\r\n    "ping": "pong"\r\n}' % host}]
+        if host == 'unreachable.example.com':
+            runner.events = [{'event': 'runner_on_unreachable', 'stdout': '', 'event_data': {'host': host, 'res': {
+                'unreachable': True, 'msg': 'Failed to connect to the host via ssh'}}}]
+
+        def run():
+            with lock:
+                in_flight.append(host)
+                max_in_flight.append(len(in_flight))
+            time.sleep(0.05)
+            with lock:
+                in_flight.remove(host)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread, runner
+
+    int_params = {'port': 22, 'creds': {'identifier': 'bill', 'password': 'xyz321', 'credentials': {}}}
+    executions = [('ping', {'host': '10.0.0.%d' % i}) for i in range(1, 5)]
+
+    with patch('ansible_runner.run_async', side_effect=fake_run_async):
+        batch_results = asyncio.run(generic_ansible_batch('linux', executions + [('ping', {'host': 'unreachable.example.com'})],
+                                                          int_params, 'ssh', max_concurrency=2))
+
+    assert 1 < max(max_in_flight) <= 2
+    error_result = batch_results.pop()
+    assert error_result.entry_type == EntryType.ERROR
+    assert "Host unreachable.example.com unreachable" in error_result.readable_output
+
+    for (command, args), async_results in zip(executions, batch_results):
+        _, mock_ansible_results = fake_run_async(inventory={'all': {'hosts': {args['host']: {}}}})
+        with patch('ansible_runner.run', return_value=mock_ansible_results):
+            sync_results = generic_ansible('linux', command, args, int_params, 'ssh')
+
+        assert async_results.readable_output == sync_results.readable_output
+        assert async_results.outputs == sync_results.outputs
+
+
+def test_private_data_dir_management(tmp_path):
+    """
+    Scenario: Runner private data dirs should be removed after use, or rotated when kept for debugging
+
+    Given:
+    A. default integration params
+    B. keep_artifacts enabled with a max count of 2 kept runs
+    C. kept runs of different ages and sizes
+
+    When:
+    - a module is run, or the kept artifacts are rotated
+
+    Then:
+    A. The private data dir is created under the artifact dir and removed once the results are parsed
+    B. Only the 2 most recent private data dirs are kept
+    C. Runs older than the max age, or beyond the max total size, are removed
+    """
+    args = {'host': "123.123.123.123"}
+    int_params = {'port': 22, 'artifact_dir': str(tmp_path / 'A'),
+                  'creds': {'identifier': 'bill', 'password': 'xyz321', 'credentials': {}}}
+    mock_ansible_results = Object()
+    mock_ansible_results.events = []
+
+    # A
+    with patch('ansible_runner.run', return_value=mock_ansible_results) as mock_run:
+        generic_ansible('linux', 'ping', args, int_params, 'ssh')
+    private_data_dir = mock_run.call_args.kwargs['private_data_dir']
+    assert os.path.dirname(private_data_dir) == str(tmp_path / 'A')
+    assert not os.path.exists(private_data_dir)
+
+    # B
+    int_params.update({'artifact_dir': str(tmp_path / 'B'), 'keep_artifacts': True, 'artifact_max_count': '2'})
+    kept = []
+    for _ in range(3):
+        with patch('ansible_runner.run', return_value=mock_ansible_results) as mock_run:
+            generic_ansible('linux', 'ping', args, int_params, 'ssh')
+        kept.append(mock_run.call_args.kwargs['private_data_dir'])
+        # make sure the runs have distinct modification times
+        os.utime(kept[-1], (time.time() - 10 + len(kept), time.time() - 10 + len(kept)))
+    assert sorted(os.listdir(tmp_path / 'B')) == sorted(os.path.basename(path) for path in kept[1:])
+
+    # C
+    base_dir = tmp_path / 'C'
+    for name, age_hours, size in [('ansible-new', 0, 600 * 1024), ('ansible-mid', 1, 600 * 1024), ('ansible-old', 5, 10)]:
+        (base_dir / name).mkdir(parents=True)
+        (base_dir / name / 'stdout').write_bytes(b'x' * size)
+        mtime = time.time() - age_hours * 3600
+        os.utime(base_dir / name, (mtime, mtime))
+
+    rotate_artifacts(str(base_dir), max_age=2)
+    assert sorted(os.listdir(base_dir)) == ['ansible-mid', 'ansible-new']
+
+    rotate_artifacts(str(base_dir), max_size=1)
+    assert os.listdir(base_dir) == ['ansible-new']
+
+
+def test_fake_runner_benchmark():
+    """
+    Scenario: The benchmark stand-in for ansible_runner.run should replay event streams generic_ansible can parse
+
+    Given:
+    - 5 linux hosts
+    - synthetic results of 10 values nested 3 levels deep
+
+    When:
+    A. generic_ansible is run against the fake runner
+    B. the benchmarks are run for 1 and 5 hosts
+    C. the benchmarks are run with hosts that fail
+
+    Then:
+    A. A result is returned for every host, with the ansible_ prefix stripped
+    B. Every stage reports latency, throughput and peak memory for each host count
+    C. The runs that end with the host error are reported as separate stages
+    """
+
+    # A
+    args = {'host': ['10.0.0.%d' % i for i in range(1, 6)]}
+    int_params = {'port': 22, 'creds': {'identifier': 'bill', 'password': 'xyz321', 'credentials': {}}}
+    with patch('ansible_runner.run', side_effect=make_fake_run(payload_size=10, depth=3)):
+        results = generic_ansible('linux', 'ping', args, int_params, 'ssh')
+
+    assert [result['host'] for result in results.outputs] == args['host']
+    assert 'key_0_0' in results.outputs[0]
+    assert 'key_2_0' in results.outputs[0]['nested']['nested']
+
+    # B
+    report = run_benchmarks([1, 5], payload_size=10, depth=3, repeat=1)
+    assert set(report['results']) == {'1', '5'}
+    for stages in report['results'].values():
+        assert set(stages) == {'inventory', 'parse', 'normalise', 'markdown', 'delta', 'end_to_end'}
+        for result in stages.values():
+            assert set(result) == {'median_ms', 'p95_ms', 'peak_kb', 'hosts_per_sec'}
+
+    # C
+    report = run_benchmarks([5], payload_size=10, depth=3, failure_rate=0.5, repeat=1)
+    assert set(report['results']['5']) == {'inventory', 'parse_failed', 'normalise', 'markdown', 'delta',
+                                           'end_to_end_failed'}
+
+
+def test_structured_module_args():
+    """
+    Scenario: Module args should be passed to Ansible as structured data in a generated playbook
+
+    Given:
+    - args holding quotes, a list, a dict, jinja syntax and a multi-KB value
+    - local integration params, only some of which are accepted by the module
+
+    When:
+    A. the module args are built
+    B. the module is run and ansible-runner returns playbook events with the result in the event data
+
+    Then:
+    A. Values are passed through unchanged, jinja syntax is escaped, and params the module doesn't accept are left out
+    B. The results are parsed from the event data, without Ansible internal keys
+    """
+
+    # A
+    with patch('AnsibleApiModule.module_options', return_value=frozenset(['api_token', 'endpoint', 'name', 'labels'])):
+        module_args = build_module_args(STRUCTURED_ARGS, STRUCTURED_INT_PARAMS, 'local', 'hcloud_server')
+    assert module_args == EXPECTED_STRUCTURED_MODULE_ARGS
+
+    # B
+    mock_ansible_results = Object()
+    mock_ansible_results.events = MOCK_PLAYBOOK_EVENTS
+    with patch('AnsibleApiModule.module_options', return_value=None), \
+            patch('ansible_runner.run', return_value=mock_ansible_results) as mock_run:
+        results = generic_ansible('hcloud', 'hcloud_server', STRUCTURED_ARGS, STRUCTURED_INT_PARAMS, 'local')
+
+    playbook = mock_run.call_args.kwargs['playbook']
+    assert playbook[0]['hosts'] == 'all'
+    assert playbook[0]['tasks'][0]['hcloud_server']['user_data'] == EXPECTED_STRUCTURED_MODULE_ARGS['user_data']
+    assert results.outputs == EXPECTED_PLAYBOOK_OUTPUTS
+    assert results.readable_output == EXPECTED_PLAYBOOK_READABLE
+
+
+def test_ssh_agent_reuse(tmp_path):
+    """
+    Scenario: SSH keys should be loaded into an ssh-agent of their own once, rather than on every command
+
+    Given:
+    - A private key saved in the credential manager, and the private key of another integration instance
+
+    When:
+    A. a command using the key is run for the first time in the container
+    B. another command using the same key is run, with the key pasted with Windows line endings
+    C. the module is run with the key while ssh-agent can't be used
+    D. a command using the other key is run
+
+    Then:
+    A. An agent named by the hash of the key is started, and only the key is loaded into it for a limited time
+    B. The same agent is used, and the key is neither loaded again nor written to disk
+    C. The key is handed to ansible-runner as before
+    D. The other key gets an agent of its own, so neither instance can use the key of the other
+    """
+    if not shutil.which('ssh-agent') or not shutil.which('ssh-keygen'):
+        pytest.skip("OpenSSH client tools are not installed")
+
+    def load_key(name: str) -> str:
+        subprocess.run(['ssh-keygen', '-q', '-t', 'ed25519', '-N', '', '-f', str(tmp_path / name)], check=True)
+        return (tmp_path / name).read_text()
+
+    def loaded_fingerprints(envvars: Dict[str, str]) -> List[str]:
+        loaded = subprocess.run(['ssh-add', '-l', '-E', 'sha256'], env=dict(os.environ, **envvars),
+                                stdout=subprocess.PIPE, universal_newlines=True).stdout
+        return [line.split()[1] for line in loaded.splitlines()]
+
+    def fingerprint(name: str) -> str:
+        return subprocess.run(['ssh-keygen', '-l', '-E', 'sha256', '-f', str(tmp_path / (name + '.pub'))],
+                              stdout=subprocess.PIPE, universal_newlines=True).stdout.split()[1]
+
+    sshkey = load_key('id')
+    other_sshkey = load_key('other_id')
+    agent_pids = []
+
+    try:
+        # A
+        with patch('subprocess.run', wraps=subprocess.run) as mock_run:
+            envvars = ssh_agent_env(sshkey, str(tmp_path))
+        key_id = re.match(r'ansible-ssh-agent-([0-9a-f]{16})\.sock$', os.path.basename(envvars['SSH_AUTH_SOCK'])).group(1)
+        state = json.loads((tmp_path / (SSH_AGENT_STATE % key_id)).read_text())
+        agent_pids.append(state['pid'])
+        assert os.path.dirname(envvars['SSH_AUTH_SOCK']) == str(tmp_path)
+        assert ['ssh-add', '-t', '3600', '-'] in [call.args[0] for call in mock_run.call_args_list]
+        assert loaded_fingerprints(envvars) == [fingerprint('id')]
+
+        # B
+        files = set(tmp_path.iterdir())
+        with patch('subprocess.run', wraps=subprocess.run) as mock_run:
+            assert ssh_agent_env(sshkey.replace('\n', '\r\n') + '\n', str(tmp_path)) == envvars
+        assert [call.args[0] for call in mock_run.call_args_list] == [['ssh-add', '-l']]
+        assert json.loads((tmp_path / (SSH_AGENT_STATE % key_id)).read_text()) == state
+        assert set(tmp_path.iterdir()) == files
+
+        # D
+        other_envvars = ssh_agent_env(other_sshkey, str(tmp_path))
+        other_key_id = re.search(r'([0-9a-f]{16})\.sock$', other_envvars['SSH_AUTH_SOCK']).group(1)
+        agent_pids.append(json.loads((tmp_path / (SSH_AGENT_STATE % other_key_id)).read_text())['pid'])
+        assert other_envvars != envvars
+        assert loaded_fingerprints(other_envvars) == [fingerprint('other_id')]
+        assert loaded_fingerprints(envvars) == [fingerprint('id')]
+    finally:
+        for pid in agent_pids:
+            os.kill(pid, signal.SIGTERM)
+
+    # C
+    int_params = {'port': 22, 'creds': {'credentials': {'user': 'joe', 'sshkey': sshkey}}}
+    with patch('AnsibleApiModule.ssh_agent_env', return_value=None), \
+            patch('ansible_runner.run', side_effect=make_fake_run()) as mock_run:
+        generic_ansible('linux', 'ping', {'host': '10.0.0.1'}, int_params, 'ssh')
+    assert mock_run.call_args.kwargs['ssh_key'] == sshkey
+    assert 'envvars' not in mock_run.call_args.kwargs
+
+
+def test_generic_ansible_delta():
+    """
+    Scenario: In delta mode only the hosts and fields that changed since the last run should be output
+
+    Given:
+    - setup facts of three hosts, run with delta Yes
+
+    When:
+    A. the module is run for the first time
+    B. the module is run again, with one host unchanged, one changed, one left out of the run and one new
+    C. the module is run again with the same results
+    D. the module is run with other module args
+    E. the host left out of B is run on its own with the same results
+    F. another command writes to the integration context while the delta is being stored
+    G. the module is run a month later, and then with more args than the number of digests kept
+
+    Then:
+    A. All hosts are output as new, and their digests are stored in the integration context
+    B. Only the changed fields of the changed host and the new host are output, the host left out keeps its digests
+    C. Nothing is output
+    D. The run is compared to its own digests, so all hosts are output as new
+    E. The host is unchanged, as the other runs didn't affect it
+    F. The delta is stored again on top of the other command's write, keeping both
+    G. The digests of the args not run for a month are dropped, and then those of the least recently run args
+    """
+    integration_context = MockIntegrationContext()
+
+    def run(args, facts):
+        mock_ansible_results = Object()
+        mock_ansible_results.events = facts_events(facts)
+        with integration_context.patch(), patch('ansible_runner.run', return_value=mock_ansible_results):
+            return generic_ansible('linux', 'setup_facts', args, DELTA_INT_PARAMS, 'ssh')
+
+    # A
+    results = run(DELTA_ARGS, MOCK_FIRST_RUN_FACTS)
+    assert [result['delta'] for result in results.outputs] == ['new', 'new', 'new']
+    assert results.outputs[0]['hostname'] == 'web1'
+    assert results.readable_output.startswith("Delta since the last run: 3 new, 0 changed, 0 unchanged")
+    state = next(iter(integration_context.data['ansible_delta'].values()))
+    assert set(state['hosts']) == set(MOCK_FIRST_RUN_FACTS)
+    # One packed string of digests per host, with the field names stored once
+    assert all(isinstance(packed, str) for packed in state['hosts'].values())
+    assert 'swaptotal_mb' in state['fields']
+
+    # B
+    results = run(DELTA_SECOND_ARGS, MOCK_SECOND_RUN_FACTS)
+    assert results.outputs == EXPECTED_DELTA_OUTPUTS
+    assert results.readable_output.startswith("Delta since the last run: 1 new, 1 changed, 1 unchanged")
+    assert "10.0.0.1" not in results.readable_output
+    assert "10.0.0.3" not in results.readable_output
+
+    # C
+    version = integration_context.version
+    results = run(DELTA_SECOND_ARGS, MOCK_SECOND_RUN_FACTS)
+    assert results.outputs == []
+    assert integration_context.version == version  # Nothing changed, so the context is not written
+
+    # D
+    results = run(dict(DELTA_SECOND_ARGS, gather_subset='all'), MOCK_SECOND_RUN_FACTS)
+    assert [result['delta'] for result in results.outputs] == ['new', 'new', 'new']
+    assert len(integration_context.data['ansible_delta']) == 2
+
+    # E
+    results = run(dict(DELTA_ARGS, host='10.0.0.3'), {'10.0.0.3': MOCK_FIRST_RUN_FACTS['10.0.0.3']})
+    assert results.outputs == []
+    assert results.readable_output.startswith("Delta since the last run: 0 new, 0 changed, 1 unchanged")
+
+    # F
+    get_with_version = integration_context.get_with_version
+
+    def concurrent_write():
+        context, version = get_with_version()
+        if 'other' not in integration_context.data:
+            integration_context.set(dict(context, other='value'))
+        return context, version
+
+    integration_context.get_with_version = concurrent_write
+    results = run(dict(DELTA_ARGS, host='10.0.0.5'), {'10.0.0.5': MOCK_FIRST_RUN_FACTS['10.0.0.3']})
+    assert results.outputs[0]['delta'] == 'new'
+    assert integration_context.data['other'] == 'value'
+    assert any('10.0.0.5' in state['hosts'] for state in integration_context.data['ansible_delta'].values())
+
+    # G
+    integration_context.get_with_version = get_with_version
+    with patch('AnsibleApiModule.time.time', return_value=time.time() + 31 * 24 * 3600):
+        run(dict(DELTA_ARGS, host='10.0.0.6'), {'10.0.0.6': MOCK_FIRST_RUN_FACTS['10.0.0.3']})
+    assert len(integration_context.data['ansible_delta']) == 1
+
+    with patch('AnsibleApiModule.MAX_DELTA_KEYS', 2):
+        for index in range(3):
+            with patch('AnsibleApiModule.time.time', return_value=time.time() + (32 + index) * 24 * 3600):
+                run(dict(DELTA_ARGS, gather_subset=str(index)), MOCK_FIRST_RUN_FACTS)
+    assert sorted(integration_context.data['ansible_delta']) == sorted(
+        delta_key('linux', 'setup_facts', dict(DELTA_ARGS, gather_subset=str(index))) for index in [1, 2])
+
+
+def test_generic_ansible_precheck():
+    """
+    Scenario: With precheck Yes, hosts that don't accept a TCP connection should be skipped
+
+    Given:
+    - A local port that is listening, and one that is not
+
+    When:
+    A. the module is run against both with precheck Yes
+    B. the module is run with generic_ansible_async
+    C. the module is run against only the port that is not listening
+    D. the module is run from a running event loop
+    E. hosts are probed with errors that do and don't mean the host is down, with a concurrency of 2
+
+    Then:
+    A. Only the listening host is passed to ansible-runner, and the other is reported as unreachable
+    B. The same results are returned
+    C. The command fails without running ansible-runner
+    D. The same results are returned
+    E. Only the refused, timed out and unroutable hosts are removed, and no more than 2 are probed at once
+    """
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen()
+    closed = socket.socket()
+    closed.bind(('127.0.0.1', 0))
+    closed_port = closed.getsockname()[1]
+    closed.close()
+
+    live_host = '127.0.0.1:%d' % listener.getsockname()[1]
+    dead_host = '127.0.0.1:%d' % closed_port
+    args = {'host': [live_host, dead_host], 'precheck': 'Yes', 'precheck_timeout': '1'}
+    int_params = {'port': 22, 'creds': {'identifier': 'bill', 'password': 'xyz321', 'credentials': {}}}
+
+    try:
+        # A
+        with patch('ansible_runner.run', side_effect=make_fake_run()) as mock_run:
+            results = generic_ansible('linux', 'ping', args, int_params, 'ssh')
+        assert list(mock_run.call_args.kwargs['inventory']['all']['hosts']) == [live_host]
+        assert [(result['host'], result['status']) for result in results.outputs] == [(live_host, 'SUCCESS'),
+                                                                                        (dead_host, 'UNREACHABLE')]
+        assert results.outputs[1]['unreachable'] is True
+        assert "# %s - UNREACHABLE" % dead_host in results.readable_output
+
+        # B
+        with patch('ansible_runner.run_async', side_effect=make_fake_run_async()):
+            async_results = asyncio.run(generic_ansible_async('linux', 'ping', args, int_params, 'ssh'))
+        assert async_results.outputs == results.outputs
+
+        # C
+        with patch('ansible_runner.run') as mock_run, \
+                pytest.raises(DemistoException, match="^All hosts are unreachable: %s$" % dead_host):
+            generic_ansible('linux', 'ping', dict(args, host=dead_host), int_params, 'ssh')
+        mock_run.assert_not_called()
+
+        # D
+        async def run_in_loop():
+            return generic_ansible('linux', 'ping', args, int_params, 'ssh')
+
+        with patch('ansible_runner.run', side_effect=make_fake_run()):
+            loop_results = asyncio.run(run_in_loop())
+        assert loop_results.outputs == results.outputs
+    finally:
+        listener.close()
+
+    # E
+    probe_errors = {'10.0.0.1': None, '10.0.0.2': ConnectionRefusedError(), '10.0.0.3': asyncio.TimeoutError(),
+                    '10.0.0.4': OSError(errno.EHOSTUNREACH, 'No route to host'),
+                    '10.0.0.5': OSError(errno.EMFILE, 'Too many open files'), '10.0.0.6': PermissionError()}
+    in_flight = []
+    max_in_flight = []
+
+    async def open_connection(address, port):
+        in_flight.append(address)
+        max_in_flight.append(len(in_flight))
+        await asyncio.sleep(0.01)
+        in_flight.remove(address)
+        if probe_errors[address] is not None:
+            raise probe_errors[address]
+        writer = Object()
+        writer.close = lambda: None
+        return None, writer
+
+    with patch('asyncio.open_connection', side_effect=open_connection), \
+            patch('AnsibleApiModule.PRECHECK_CONCURRENCY', 2), \
+            patch('ansible_runner.run', side_effect=make_fake_run()) as mock_run:
+        generic_ansible('linux', 'ping', dict(args, host=list(probe_errors)), int_params, 'ssh')
+    assert list(mock_run.call_args.kwargs['inventory']['all']['hosts']) == ['10.0.0.1', '10.0.0.5', '10.0.0.6']
+    assert max(max_in_flight) == 2
+
+
+def test_generic_ansible_timeouts():
+    """
+    Scenario: Hosts that run out of time should be reported as timed out, along with the results of the other hosts
+
+    Given:
+    - Three hosts
+
+    When:
+    A. the module is run with a host_timeout, and Ansible fails one host as it took too long
+    B. the module is run against network devices with a host_timeout
+    C. the module is run with a deadline, and one host hangs
+    D. a module with an action plugin that can't run async, and one with an action plugin that can, are run with a
+       host_timeout
+
+    Then:
+    A. The module is run async and polled, the host that took too long is reported as TIMEOUT, and the
+       async_status bookkeeping is dropped from the other host
+    B. The timeout is set as the persistent connection command timeout instead
+    C. The run is cancelled by its cancel callback, and the hung and unstarted hosts are reported as TIMEOUT
+    D. The first fails before Ansible is run, pointing at deadline instead, and the second is run async
+    """
+    # A
+    mock_ansible_results = Object()
+    mock_ansible_results.events = MOCK_HOST_TIMEOUT_EVENTS
+    with patch('ansible_runner.run', return_value=mock_ansible_results) as mock_run:
+        results = generic_ansible('linux', 'command', {'host': '10.0.0.1, 10.0.0.2', 'host_timeout': '5'},
+                                  TIMEOUT_INT_PARAMS, 'ssh')
+    task = mock_run.call_args.kwargs['playbook'][0]['tasks'][0]
+    assert (task['async'], task['poll']) == (5, 1)
+    assert [(result['host'], result['status']) for result in results.outputs] == [('10.0.0.1', 'SUCCESS'),
+                                                                                    ('10.0.0.2', 'TIMEOUT')]
+    assert results.readable_output.startswith("Timed out hosts: 10.0.0.2\n")
+    assert not {'job_id', 'finished', 'started', 'results_file'} & set(results.outputs[0])
+    assert results.outputs[0]['stdout'] == 'up'
+
+    # B
+    with patch('ansible_runner.run', return_value=mock_ansible_results) as mock_run:
+        generic_ansible('ios', 'ios_command', {'host': '10.0.0.1', 'host_timeout': '5'}, TIMEOUT_INT_PARAMS, 'ios')
+    assert mock_run.call_args.kwargs['inventory']['all']['vars']['ansible_command_timeout'] == 5
+    assert 'async' not in mock_run.call_args.kwargs['playbook'][0]['tasks'][0]
+
+    # C
+    cancel_results = []
+
+    def hung_run(**kwargs):
+        # Bounded, so a callback that never cancels fails the test rather than hanging it
+        for _ in range(500):
+            cancel_results.append(kwargs['cancel_callback']())
+            if cancel_results[-1]:
+                break
+            time.sleep(0.01)
+        runner = Object()
+        runner.status = 'canceled'
+        runner.events = MOCK_DEADLINE_EVENTS
+        return runner
+
+    with patch('ansible_runner.run', side_effect=hung_run):
+        results = generic_ansible('linux', 'command', {'host': '10.0.0.1, 10.0.0.2, 10.0.0.3', 'deadline': '1'},
+                                  TIMEOUT_INT_PARAMS, 'ssh')
+    assert cancel_results[0] is False
+    assert cancel_results[-1] is True
+    assert results.outputs == EXPECTED_DEADLINE_OUTPUTS
+    assert results.readable_output.startswith("Timed out hosts: 10.0.0.2, 10.0.0.3\n")
+
+    # D
+    fake_modules = fake_ansible_modules(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'TestsInput', 'modules'))
+    fake_modules['ansible.plugins.loader'].action_loader.has_plugin = lambda name: name in ['copy', 'command']
+    with patch.dict(sys.modules, fake_modules), patch('ansible_runner.run', return_value=mock_ansible_results) as mock_run:
+        with pytest.raises(ValueError, match="copy can't be run with async or host_timeout.*Use deadline"):
+            generic_ansible('linux', 'copy', {'host': '10.0.0.1', 'host_timeout': '5', 'src': 'a', 'dest': 'b'},
+                            TIMEOUT_INT_PARAMS, 'ssh')
+        mock_run.assert_not_called()
+
+        generic_ansible('linux', 'command', {'host': '10.0.0.1', 'host_timeout': '5'}, TIMEOUT_INT_PARAMS, 'ssh')
+    assert mock_run.call_args.kwargs['playbook'][0]['tasks'][0]['async'] == 5
+
+
+def test_persistent_network_connections(tmp_path):
+    """
+    Scenario: ios and nxos connections should use Ansible's persistent connection settings, with connect and
+    execute time reported
+
+    Given:
+    - An ios integration with the connect and command timeouts set
+
+    When:
+    - A module is run with timing Yes
+
+    Then:
+    - The connect timeout is set as an inventory var, and the socket dir and command timeout as Ansible settings.
+      The persistent connect timeout is left at Ansible's default, so a dead device fails quickly.
+      The device is connected to in a task of its own, and its connect and execute time are reported separately
+    """
+    int_params = dict(NETWORK_INT_PARAMS, persistent_control_path_dir=str(tmp_path / 'pc'))
+    mock_ansible_results = Object()
+    mock_ansible_results.events = MOCK_NETWORK_EVENTS
+    with patch('ansible_runner.run', return_value=mock_ansible_results) as mock_run:
+        results, timing_results = generic_ansible('ios', 'ios_command', NETWORK_ARGS, int_params, 'ios')
+
+    kwargs = mock_run.call_args.kwargs
+    assert kwargs['inventory']['all']['vars'] == EXPECTED_NETWORK_VARS
+    assert kwargs['envvars'] == {'ANSIBLE_PERSISTENT_CONTROL_PATH_DIR': str(tmp_path / 'pc'),
+                                 'ANSIBLE_PERSISTENT_COMMAND_TIMEOUT': '60'}
+    assert oct(os.stat(tmp_path / 'pc').st_mode & 0o777) == '0o700'
+
+    tasks = kwargs['playbook'][0]['tasks']
+    assert tasks[0] == {'name': 'connect', 'cli_command': {'command': 'show clock'}}
+    assert tasks[1]['ios_command'] == {'commands': ['show version']}
+    assert results.outputs == EXPECTED_NETWORK_OUTPUTS
+    assert timing_results.outputs['hosts'] == [{'host': '10.1.1.1', 'duration': 1500.0, 'connect': 4000.0}]
+    assert timing_results.outputs['stages']['connect'] == 4000.0
+
+
+def test_argument_schema_validation():
+    """
+    Scenario: Module args should be validated and coerced against the generated argument schema before anything is run
+
+    Given:
+    - The argument schema of a local module, loaded once
+
+    When:
+    A. the module is run with valid args given as XSOAR strings
+    B. a required arg is missing
+    C. an arg is not one of its choices
+    D. an arg doesn't match its type
+    E. bool and dict args are given in the other forms Ansible accepts
+    F. an arg is given under an alias of its option
+
+    Then:
+    A. The args are coerced to their types, and only the integration params in the schema are passed to the module
+    B. C. D. The command fails with an error naming the arg, without ansible-runner being started
+    E. The args are coerced the same as Ansible would
+    F. The arg is checked and coerced as its option, and passed under the alias
+    """
+    with patch.dict('AnsibleApiModule.ARGUMENT_SCHEMAS'):
+        load_argument_schemas(ARGUMENT_SCHEMAS)
+
+        # A
+        with patch('AnsibleApiModule.module_options') as mock_module_options, \
+                patch('ansible_runner.run', side_effect=make_fake_run()) as mock_run:
+            generic_ansible('hcloud', 'hcloud_server', SCHEMA_ARGS, SCHEMA_INT_PARAMS, 'local')
+        assert mock_run.call_args.kwargs['playbook'][0]['tasks'][0]['hcloud_server'] == EXPECTED_SCHEMA_MODULE_ARGS
+        mock_module_options.assert_not_called()
+
+        invalid_calls = [
+            ({'state': 'present'}, {}, "Missing required arguments: api_token, name"),     # B
+            (dict(SCHEMA_ARGS, state='running'), SCHEMA_INT_PARAMS, "Invalid value for state: running"),   # C
+            (dict(SCHEMA_ARGS, image_id='ubuntu'), SCHEMA_INT_PARAMS, "Invalid value for image_id, expected int"),  # D
+            (dict(SCHEMA_ARGS, backups='maybe'), SCHEMA_INT_PARAMS, "Invalid value for backups, expected bool"),
+            (dict(SCHEMA_ARGS, backups='2'), SCHEMA_INT_PARAMS, "Invalid value for backups, expected bool"),
+            (dict(SCHEMA_ARGS, labels='prod'), SCHEMA_INT_PARAMS, "Invalid value for labels, expected dict"),
+            ({'server_name': 'web1', 'image': 'ubuntu'}, SCHEMA_INT_PARAMS, "Invalid value for image, expected int")  # F
+        ]
+        for args, int_params, error in invalid_calls:
+            with patch('ansible_runner.run') as mock_run, pytest.raises(ValueError, match=error):
+                generic_ansible('hcloud', 'hcloud_server', args, int_params, 'local')
+            mock_run.assert_not_called()
+
+        # E
+        for backups, labels, expected_backups, expected_labels in ANSIBLE_TYPE_FORMS:
+            with patch('ansible_runner.run', side_effect=make_fake_run()) as mock_run:
+                generic_ansible('hcloud', 'hcloud_server', dict(SCHEMA_ARGS, backups=backups, labels=labels),
+                                SCHEMA_INT_PARAMS, 'local')
+            module_args = mock_run.call_args.kwargs['playbook'][0]['tasks'][0]['hcloud_server']
+            assert (module_args['backups'], module_args['labels']) == (expected_backups, expected_labels)
+
+        # F
+        with patch('ansible_runner.run', side_effect=make_fake_run()) as mock_run:
+            generic_ansible('hcloud', 'hcloud_server', {'server_name': 'web1', 'image': '42'}, SCHEMA_INT_PARAMS, 'local')
+        assert mock_run.call_args.kwargs['playbook'][0]['tasks'][0]['hcloud_server'] == {
+            'server_name': 'web1', 'image': 42, 'api_token': 'abc123'}
+
+
+def test_generic_ansible_in_process(tmp_path):
+    """
+    Scenario: Modules of local integrations should give the same results when run in process as with ansible-runner
+
+    Given:
+    - A local integration with in_process set, and a python module without an action plugin
+
+    When:
+    A. the module is run in process, and with ansible-runner running the module in a process of its own
+    B. the module fails, both ways
+    C. the module has an action plugin
+    D. a module that ships with Ansible is run both ways
+
+    Then:
+    A. ansible-runner is not started, and the results are the same
+    B. The command fails with the same error
+    C. The module is run with ansible-runner
+    D. The results are the same
+    """
+    pytest.importorskip('ansible.module_utils.basic')
+    from ansible.module_utils.json_utils import _filter_non_json_lines
+    from ansible.plugins.loader import module_loader
+    module_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'TestsInput', 'modules')
+    module_loader.add_directory(module_dir)
+
+    def run_module_process(**kwargs):
+        # Runs the module the way Ansible does on a host, in a process of its own reading its args from a file
+        task = kwargs['playbook'][0]['tasks'][0]
+        command = next(key for key in task if key != 'name')
+        args_file = tmp_path / 'args.json'
+        args_file.write_text(json.dumps({'ANSIBLE_MODULE_ARGS': task[command]}))
+        stdout = subprocess.run([sys.executable, module_loader.find_plugin(command), str(args_file)],
+                                stdout=subprocess.PIPE, universal_newlines=True,
+                                env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))).stdout
+        result = json.loads(_filter_non_json_lines(stdout)[0])
+        runner = Object()
+        runner.events = [{'event': 'runner_on_failed' if result.get('failed') else 'runner_on_ok', 'stdout': '',
+                          'event_data': {'host': 'localhost', 'res': dict(result, _ansible_no_log=False)}}]
+        return runner
+
+    args = {'message': 'hi', 'count': '2', 'tags': 'a,b'}
+    int_params = {'in_process': True, 'api_token': 'not passed, as the module does not accept it'}
+
+    # A
+    with patch('ansible_runner.run') as mock_run:
+        in_process_results = generic_ansible('echo', 'xsoar_echo', args, int_params, 'local')
+    mock_run.assert_not_called()
+    with patch('ansible_runner.run', side_effect=run_module_process):
+        runner_results = generic_ansible('echo', 'xsoar_echo', args, dict(int_params, in_process=False), 'local')
+    assert in_process_results.outputs == runner_results.outputs == [
+        {'changed': True, 'echo': {'message': 'hihi', 'tags': ['a', 'b']}, 'status': 'CHANGED'}]
+    assert in_process_results.readable_output == runner_results.readable_output
+
+    # B
+    errors = []
+    for params, side_effect in [(int_params, None), (dict(int_params, in_process=False), run_module_process)]:
+        with patch('ansible_runner.run', side_effect=side_effect), pytest.raises(DemistoException) as error:
+            generic_ansible('echo', 'xsoar_echo', dict(args, fail='Yes'), params, 'local')
+        errors.append(str(error.value))
+    assert errors[0] == errors[1] == "Host localhost failed running command\nError Details: Failed as asked: hi"
+
+    # C
+    with patch('ansible.plugins.loader.action_loader.has_plugin', return_value=True), \
+            patch('ansible_runner.run', side_effect=run_module_process) as mock_run:
+        generic_ansible('echo', 'xsoar_echo', args, int_params, 'local')
+    mock_run.assert_called_once()
+
+    # D
+    with patch('ansible_runner.run') as mock_run:
+        in_process_results = generic_ansible('echo', 'ping', {'data': 'xsoar'}, int_params, 'local')
+    mock_run.assert_not_called()
+    with patch('ansible_runner.run', side_effect=run_module_process):
+        runner_results = generic_ansible('echo', 'ping', {'data': 'xsoar'}, dict(int_params, in_process=False), 'local')
+    assert in_process_results.outputs == runner_results.outputs == ['xsoar']
+    assert in_process_results.readable_output == runner_results.readable_output
+
+
+def test_generic_ansible_in_process_without_ansible():
+    """
+    Scenario: Modules run in process should give the same results as with ansible-runner, also without Ansible installed
+
+    Given:
+    - A local integration with in_process set, stand-ins for the Ansible module loader and module_utils, and a module
+      that reads its args from module_utils.basic, or from stdin when run in a process of its own
+
+    When:
+    A. the module is run in process, and with ansible-runner running the module in a process of its own
+    B. the module fails, both ways
+    C. the module is run in process by several concurrent generic_ansible_async commands
+
+    Then:
+    A. ansible-runner is not started, and the results are the same
+    B. The command fails with the same error
+    C. ansible-runner is not started, each command gets the result of its own args, and the args are cleared afterwards
+    """
+    module_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'TestsInput', 'modules')
+    fake_modules = fake_ansible_modules(module_dir)
+
+    def run_module_process(**kwargs):
+        module_args = kwargs['playbook'][0]['tasks'][0]['xsoar_raw_echo']
+        stdout = subprocess.run([sys.executable, os.path.join(module_dir, 'xsoar_raw_echo.py')],
+                                input=json.dumps({'ANSIBLE_MODULE_ARGS': module_args}),
+                                stdout=subprocess.PIPE, universal_newlines=True).stdout
+        result = module_result(stdout)
+        runner = Object()
+        runner.events = [{'event': 'runner_on_failed' if result.get('failed') else 'runner_on_ok', 'stdout': '',
+                          'event_data': {'host': 'localhost', 'res': result}}]
+        return runner
+
+    args = {'message': 'hi', 'count': '2'}
+    int_params = {'in_process': True}
+
+    # Modules run in process that miss their args find an empty stdin, rather than waiting on the one of pytest
+    with patch.dict(sys.modules, fake_modules), patch('sys.stdin', io.TextIOWrapper(io.BytesIO())):
+        # A
+        with patch('ansible_runner.run') as mock_run:
+            in_process_results = generic_ansible('echo', 'xsoar_raw_echo', args, int_params, 'local')
+        mock_run.assert_not_called()
+        with patch('ansible_runner.run', side_effect=run_module_process):
+            runner_results = generic_ansible('echo', 'xsoar_raw_echo', args, dict(int_params, in_process=False), 'local')
+        assert in_process_results.outputs == runner_results.outputs == [
+            {'changed': True, 'echo': {'message': 'hihi'}, 'status': 'CHANGED'}]
+        assert in_process_results.readable_output == runner_results.readable_output
+
+        # B
+        errors = []
+        for params, side_effect in [(int_params, None), (dict(int_params, in_process=False), run_module_process)]:
+            with patch('ansible_runner.run', side_effect=side_effect), pytest.raises(DemistoException) as error:
+                generic_ansible('echo', 'xsoar_raw_echo', dict(args, fail='Yes'), params, 'local')
+            errors.append(str(error.value))
+        assert errors[0] == errors[1] == "Host localhost failed running command\nError Details: Failed as asked: hi"
+
+        # C
+        async def run_concurrently():
+            return await asyncio.gather(*(
+                generic_ansible_async('echo', 'xsoar_raw_echo', {'message': message, 'delay': '0.05'}, int_params,
+                                      'local')
+                for message in ['a', 'b', 'c', 'd']))
+
+        with patch('ansible_runner.run_async') as mock_run_async:
+            concurrent_results = asyncio.run(run_concurrently())
+        mock_run_async.assert_not_called()
+        assert [results.outputs[0]['echo']['message'] for results in concurrent_results] == ['a', 'b', 'c', 'd']
+        assert fake_modules['ansible.module_utils.basic']._ANSIBLE_ARGS is None
+
+
+def test_rate_limiting():
+    """
+    Scenario: Module runs of an integration instance should be rate limited, and runs the provider throttled retried
+
+    Given:
+    - A local integration with a rate limit of 10 runs a second, a burst of 2, and 2 retries
+
+    When:
+    A. three modules are run at once
+    B. the provider rate limits the first run of a module
+    C. the provider rate limits every run of a module
+    D. the provider rate limits the first run of a module run with generic_ansible_async
+    E. a module is run with a deadline while the instance is backing off past it
+    F. a module that can't be run in process is run with in_process set
+    G. modules fail with the throttling errors of several providers, and with unrelated errors mentioning 429 or a
+       rate limit
+
+    Then:
+    A. The first two run straight away, and the third waits for a token
+    B. The run is retried after backing off, the backoff is shared through the integration context, and the
+       time throttled is reported
+    C. The command fails with the rate limit error once the retries are used up
+    D. The run is retried the same way
+    E. The command doesn't wait or run the module, and the host is reported as TIMEOUT
+    F. Only one token is taken for the run
+    G. Only the throttling errors, and failures with an HTTP status of 429, are taken as rate limiting
+    """
+    integration_context = MockIntegrationContext()
+    sleeps = []
+
+    def runs(*events_list):
+        results = []
+        for events in events_list:
+            run = Object()
+            run.events = events
+            results.append(run)
+        return results
+
+    def run_async(runs):
+        def fake_run_async(**kwargs):
+            thread = threading.Thread(target=lambda: None)
+            thread.start()
+            return thread, runs.pop(0)
+        return fake_run_async
+
+    async def fake_sleep(delay):
+        sleeps.append(delay)
+
+    with integration_context.patch(), \
+            patch('AnsibleApiModule.time.sleep', side_effect=sleeps.append), \
+            patch('AnsibleApiModule.asyncio.sleep', side_effect=fake_sleep):
+        # A, at a single point in time so no tokens are refilled between the runs
+        with patch('ansible_runner.run', side_effect=runs(*[MOCK_SERVER_EVENTS] * 3)), \
+                patch('AnsibleApiModule.time.time', return_value=time.time()):
+            for _ in range(3):
+                generic_ansible('hcloud', 'hcloud_server_info', RATE_LIMIT_ARGS, RATE_LIMIT_INT_PARAMS, 'local')
+        assert len(sleeps) == 1 and 0.09 < sleeps[0] <= 0.1
+        assert integration_context.data['ansible_rate_limit']['tokens'] == pytest.approx(-1, abs=0.01)
+
+        # B
+        integration_context.data.clear()
+        sleeps.clear()
+        with patch('ansible_runner.run', side_effect=runs(MOCK_RATE_LIMITED_EVENTS, MOCK_SERVER_EVENTS)) as mock_run:
+            results = generic_ansible('hcloud', 'hcloud_server_info', dict(RATE_LIMIT_ARGS, timing='Yes'),
+                                      RATE_LIMIT_INT_PARAMS, 'local')
+        assert mock_run.call_count == 2
+        assert len(sleeps) == 1 and 0.5 <= sleeps[0] <= 1
+        assert integration_context.data['ansible_rate_limit']['blocked_until'] > time.time()
+        assert results[0].outputs == [[{'id': 1, 'name': 'web1', 'status': 'running'}]]
+        # The sleep is mocked, so no time is spent throttled
+        assert results[0].readable_output.startswith("Throttled for 0.0 seconds, with 1 retries after being rate limited\n")
+        assert results[1].outputs['rate_limit_retries'] == 1
+        assert 'throttled' in results[1].outputs['stages']
+
+        # C
+        integration_context.data.clear()
+        with patch('ansible_runner.run', side_effect=runs(*[MOCK_RATE_LIMITED_EVENTS] * 3)) as mock_run, \
+                pytest.raises(DemistoException, match="Rate limit exceeded"):
+            generic_ansible('hcloud', 'hcloud_server_info', RATE_LIMIT_ARGS, RATE_LIMIT_INT_PARAMS, 'local')
+        assert mock_run.call_count == 3
+
+        # D
+        integration_context.data.clear()
+        sleeps.clear()
+        async_runs = runs(MOCK_RATE_LIMITED_EVENTS, MOCK_SERVER_EVENTS)
+        with patch('ansible_runner.run_async', side_effect=run_async(async_runs)):
+            results = asyncio.run(generic_ansible_async('hcloud', 'hcloud_server_info', RATE_LIMIT_ARGS,
+                                                        RATE_LIMIT_INT_PARAMS, 'local'))
+        assert async_runs == []
+        assert len(sleeps) == 1
+        assert results.outputs == [[{'id': 1, 'name': 'web1', 'status': 'running'}]]
+
+        # E
+        sleeps.clear()
+        integration_context.data['ansible_rate_limit']['blocked_until'] = time.time() + 30
+        with patch('ansible_runner.run') as mock_run:
+            results = generic_ansible('hcloud', 'hcloud_server_info', dict(RATE_LIMIT_ARGS, deadline='10'),
+                                      RATE_LIMIT_INT_PARAMS, 'local')
+        mock_run.assert_not_called()
+        assert sleeps == []
+        assert results.outputs == [{'timeout': True, 'msg': 'Not started before the 10 second deadline', 'status': 'TIMEOUT'}]
+        assert results.readable_output.startswith("Timed out hosts: localhost\n")
+
+        # F
+        integration_context.data.clear()
+        with patch('ansible_runner.run', side_effect=runs(MOCK_SERVER_EVENTS)):
+            generic_ansible('hcloud', 'xsoar_missing_module', RATE_LIMIT_ARGS, dict(RATE_LIMIT_INT_PARAMS, in_process=True),
+                            'local')
+        assert integration_context.data['ansible_rate_limit']['tokens'] == pytest.approx(1, abs=0.01)
+
+    # G
+    def failed_events(**res):
+        return [{'event': 'runner_on_failed', 'stdout': '', 'event_data': {'host': 'localhost', 'res': res}}]
+
+    for msg in RATE_LIMITED_MESSAGES:
+        assert rate_limited(failed_events(failed=True, msg=msg)), msg
+    for msg in NOT_RATE_LIMITED_MESSAGES:
+        assert not rate_limited(failed_events(failed=True, msg=msg)), msg
+    assert rate_limited(failed_events(failed=True, status=429, msg='Status code was 429 and not [200]'))
+    assert not rate_limited(failed_events(failed=True, status=404, msg='Status code was 404 and not [200]'))
+
+
+def test_generic_ansible_pagination(tmp_path):
+    """
+    Scenario: With limit, large results should be output a page at a time, later pages coming from a cache
+
+    Given:
+    - vmware_vm_info returning 5 virtual machines
+
+    When:
+    A. the module is run with limit 2
+    B. the next page is requested with the returned cursor
+    C. the last page is requested
+    D. a cursor that has expired is used
+    E. package_facts is run against two hosts with 3 packages each, with limit 4
+    F. a module with a limit option of its own is run with limit
+    G. the module is run with a limit that isn't positive
+    H. the module is run with limit 2 and keep_artifacts, with kept artifacts rotated after an hour
+    I. the next page is requested in another container
+    J. the next page is requested after the cached file was pruned
+
+    Then:
+    A. The first 2 virtual machines are output, along with the total and the cursor of the next page. The
+       results are cached in a file, and only indexed in the integration context
+    B. The next 2 are output from the cache, without running the module again
+    C. The last one is output, without a next cursor
+    D. The command fails, saying to run it again without a cursor, and the cached file is removed
+    E. The pages run across the hosts, each host is output with the packages on the page
+    F. The limit is passed to the module, and the results are not paged
+    G. The command fails without running the module
+    H. The page cache is not taken for a private data dir, so the cursor still works after the rotation
+    I. The command fails, saying the results can only be paged in the container that ran the command
+    J. The command fails, saying to run it again without a cursor, and the index entry is dropped as well
+    """
+
+    mock_ansible_results = Object()
+    mock_ansible_results.events = MOCK_VM_INFO_EVENTS
+    page_dir = tmp_path / 'page-cache'
+    with MockIntegrationContext().patch() as integration_context, \
+            patch('AnsibleApiModule.default_artifact_dir', return_value=str(tmp_path)):
+        # A
+        with patch('ansible_runner.run', return_value=mock_ansible_results):
+            results, page = generic_ansible('vmware', 'vmware_vm_info', {'limit': '2'}, PAGINATION_INT_PARAMS, 'local')
+        assert [vm['guest_name'] for vm in results.outputs[0]['virtual_machines']] == ['vm1', 'vm2']
+        assert page.outputs_prefix == 'vmware.Page'
+        assert (page.outputs['offset'], page.outputs['limit'], page.outputs['total']) == (0, 2, 5)
+        assert page.readable_output.startswith("Showing 1-2 of 5. Run the command again with cursor=")
+        assert list(integration_context.data['ansible_pages'].values()) == [
+            {'module': 'vmware_vm_info', 'limit': 2, 'total': 5, 'container': socket.gethostname(),
+             'expires': pytest.approx(time.time() + 600, abs=5)}]
+        cache_file = page_dir / ('%s.json' % next(iter(integration_context.data['ansible_pages'])))
+        assert len(json.loads(cache_file.read_text())['host_results']) == 1
+        assert oct(os.stat(cache_file).st_mode & 0o777) == '0o600'
+
+        # B
+        with patch('ansible_runner.run') as mock_run:
+            results, page = generic_ansible('vmware', 'vmware_vm_info', {'cursor': page.outputs['next_cursor']},
+                                            PAGINATION_INT_PARAMS, 'local')
+        mock_run.assert_not_called()
+        assert [vm['guest_name'] for vm in results.outputs[0]['virtual_machines']] == ['vm3', 'vm4']
+        assert results.outputs[0]['status'] == 'SUCCESS'
+
+        # C
+        results, page = generic_ansible('vmware', 'vmware_vm_info', {'cursor': page.outputs['next_cursor']},
+                                        PAGINATION_INT_PARAMS, 'local')
+        assert [vm['guest_name'] for vm in results.outputs[0]['virtual_machines']] == ['vm5']
+        assert page.outputs['next_cursor'] is None
+        assert page.readable_output == "Showing 5-5 of 5. This is the last page."
+
+        # D
+        cursor = '%s:2' % next(iter(integration_context.data['ansible_pages']))
+        with patch('AnsibleApiModule.time.time', return_value=time.time() + 3600):
+            with pytest.raises(DemistoException, match="Run the command again without a cursor"):
+                generic_ansible('vmware', 'vmware_vm_info', {'cursor': cursor}, PAGINATION_INT_PARAMS, 'local')
+            # The next result set cached drops the expired one
+            with patch('ansible_runner.run', return_value=mock_ansible_results):
+                generic_ansible('vmware', 'vmware_vm_info', {'limit': '2'}, PAGINATION_INT_PARAMS, 'local')
+        assert not cache_file.exists()
+        assert len(integration_context.data['ansible_pages']) == 1
+
+        # E
+        mock_ansible_results.events = MOCK_PACKAGE_FACTS_EVENTS
+        int_params = {'port': 22, 'creds': {'identifier': 'bill', 'password': 'xyz321', 'credentials': {}}}
+        with patch('ansible_runner.run', return_value=mock_ansible_results):
+            results, page = generic_ansible('linux', 'package_facts', {'host': '10.0.0.1, 10.0.0.2', 'limit': '4'},
+                                            int_params, 'ssh')
+        assert results.outputs == EXPECTED_PACKAGE_FACTS_PAGES[0]
+        results, page = generic_ansible('linux', 'package_facts', {'cursor': page.outputs['next_cursor']}, int_params,
+                                        'ssh')
+        assert results.outputs == EXPECTED_PACKAGE_FACTS_PAGES[1]
+        assert page.outputs['total'] == 6
+
+        # F
+        mock_ansible_results.events = MOCK_VM_INFO_EVENTS
+        with patch.dict('AnsibleApiModule.ARGUMENT_SCHEMAS', {'vmware_vm_info': {'limit': {'type': 'int'}}}), \
+                patch('ansible_runner.run', return_value=mock_ansible_results) as mock_run:
+            results = generic_ansible('vmware', 'vmware_vm_info', {'limit': '2'}, PAGINATION_INT_PARAMS, 'local')
+        assert mock_run.call_args.kwargs['playbook'][0]['tasks'][0]['vmware_vm_info']['limit'] == 2
+        assert len(results.outputs[0]['virtual_machines']) == 5
+
+        # G
+        for limit in ['0', '-1', 'ten']:
+            with patch('ansible_runner.run') as mock_run, pytest.raises(ValueError, match="limit must be a positive number"):
+                generic_ansible('vmware', 'vmware_vm_info', {'limit': limit}, PAGINATION_INT_PARAMS, 'local')
+            mock_run.assert_not_called()
+
+        # H
+        int_params = dict(PAGINATION_INT_PARAMS, keep_artifacts=True, artifact_max_age='1')
+        with patch('ansible_runner.run', return_value=mock_ansible_results):
+            _, page = generic_ansible('vmware', 'vmware_vm_info', {'limit': '2'}, int_params, 'local')
+        assert list(tmp_path.glob('ansible-*'))
+        with patch('AnsibleApiModule.time.time', return_value=time.time() + 3700):
+            for entry in tmp_path.iterdir():
+                os.utime(entry, (time.time() - 3700, time.time() - 3700))
+            rotate_artifacts(str(tmp_path), max_age=1)
+        assert not list(tmp_path.glob('ansible-*'))
+        results, next_page = generic_ansible('vmware', 'vmware_vm_info', {'cursor': page.outputs['next_cursor']},
+                                             int_params, 'local')
+        assert [vm['guest_name'] for vm in results.outputs[0]['virtual_machines']] == ['vm3', 'vm4']
+
+        # I
+        with patch('AnsibleApiModule.socket.gethostname', return_value='other-container'), \
+                pytest.raises(DemistoException, match="can only be paged in the container that ran the command"):
+            generic_ansible('vmware', 'vmware_vm_info', {'cursor': next_page.outputs['next_cursor']}, int_params, 'local')
+
+        # J
+        cache_id = next_page.outputs['next_cursor'].split(':')[0]
+        (page_dir / ('%s.json' % cache_id)).unlink()
+        with pytest.raises(DemistoException, match="Run the command again without a cursor"):
+            generic_ansible('vmware', 'vmware_vm_info', {'cursor': next_page.outputs['next_cursor']}, int_params, 'local')
+        assert cache_id not in integration_context.data['ansible_pages']
@@ -0,0 +1,35 @@
+ASYNC_ARGS = {'host': "123.123.123.123, 123.123.123.124", 'name': 'nginx', 'state': 'latest',
+              'async': 'Yes', 'async_timeout': '600'}
+ASYNC_INT_PARAMS = {'port': 22, 'concurrency': 4, 'creds': {'identifier': 'bill', 'password': 'xyz321', 'credentials': {}}}
+
+MOCK_ASYNC_START_EVENTS = [
+    {'event': 'runner_on_ok', 'stdout': '123.123.123.123 | CHANGED => {\r\n    "ansible_job_id": "11111.1",\r\n\
+    "changed": true,\r\n    "finished": 0,\r\n    "results_file": "/root/.ansible_async/11111.1",\r\n    "started": 1\r\n}'},
+    {'event': 'runner_on_ok', 'stdout': '123.123.123.124 | CHANGED => {\r\n    "ansible_job_id": "22222.2",\r\n\
+    "changed": true,\r\n    "finished": 0,\r\n    "results_file": "/root/.ansible_async/22222.2",\r\n    "started": 1\r\n}'}
+]
+
+MOCK_ASYNC_RUNNING_EVENTS = [
+    {'event': 'runner_on_ok', 'stdout': '123.123.123.123 | SUCCESS => {\r\n    "ansible_job_id": "11111.1",\r\n\
+    "changed": false,\r\n    "finished": 1,\r\n    "results_file": "/root/.ansible_async/11111.1",\r\n    "started": 1,\r\n\
+    "cache_updated": false\r\n}'},
+    {'event': 'runner_on_ok', 'stdout': '123.123.123.124 | SUCCESS => {\r\n    "ansible_job_id": "22222.2",\r\n\
+    "changed": false,\r\n    "finished": 0,\r\n    "results_file": "/root/.ansible_async/22222.2",\r\n    "started": 1\r\n}'}
+]
+
+MOCK_ASYNC_FINISHED_EVENTS = [
+    {'event': 'runner_on_ok', 'stdout': '123.123.123.123 | SUCCESS => {\r\n    "ansible_job_id": "11111.1",\r\n\
+    "changed": false,\r\n    "finished": 1,\r\n    "results_file": "/root/.ansible_async/11111.1",\r\n    "started": 1,\r\n\
+    "cache_updated": false\r\n}'},
+    {'event': 'runner_on_ok', 'stdout': '123.123.123.124 | SUCCESS => {\r\n    "ansible_job_id": "22222.2",\r\n\
+    "changed": true,\r\n    "finished": 1,\r\n    "results_file": "/root/.ansible_async/22222.2",\r\n    "started": 1,\r\n\
+    "cache_updated": true\r\n}'}
+]
+
+MOCK_ASYNC_FAILED_EVENTS = [
+    {'event': 'runner_on_failed', 'stdout': '123.123.123.123 | FAILED! => {\r\n    "ansible_job_id": "33333.3",\r\n\
+    "changed": false,\r\n    "finished": 1,\r\n    "msg": "No package matching \'nginx\' is available"\r\n}'}
+]
+
+EXPECTED_ASYNC_OUTPUTS = [{'changed': False, 'cache_updated': False, 'host': '123.123.123.123', 'status': 'SUCCESS'},
+                          {'changed': True, 'cache_updated': True, 'host': '123.123.123.124', 'status': 'SUCCESS'}]
@@ -0,0 +1,31 @@
+DELTA_ARGS = {'host': "10.0.0.1, 10.0.0.2, 10.0.0.3", 'gather_subset': 'min', 'delta': 'Yes'}
+DELTA_SECOND_ARGS = {'host': "10.0.0.1, 10.0.0.2, 10.0.0.4", 'gather_subset': 'min', 'delta': 'Yes'}
+DELTA_INT_PARAMS = {'port': 22, 'creds': {'identifier': 'bill', 'password': 'xyz321', 'credentials': {}}}
+
+MOCK_FIRST_RUN_FACTS = {
+    '10.0.0.1': {'ansible_hostname': 'web1', 'ansible_kernel': '5.4.0', 'ansible_uptime_seconds': 100},
+    '10.0.0.2': {'ansible_hostname': 'web2', 'ansible_kernel': '5.4.0', 'ansible_uptime_seconds': 200,
+                 'ansible_swaptotal_mb': 1024},
+    '10.0.0.3': {'ansible_hostname': 'web3', 'ansible_kernel': '5.4.0', 'ansible_uptime_seconds': 300}
+}
+
+# 10.0.0.1 unchanged, 10.0.0.2 rebooted into a new kernel without swap, 10.0.0.3 not in the run and 10.0.0.4 added
+MOCK_SECOND_RUN_FACTS = {
+    '10.0.0.1': {'ansible_hostname': 'web1', 'ansible_kernel': '5.4.0', 'ansible_uptime_seconds': 100},
+    '10.0.0.2': {'ansible_hostname': 'web2', 'ansible_kernel': '5.15.0', 'ansible_uptime_seconds': 10},
+    '10.0.0.4': {'ansible_hostname': 'web4', 'ansible_kernel': '5.15.0', 'ansible_uptime_seconds': 20}
+}
+
+
+def facts_events(facts):
+    return [{'event': 'runner_on_ok', 'stdout': '', 'event_data': {'host': host, 'res': {'ansible_facts': host_facts,
+                                                                                          'changed': False}}}
+            for host, host_facts in facts.items()]
+
+
+EXPECTED_DELTA_OUTPUTS = [
+    {'kernel': '5.15.0', 'uptime_seconds': 10, 'removed_fields': ['swaptotal_mb'], 'delta': 'changed',
+     'host': '10.0.0.2', 'status': 'SUCCESS'},
+    {'hostname': 'web4', 'kernel': '5.15.0', 'uptime_seconds': 20, 'delta': 'new', 'host': '10.0.0.4',
+     'status': 'SUCCESS'}
+]
@@ -1,5 +1,7 @@
 ANSIBLE_INVENTORY_HOSTS_LIST = {'host': ['123.123.123.123', 'example-host1', 'host.example.com']}
 ANSIBLE_INVENTORY_HOSTS_CSV_LIST = {'host': "123.123.123.123, host.example.com"}
 ANSIBLE_INVENTORY_HOST_w_PORT = {'host': "123.123.123.123:45678"}
+ANSIBLE_INVENTORY_HOST_RANGES = {'host': ['web[1:3].example.com', 'db-[a:b]', '10.0.0.0/30:2222']}
+ANSIBLE_INVENTORY_HOST_DUPLICATES = {'host': "123.123.123.123, host.example.com, 123.123.123.123,host.example.com"}
 ANSIBLE_INVENTORY_INT_PARAMS = {'port': 22, 'creds': {'credentials': {
     'user': 'joe', 'password': 'pass123', 'sshkey': 'aaaaaaaaaaaaaa'}, 'identifier': 'bill', 'password': 'xyz321'}}
@@ -0,0 +1,22 @@
+TIMEOUT_INT_PARAMS = {'port': 22, 'creds': {'identifier': 'bill', 'password': 'xyz321', 'credentials': {}}}
+
+MOCK_HOST_TIMEOUT_EVENTS = [
+    {'event': 'runner_on_ok', 'stdout': '', 'event_data': {'host': '10.0.0.1', 'res': {
+        'changed': False, 'stdout': 'up', 'ansible_job_id': '1111.1', 'finished': 1}}},
+    {'event': 'runner_on_failed', 'stdout': '', 'event_data': {'host': '10.0.0.2', 'res': {
+        'failed': True, 'msg': 'async task did not complete within the requested time - 5s'}}}
+]
+
+# The run is cancelled at the deadline while 10.0.0.2 is running, before 10.0.0.3 has started
+MOCK_DEADLINE_EVENTS = [
+    {'event': 'runner_on_start', 'stdout': '', 'event_data': {'host': '10.0.0.1'}},
+    {'event': 'runner_on_ok', 'stdout': '', 'event_data': {'host': '10.0.0.1', 'res': {'changed': False, 'stdout': 'up'}}},
+    {'event': 'runner_on_start', 'stdout': '', 'event_data': {'host': '10.0.0.2'}}
+]
+
+EXPECTED_DEADLINE_OUTPUTS = [
+    {'stdout': 'up', 'changed': False, 'host': '10.0.0.1', 'status': 'SUCCESS'},
+    {'timeout': True, 'msg': 'Cancelled at the 1 second deadline before the module finished', 'host': '10.0.0.2',
+     'status': 'TIMEOUT'},
+    {'timeout': True, 'msg': 'Not started before the 1 second deadline', 'host': '10.0.0.3', 'status': 'TIMEOUT'}
+]
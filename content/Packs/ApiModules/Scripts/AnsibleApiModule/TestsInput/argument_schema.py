@@ -0,0 +1,32 @@
+ARGUMENT_SCHEMAS = {
+    'hcloud_server': {
+        'api_token': {'required': True},
+        'name': {'required': True, 'aliases': ['server_name']},
+        'state': {'choices': ['absent', 'present', 'restarted', 'started', 'stopped', 'rebuild']},
+        'backups': {'type': 'bool'},
+        'labels': {'type': 'dict'},
+        'ssh_keys': {'type': 'list', 'elements': 'str'},
+        'ports': {'type': 'list', 'elements': 'int'},
+        'delete_protection_timeout': {'type': 'float'},
+        'image_id': {'type': 'int', 'aliases': ['image']}
+    }
+}
+
+SCHEMA_INT_PARAMS = {'api_token': 'abc123', 'endpoint': 'https://api.hetzner.cloud/v1', 'keep_artifacts': False}
+
+SCHEMA_ARGS = {'name': 'web1', 'state': 'present', 'backups': 'Yes', 'labels': '{"env": "prod"}',
+               'ssh_keys': 'key-a,key-b', 'ports': '22, 443', 'delete_protection_timeout': '1.5', 'image_id': '42',
+               'timing': 'No'}
+
+EXPECTED_SCHEMA_MODULE_ARGS = {'name': 'web1', 'state': 'present', 'backups': True, 'labels': {'env': 'prod'},
+                               'ssh_keys': ['key-a', 'key-b'], 'ports': [22, 443], 'delete_protection_timeout': 1.5,
+                               'image_id': 42, 'api_token': 'abc123'}
+
+# Other bool and dict forms accepted by Ansible, and the values they are coerced to
+ANSIBLE_TYPE_FORMS = [
+    ('on', 'env=prod', True, {'env': 'prod'}),
+    ('N', 'env=prod, tier=web', False, {'env': 'prod', 'tier': 'web'}),
+    ('t', 'env="prod east" tier=web', True, {'env': 'prod east', 'tier': 'web'}),
+    ('0', "{'env': 'prod'}", False, "{'env': 'prod'}"),   # Not JSON, left for Ansible to evaluate
+    ('1', {'env': 'prod'}, True, {'env': 'prod'})
+]
@@ -0,0 +1,47 @@
+"""Stand-ins for the parts of Ansible used to run modules in process, for tests that run without Ansible.
+
+fake_ansible_modules returns sys.modules entries for the ansible packages that run_module_in_process
+and in_process_module_path import. Modules are looked up in module_dir, and none have an action plugin.
+"""
+import json
+import os
+import types
+from typing import Dict, List
+
+
+def filter_non_json_lines(data: str) -> List[str]:
+    # Like ansible.module_utils.json_utils._filter_non_json_lines, drops the lines before the JSON result
+    lines = data.splitlines()
+    starts = [index for index, line in enumerate(lines) if line.startswith('{')]
+    if not starts:
+        raise ValueError('No start of json char found')
+    start = starts[0]
+    return ['\n'.join(lines[start:]), '\n'.join(lines[:start])]
+
+
+def fake_ansible_modules(module_dir: str) -> Dict[str, types.ModuleType]:
+    modules = {name: types.ModuleType(name) for name in [
+        'ansible', 'ansible.module_utils', 'ansible.module_utils.basic', 'ansible.module_utils.json_utils',
+        'ansible.plugins', 'ansible.plugins.loader']}
+
+    modules['ansible.module_utils.basic']._ANSIBLE_ARGS = None
+    modules['ansible.module_utils.json_utils']._filter_non_json_lines = filter_non_json_lines
+
+    def find_plugin(name: str):
+        path = os.path.join(module_dir, name + '.py')
+        return path if os.path.exists(path) else None
+
+    loader = modules['ansible.plugins.loader']
+    loader.module_loader = types.SimpleNamespace(find_plugin=find_plugin)
+    loader.action_loader = types.SimpleNamespace(has_plugin=lambda name: False)
+
+    # Submodules are attributes of their package, as they are once imported
+    for name, module in modules.items():
+        if '.' in name:
+            package, attribute = name.rsplit('.', 1)
+            setattr(modules[package], attribute, module)
+    return modules
+
+
+def module_result(stdout: str) -> Dict:
+    return json.loads(filter_non_json_lines(stdout)[0])
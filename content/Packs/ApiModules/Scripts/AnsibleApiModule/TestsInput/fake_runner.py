@@ -0,0 +1,91 @@
+"""A local stand-in for ansible_runner.run that replays synthetic event streams.
+
+Used by the benchmarks and tests to exercise generic_ansible without Ansible. The events are
+shaped like the ones ansible-runner produces for the single task playbook generic_ansible runs, and
+are generated from a seeded random generator so the same settings always replay the same stream.
+"""
+import json
+import random
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+EVENT_START = datetime(2021, 6, 1, 15, 57, 37)
+
+
+def generate_result(payload_size: int, depth: int, rng: random.Random) -> Dict[str, Any]:
+    """Build a module result with payload_size leaf values, nested depth levels deep."""
+    result: Dict[str, Any] = {'changed': False, 'ansible_facts': {'discovered_interpreter_python': '/usr/bin/python3'}}
+    level = result
+    per_level = max(payload_size // max(depth, 1), 1)
+    for current_depth in range(max(depth, 1)):
+        for index in range(per_level):
+            level['ansible_key_%d_%d' % (current_depth, index)] = rng.choice(
+                ['value-%d' % rng.randint(0, 10000), rng.randint(0, 10000), rng.random() > 0.5, None])
+        # Lists of dicts exercise the markdown list headers
+        level['items'] = [{'id': index, 'name': 'item-%d' % index} for index in range(min(per_level, 5))]
+        level['nested'] = {}
+        level = level['nested']
+    return result
+
+
+def format_stdout(host: str, status: str, result: Dict[str, Any]) -> str:
+    return '%s: [%s] => %s' % (status, host, json.dumps(result, indent=4).replace('\n', '\r\n'))
+
+
+def generate_events(hosts: List[str], payload_size: int = 20, depth: int = 2, failure_rate: float = 0.0,
+                    unreachable_rate: float = 0.0, seed: int = 0) -> List[Dict[str, Any]]:
+    """Replay a module run against hosts, a share of which fail or are unreachable."""
+    rng = random.Random(seed)
+    created = EVENT_START
+    events = [{'event': 'playbook_on_start', 'stdout': '', 'created': created.isoformat(), 'event_data': {}}]
+    for counter, host in enumerate(hosts):
+        created += timedelta(milliseconds=rng.randint(1, 5))
+        events.append({'event': 'runner_on_start', 'stdout': '', 'counter': counter, 'created': created.isoformat(),
+                       'event_data': {'host': host, 'task': 'benchmark'}})
+
+    for counter, host in enumerate(hosts):
+        created += timedelta(milliseconds=rng.randint(50, 500))
+        roll = rng.random()
+        if roll < unreachable_rate:
+            event, status = 'runner_on_unreachable', 'unreachable'
+            result = {'changed': False, 'unreachable': True, 'msg': 'Failed to connect to the host via ssh'}
+        elif roll < unreachable_rate + failure_rate:
+            event, status = 'runner_on_failed', 'fatal'
+            result = {'changed': False, 'failed': True, 'msg': 'module failure'}
+        else:
+            event, status = 'runner_on_ok', 'ok'
+            result = generate_result(payload_size, depth, rng)
+        result['_ansible_no_log'] = False
+        events.append({'event': event, 'stdout': format_stdout(host, status, result), 'counter': len(hosts) + counter,
+                       'created': created.isoformat(), 'event_data': {'host': host, 'task': 'benchmark', 'res': result}})
+    return events
+
+
+class FakeRunner(object):
+    def __init__(self, events: List[Dict[str, Any]]):
+        self.events = events
+        self.status = 'successful'
+        self.rc = 0
+
+
+def make_fake_run(**event_settings):
+    """Return a replacement for ansible_runner.run, replaying events for the hosts in the inventory.
+
+    event_settings are passed to generate_events.
+    """
+    def fake_run(**kwargs):
+        hosts = list(kwargs['inventory']['all']['hosts'])
+        return FakeRunner(generate_events(hosts, **event_settings))
+    return fake_run
+
+
+def make_fake_run_async(**event_settings):
+    """Return a replacement for ansible_runner.run_async, see make_fake_run."""
+    fake_run = make_fake_run(**event_settings)
+
+    def fake_run_async(**kwargs):
+        thread = threading.Thread(target=lambda: None)
+        thread.start()
+        return thread, fake_run(**kwargs)
+    return fake_run_async
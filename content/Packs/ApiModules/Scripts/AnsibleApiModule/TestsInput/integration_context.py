@@ -0,0 +1,35 @@
+"""A local stand-in for the integration context, with the versioned reads and writes of the server.
+
+Writes with a version other than the current one fail with a ValueError, like they do when another
+command wrote to the context first.
+"""
+import json
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Tuple
+from unittest.mock import patch
+
+
+class MockIntegrationContext:
+    def __init__(self, data: Dict[str, Any] = None):
+        self.data: Dict[str, Any] = data or {}
+        self.version = 0
+
+    def get(self) -> Dict[str, Any]:
+        # Copies, so changes are only seen once they are written back
+        return json.loads(json.dumps(self.data))
+
+    def get_with_version(self) -> Tuple[Dict[str, Any], int]:
+        return self.get(), self.version
+
+    def set(self, context: Dict[str, Any], sync: bool = True, version: int = -1):
+        if version != -1 and version != self.version:
+            raise ValueError("Version conflict, the context is at version %d, not %d" % (self.version, version))
+        self.data = json.loads(json.dumps(context))
+        self.version += 1
+
+    @contextmanager
+    def patch(self) -> Iterator['MockIntegrationContext']:
+        with patch('AnsibleApiModule.get_integration_context', side_effect=self.get), \
+                patch('AnsibleApiModule.get_integration_context_with_version', side_effect=self.get_with_version), \
+                patch('AnsibleApiModule.set_integration_context', side_effect=self.set):
+            yield self
@@ -0,0 +1,35 @@
+STRUCTURED_ARGS = {
+    'name': 'web "primary" 01',
+    'labels': {'env': 'prod', 'team': "ops's"},
+    'ssh_keys': ['key-a', 'key-b'],
+    'user_data': "#cloud-config\nruncmd:\n  - echo {{ not_a_variable }}\n" + 'x' * 4096,
+}
+STRUCTURED_INT_PARAMS = {'api_token': 'abc123', 'endpoint': 'https://api.hetzner.cloud/v1', 'keep_artifacts': False,
+                         'proxy': 'http://proxy:3128'}
+
+EXPECTED_STRUCTURED_MODULE_ARGS = {
+    'name': 'web "primary" 01',
+    'labels': {'env': 'prod', 'team': "ops's"},
+    'ssh_keys': ['key-a', 'key-b'],
+    'user_data': "{% raw %}#cloud-config\nruncmd:\n  - echo {{ not_a_variable }}\n" + 'x' * 4096 + "{% endraw %}",
+    'api_token': 'abc123',
+    'endpoint': 'https://api.hetzner.cloud/v1'
+}
+
+MOCK_PLAYBOOK_EVENTS = [
+    {'event': 'playbook_on_start', 'stdout': '', 'created': '2021-06-01T15:57:37.638813', 'event_data': {}},
+    {'event': 'runner_on_start', 'stdout': '', 'created': '2021-06-01T15:57:37.668136',
+     'event_data': {'host': 'localhost', 'task': 'hcloud_server'}},
+    {'event': 'runner_on_ok', 'stdout': 'changed: [localhost]', 'created': '2021-06-01T15:57:38.668136',
+     'event_data': {'host': 'localhost', 'task': 'hcloud_server',
+                    'res': {'changed': True, 'hcloud_server': {'id': '42', 'name': 'web "primary" 01', 'server_type': 'cx11'},
+                            'invocation': {'module_args': {'api_token': 'VALUE_SPECIFIED_IN_NO_LOG_PARAMETER'}},
+                            '_ansible_no_log': False}}}
+]
+
+EXPECTED_PLAYBOOK_OUTPUTS = [{'id': '42', 'name': 'web "primary" 01', 'server_type': 'cx11', 'status': 'CHANGED'}]
+EXPECTED_PLAYBOOK_READABLE = """# CHANGED
+  * id: 42
+  * name: web "primary" 01
+  * server_type: cx11
+"""
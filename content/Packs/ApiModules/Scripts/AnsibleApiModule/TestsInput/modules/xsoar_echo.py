@@ -0,0 +1,41 @@
+#!/usr/bin/python
+DOCUMENTATION = '''
+---
+module: xsoar_echo
+short_description: Return the args it was given, used to test running modules in process
+options:
+  message:
+    type: str
+    required: true
+  count:
+    type: int
+    default: 1
+  tags:
+    type: list
+    elements: str
+  fail:
+    type: bool
+    default: false
+'''
+
+from ansible.module_utils.basic import AnsibleModule
+
+
+def main():
+    module = AnsibleModule(argument_spec=dict(
+        message=dict(type='str', required=True),
+        count=dict(type='int', default=1),
+        tags=dict(type='list', elements='str'),
+        fail=dict(type='bool', default=False)
+    ))
+    if module.params['fail']:
+        module.fail_json(msg="Failed as asked: %s" % module.params['message'])
+
+    print("Noise printed before the result is ignored, as it is by Ansible")
+    module.exit_json(changed=module.params['count'] > 1,
+                     echo={'message': module.params['message'] * module.params['count'],
+                           'tags': module.params['tags']})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+#!/usr/bin/python
+DOCUMENTATION = '''
+---
+module: xsoar_raw_echo
+short_description: Return the args it was given, without AnsibleModule, used to test running modules in process
+options:
+  message:
+    type: str
+    required: true
+  count:
+    type: int
+    default: 1
+  fail:
+    type: bool
+    default: false
+  delay:
+    type: float
+    default: 0
+'''
+
+import json
+import sys
+import time
+
+
+def load_args():
+    # The args injected by the in process runner, or read from stdin like old style modules do
+    try:
+        from ansible.module_utils import basic
+        raw_args = basic._ANSIBLE_ARGS
+    except ImportError:
+        raw_args = None
+    if raw_args is None:
+        raw_args = sys.stdin.buffer.read()
+    return json.loads(raw_args)['ANSIBLE_MODULE_ARGS']
+
+
+def main():
+    args = load_args()
+    # Gives concurrent runs time to overlap
+    time.sleep(float(args.get('delay', 0)))
+    if str(args.get('fail', '')).lower() in ['yes', 'true']:
+        print(json.dumps({'failed': True, 'msg': "Failed as asked: %s" % args['message']}))
+        sys.exit(1)
+
+    count = int(args.get('count', 1))
+    print("Noise printed before the result is ignored, as it is by Ansible")
+    print(json.dumps({'changed': count > 1, 'echo': {'message': args['message'] * count}}))
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,27 @@
+NETWORK_ARGS = {'host': '10.1.1.1', 'commands': ['show version'], 'timing': 'Yes'}
+NETWORK_INT_PARAMS = {'concurrency': 4, 'connect_timeout': '20', 'command_timeout': '60',
+                      'creds': {'identifier': 'admin', 'password': 'cisco', 'credentials': {}}}
+
+EXPECTED_NETWORK_VARS = {'ansible_user': 'admin', 'ansible_password': 'cisco', 'ansible_connection': 'network_cli',
+                         'ansible_network_os': 'ios', 'ansible_become': 'yes', 'ansible_become_method': 'enable',
+                         'ansible_timeout': 20}
+
+# Logging in takes 4s, running the module 1.5s
+MOCK_NETWORK_EVENTS = [
+    {'event': 'playbook_on_start', 'stdout': '', 'created': '2021-06-01T15:57:37.000000', 'event_data': {}},
+    {'event': 'runner_on_start', 'stdout': '', 'created': '2021-06-01T15:57:38.000000',
+     'event_data': {'host': '10.1.1.1', 'task': 'connect'}},
+    {'event': 'runner_on_ok', 'stdout': '', 'created': '2021-06-01T15:57:42.000000',
+     'event_data': {'host': '10.1.1.1', 'task': 'connect', 'res': {
+         'changed': False, 'stdout': '*15:57:42.123 UTC Tue Jun 1 2021'}}},
+    {'event': 'runner_on_start', 'stdout': '', 'created': '2021-06-01T15:57:42.100000',
+     'event_data': {'host': '10.1.1.1', 'task': 'ios_command'}},
+    {'event': 'runner_on_ok', 'stdout': '', 'created': '2021-06-01T15:57:43.600000',
+     'event_data': {'host': '10.1.1.1', 'task': 'ios_command', 'res': {
+         'changed': False, 'stdout': ['Cisco IOS Software, Version 15.2(4)E10'],
+         'stdout_lines': [['Cisco IOS Software, Version 15.2(4)E10']]}}}
+]
+
+EXPECTED_NETWORK_OUTPUTS = [{'changed': False, 'stdout': ['Cisco IOS Software, Version 15.2(4)E10'],
+                             'stdout_lines': [['Cisco IOS Software, Version 15.2(4)E10']], 'host': '10.1.1.1',
+                             'status': 'SUCCESS'}]
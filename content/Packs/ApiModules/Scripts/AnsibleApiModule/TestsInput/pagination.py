@@ -0,0 +1,22 @@
+PAGINATION_INT_PARAMS = {'hostname': 'vcenter.example.com', 'username': 'bill', 'password': 'xyz321'}
+
+MOCK_VM_INFO_EVENTS = [
+    {'event': 'runner_on_ok', 'stdout': '', 'event_data': {'host': 'localhost', 'res': {
+        'changed': False, 'virtual_machines': [{'guest_name': 'vm%d' % index, 'power_state': 'poweredOn'}
+                                               for index in range(1, 6)]}}}
+]
+
+MOCK_PACKAGE_FACTS_EVENTS = [
+    {'event': 'runner_on_ok', 'stdout': '', 'event_data': {'host': host, 'res': {
+        'changed': False, 'ansible_facts': {'packages': [{'name': 'package%d' % index} for index in range(1, 4)],
+                                            'hostname': host}}}}
+    for host in ['10.0.0.1', '10.0.0.2']
+]
+
+EXPECTED_PACKAGE_FACTS_PAGES = [
+    [{'packages': [{'name': 'package1'}, {'name': 'package2'}, {'name': 'package3'}], 'hostname': '10.0.0.1',
+      'host': '10.0.0.1', 'status': 'SUCCESS'},
+     {'packages': [{'name': 'package1'}], 'hostname': '10.0.0.2', 'host': '10.0.0.2', 'status': 'SUCCESS'}],
+    [{'packages': [{'name': 'package2'}, {'name': 'package3'}], 'hostname': '10.0.0.2', 'host': '10.0.0.2',
+      'status': 'SUCCESS'}]
+]
@@ -0,0 +1,31 @@
+RATE_LIMIT_ARGS = {'name': 'web1'}
+RATE_LIMIT_INT_PARAMS = {'api_token': 'xyz321', 'rate_limit': '10', 'rate_limit_burst': '2', 'rate_limit_retries': '2',
+                         'rate_limit_backoff': '1'}
+
+MOCK_RATE_LIMITED_EVENTS = [
+    {'event': 'runner_on_failed', 'stdout': '', 'event_data': {'host': 'localhost', 'res': {
+        'failed': True, 'msg': 'Rate limit exceeded (rate_limit_exceeded)'}}}
+]
+
+MOCK_SERVER_EVENTS = [
+    {'event': 'runner_on_ok', 'stdout': '', 'event_data': {'host': 'localhost', 'res': {
+        'changed': False, 'hcloud_server_info': [{'id': 1, 'name': 'web1', 'status': 'running'}]}}}
+]
+
+# Failure messages of providers throttling us, and of unrelated errors that mention 429 or a rate limit
+RATE_LIMITED_MESSAGES = [
+    'Rate limit exceeded (rate_limit_exceeded)',
+    'Status code was 429 and not [200]: HTTP Error 429: Too Many Requests',
+    'Azure Error: TooManyRequests',
+    'An error occurred (RequestLimitExceeded) when calling the DescribeInstances operation: Request limit exceeded.',
+    'An error occurred (ThrottlingException) when calling the ListStacks operation: Rate exceeded',
+    'An error occurred (SlowDown) when calling the PutObject operation: Please reduce your request rate.',
+    'GCP returned error: userRateLimitExceeded'
+]
+
+NOT_RATE_LIMITED_MESSAGES = [
+    'Virtual machine 429 not found',
+    'Invalid rate_limit setting on load balancer',
+    'Unsupported parameters: rate_limit',
+    'Port 4290 is already in use'
+]